@@ -0,0 +1,1092 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks de rendimiento del juego Los Lobos
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+import secrets
+import subprocess
+import statistics
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+import django
+
+# Configurar Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lobos.settings')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+django.setup()
+
+from juego.consumers import LobbyConsumer
+from juego.models import Sala
+from juego.protocolo import evento_grupo, mensaje_cambios, orjson
+from juego import codigos, reparto
+
+
+def _jugadores(n):
+    return [
+        {'id': i, 'nombre': f'Jugador {i}', 'es_lider': i == 1, 'rol': 'aldeano'}
+        for i in range(1, n + 1)
+    ]
+
+
+class _SocketFalso(LobbyConsumer):
+    """LobbyConsumer sin conexión real: `send` solo cuenta los bytes"""
+
+    def __init__(self):
+        self.bytes_enviados = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.bytes_enviados += len(text_data)
+
+
+async def _difusion_antes(sockets, eventos):
+    # Como antes: cada socket codifica el mismo mensaje para sí mismo
+    for socket in sockets:
+        await socket.send(text_data=json.dumps({
+            'tipo': 'cambios_jugadores',
+            'epoca': 'abcd1234',
+            'eventos': eventos
+        }))
+
+
+async def _difusion_despues(sockets, eventos):
+    # Ahora: se codifica una vez y cada socket reenvía el texto
+    evento = evento_grupo(mensaje_cambios('abcd1234', eventos))
+    for socket in sockets:
+        await socket.reenviar(evento)
+
+
+def benchmark_difusion(repeticiones=200):
+    """CPU por difusión a 10/100/1000 sockets, codificando por socket o una vez"""
+    eventos = [{'evento': 'unido', 'version': 1, 'jugador': j} for j in _jugadores(20)]
+    codificador = 'orjson' if orjson is not None else 'json'
+
+    print(f"\n📊 Difusión de un mensaje de grupo (codificador: {codificador})")
+    print("=" * 80)
+    print(f"{'Sockets':>8} | {'Antes (ms)':>12} | {'Después (ms)':>12} | {'Mejora':>8}")
+    print("-" * 80)
+    for num_sockets in (10, 100, 1000):
+        sockets = [_SocketFalso() for _ in range(num_sockets)]
+        reps = max(1, repeticiones * 10 // num_sockets)
+        resultados = []
+        for difundir in (_difusion_antes, _difusion_despues):
+            inicio = time.process_time()
+            for _ in range(reps):
+                asyncio.run(difundir(sockets, eventos))
+            resultados.append((time.process_time() - inicio) * 1000 / reps)
+        antes, despues = resultados
+        print(f"{num_sockets:>8} | {antes:>12.3f} | {despues:>12.3f} | {antes / despues:>7.1f}x")
+    print("-" * 80)
+
+
+def _medir(funcion, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion()
+    return (time.perf_counter() - inicio) * 1000 / repeticiones
+
+
+def benchmark_reparto(repeticiones=200):
+    """Reparto de roles: bolsa compilada, una sala y lotes de salas"""
+    configuracion = Sala().get_configuracion_default()
+    motores = [('random', reparto.RepartidorAleatorio)]
+    if reparto.numpy is not None:
+        motores.append(('numpy', reparto.RepartidorNumpy))
+
+    def bolsa_antes(num_jugadores):
+        # Como antes en iniciar_partida: extend + relleno + shuffle global
+        bolsa = []
+        for rol, cantidad in configuracion.items():
+            bolsa.extend([rol] * cantidad)
+        if num_jugadores > len(bolsa):
+            bolsa.extend(['aldeano'] * (num_jugadores - len(bolsa)))
+        random.shuffle(bolsa)
+        return bolsa[:num_jugadores]
+
+    print("\n📊 Reparto de roles (ms por operación)")
+    print("=" * 80)
+    reparto._bolsa_compilada.cache_clear()
+    frio = _medir(lambda: reparto.compilar_bolsa(configuracion), 1)
+    caliente = _medir(lambda: reparto.compilar_bolsa(configuracion), repeticiones)
+    print(f"Compilar bolsa: fría {frio:.4f} | cacheada {caliente:.4f}")
+    print("-" * 80)
+
+    for num_jugadores in (10, 100, 1000):
+        fila = [f"Una sala de {num_jugadores:>4} jugadores | antes {_medir(lambda: bolsa_antes(num_jugadores), repeticiones):.4f}"]
+        for nombre, motor in motores:
+            repartidor = motor(semilla=1)
+            tiempo = _medir(lambda: repartidor.repartir(num_jugadores, configuracion), repeticiones)
+            fila.append(f"{nombre} {tiempo:.4f}")
+        print(' | '.join(fila))
+    print("-" * 80)
+
+    for num_salas in (100, 1000):
+        salas = [(12, configuracion)] * num_salas
+        fila = [f"Lote de {num_salas:>4} salas de 12"]
+        for nombre, motor in motores:
+            repartidor = motor(semilla=1)
+            tiempo = _medir(lambda: repartidor.repartir_lote(salas), max(1, repeticiones // 20))
+            fila.append(f"{nombre} {tiempo:.3f}")
+        print(' | '.join(fila))
+    print("-" * 80)
+
+
+def benchmark_codigos(repeticiones=200):
+    """Latencia de asignar un código: consulta por intento frente al conjunto en memoria"""
+    def codigo_antes():
+        # Como antes en Sala.generar_codigo: un exists() por intento
+        while True:
+            codigo = ''.join(random.choices(codigos.ALFABETO, k=codigos.LONGITUD))
+            if not Sala.objects.filter(codigo=codigo).exists():
+                return codigo
+
+    asignador = codigos.AsignadorCodigos()
+    print(f"\n📊 Asignación de códigos de sala ({Sala.objects.count()} salas en la BD)")
+    print("=" * 80)
+    carga = _medir(asignador._cargar, 1)
+    antes = _medir(codigo_antes, repeticiones)
+    despues = _medir(asignador.generar, repeticiones)
+    print(f"Carga inicial de códigos usados: {carga:.3f} ms (una vez por proceso)")
+    print(f"Por código: antes {antes:.4f} ms | después {despues:.4f} ms | {antes / despues:.1f}x")
+    print(f"Colisiones en memoria: {asignador.estadisticas['colisiones_memoria']}")
+    print("-" * 80)
+
+
+@contextmanager
+def _bd_de_prueba(directorio):
+    """Base de datos de prueba en un archivo de `directorio`, como la de verdad"""
+    from django.db import connection
+
+    connection.settings_dict['TEST']['NAME'] = os.path.join(directorio, 'bench.sqlite3')
+    nombre_bd = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(nombre_bd, verbosity=0)
+
+
+def benchmark_sesiones(repeticiones=200):
+    """Peticiones por segundo del flujo de unirse a una sala con cada motor de sesiones"""
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment
+
+    motores = {
+        'bd': 'django.contrib.sessions.backends.db',
+        'cache': 'django.contrib.sessions.backends.cached_db',
+        'archivo': 'django.contrib.sessions.backends.file',
+        'cookie': 'django.contrib.sessions.backends.signed_cookies',
+    }
+
+    def flujo(codigo, i):
+        # inicio -> enlace de la sala -> lobby -> recarga del lobby
+        cliente = Client()
+        cliente.post('/', {'nombre': f'Jugador {i}'})
+        cliente.get(f'/unirse/{codigo}/')
+        cliente.get(f'/lobby/{codigo}/')
+        cliente.get(f'/lobby/{codigo}/')
+        return 4
+
+    setup_test_environment()
+    with tempfile.TemporaryDirectory() as directorio, _bd_de_prueba(directorio):
+        print(f"\n📊 Flujo de unirse a una sala ({repeticiones} jugadores por motor)")
+        print("=" * 80)
+        print(f"{'Sesiones':>8} | {'Peticiones/s':>12} | {'Consultas de sesión':>20}")
+        print("-" * 80)
+        for nombre, motor in motores.items():
+            with override_settings(
+                SESSION_ENGINE=motor,
+                SESSION_FILE_PATH=directorio,
+                STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+            ):
+                lider = Client()
+                lider.post('/', {'nombre': 'Líder'})
+                codigo = lider.post('/pre_lobby/', {'accion': 'crear'}).url.strip('/').split('/')[-1]
+
+                peticiones = 0
+                inicio = time.perf_counter()
+                with CaptureQueriesContext(connection) as consultas:
+                    for i in range(repeticiones):
+                        peticiones += flujo(codigo, i)
+                segundos = time.perf_counter() - inicio
+                de_sesion = sum('django_session' in q['sql'] for q in consultas)
+                print(f"{nombre:>8} | {peticiones / segundos:>12.1f} | {de_sesion / peticiones:>20.2f}")
+        print("-" * 80)
+
+
+class _ClienteHTTP:
+    """Cliente HTTP/1.1 mínimo sobre asyncio, con cookies y token CSRF propios"""
+
+    def __init__(self, host, puerto):
+        self.host = host
+        self.puerto = puerto
+        # Django acepta un secreto CSRF elegido por el cliente si cookie y cabecera coinciden
+        csrf = secrets.token_hex(16)
+        self.cookies = {'csrftoken': csrf}
+        self.latencias = []
+
+    async def peticion(self, metodo, ruta, datos=None, cuerpo_json=None):
+        from urllib.parse import urlencode
+
+        if cuerpo_json is not None:
+            cuerpo, tipo = json.dumps(cuerpo_json).encode(), 'application/json'
+        else:
+            cuerpo, tipo = urlencode(datos or {}).encode(), 'application/x-www-form-urlencoded'
+        cabeceras = [
+            f'{metodo} {ruta} HTTP/1.1',
+            f'Host: {self.host}:{self.puerto}',
+            'Connection: close',
+            'Cookie: ' + '; '.join(f'{k}={v}' for k, v in self.cookies.items()),
+            f"X-CSRFToken: {self.cookies['csrftoken']}",
+        ]
+        if metodo == 'POST':
+            cabeceras += [
+                f'Content-Type: {tipo}',
+                f'Content-Length: {len(cuerpo)}',
+            ]
+        inicio = time.perf_counter()
+        lector, escritor = await asyncio.open_connection(self.host, self.puerto)
+        escritor.write(('\r\n'.join(cabeceras) + '\r\n\r\n').encode() + cuerpo)
+        await escritor.drain()
+        respuesta = await lector.read()
+        escritor.close()
+        self.latencias.append(time.perf_counter() - inicio)
+
+        cabecera, _, _ = respuesta.partition(b'\r\n\r\n')
+        lineas = cabecera.decode('latin-1').split('\r\n')
+        estado = int(lineas[0].split()[1])
+        ubicacion = None
+        for linea in lineas[1:]:
+            nombre, _, valor = linea.partition(': ')
+            if nombre.lower() == 'set-cookie':
+                clave, _, resto = valor.partition('=')
+                self.cookies[clave] = resto.split(';')[0]
+            elif nombre.lower() == 'location':
+                ubicacion = valor
+        return estado, ubicacion
+
+
+def _percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+async def _carga_vistas(puerto, clientes, recargas):
+    lider = _ClienteHTTP('127.0.0.1', puerto)
+    await lider.peticion('POST', '/', {'nombre': 'Líder'})
+    _, ubicacion = await lider.peticion('POST', '/pre_lobby/', {'accion': 'crear'})
+    codigo = ubicacion.strip('/').split('/')[-1]
+
+    async def jugador(i):
+        cliente = _ClienteHTTP('127.0.0.1', puerto)
+        await cliente.peticion('POST', '/', {'nombre': f'Jugador {i}'})
+        await cliente.peticion('GET', f'/unirse/{codigo}/')
+        for _ in range(recargas):
+            estado, _ = await cliente.peticion('GET', f'/lobby/{codigo}/')
+            if estado != 200:
+                raise RuntimeError(f'lobby devolvió {estado}')
+        return cliente.latencias
+
+    inicio = time.perf_counter()
+    resultados = await asyncio.gather(*(jugador(i) for i in range(clientes)))
+    segundos = time.perf_counter() - inicio
+    latencias = [l for r in resultados for l in r]
+    return latencias, len(latencias) / segundos
+
+
+def _esperar_puerto(puerto, proceso, espera=30):
+    import socket
+
+    limite = time.time() + espera
+    while time.time() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError('El servidor terminó al arrancar')
+        try:
+            socket.create_connection(('127.0.0.1', puerto), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('El servidor no arrancó a tiempo')
+
+
+@contextmanager
+def _servidor_daphne(**variables):
+    """Arranca daphne con una base de datos nueva; devuelve (puerto, proceso)"""
+    raiz = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directorio:
+        entorno = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{os.path.join(directorio, 'bench.sqlite3')}",
+            **variables,
+        )
+        subprocess.run([sys.executable, 'manage.py', 'migrate', '-v0'],
+                       cwd=raiz, env=entorno, check=True)
+        puerto = 8700 + secrets.randbelow(1000)
+        servidor = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(puerto),
+             'lobos.asgi:application'],
+            cwd=raiz, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            _esperar_puerto(puerto, servidor)
+            yield puerto, servidor
+        finally:
+            servidor.terminate()
+            servidor.wait()
+
+
+def benchmark_vistas(repeticiones=200, clientes=100):
+    """Latencia p50/p99 del flujo de unirse bajo daphne, con vistas síncronas y asíncronas"""
+    recargas = max(1, repeticiones // 100)
+
+    print(f"\n📊 Vistas bajo daphne: {clientes} clientes simultáneos "
+          f"(unirse + {recargas} recargas del lobby cada uno)")
+    print("=" * 80)
+    print(f"{'Vistas':>8} | {'p50 (ms)':>9} | {'p99 (ms)':>9} | {'Peticiones/s':>12}")
+    print("-" * 80)
+    for nombre, asincronas in (('sync', 'False'), ('async', 'True')):
+        with _servidor_daphne(VISTAS_ASYNC=asincronas) as (puerto, _):
+            latencias, por_segundo = asyncio.run(_carga_vistas(puerto, clientes, recargas))
+        print(f"{nombre:>8} | {statistics.median(latencias) * 1000:>9.1f} | "
+              f"{_percentil(latencias, 0.99) * 1000:>9.1f} | {por_segundo:>12.1f}")
+    print("-" * 80)
+
+
+# Carga de WebSockets del lobby
+
+class _Escucha:
+    """Un socket del lobby: anota cuándo llega cada tipo de mensaje"""
+
+    def __init__(self):
+        self.llegadas = defaultdict(list)
+        self.mensajes = 0
+        self._esperas = {}
+
+    def recibir(self, texto):
+        ahora = time.perf_counter()
+        tipo = json.loads(texto).get('tipo')
+        self.llegadas[tipo].append(ahora)
+        self.mensajes += 1
+        espera = self._esperas.pop(tipo, None)
+        if espera is not None and not espera.done():
+            espera.set_result(ahora)
+
+    async def esperar(self, tipo, desde, espera=30):
+        """Segundos desde `desde` hasta el primer mensaje `tipo` posterior"""
+        for llegada in self.llegadas[tipo]:
+            if llegada >= desde:
+                return llegada - desde
+        futuro = self._esperas[tipo] = asyncio.get_running_loop().create_future()
+        return await asyncio.wait_for(futuro, espera) - desde
+
+
+class _ClienteDjango:
+    """Misma interfaz que _ClienteHTTP sobre el cliente de pruebas de Django"""
+
+    def __init__(self):
+        from django.test import Client
+
+        self.cliente = Client()
+
+    async def peticion(self, metodo, ruta, datos=None, cuerpo_json=None):
+        from asgiref.sync import sync_to_async
+
+        if cuerpo_json is not None:
+            llamada = lambda: self.cliente.post(ruta, cuerpo_json, content_type='application/json')
+        else:
+            llamada = lambda: getattr(self.cliente, metodo.lower())(ruta, datos or {})
+        respuesta = await sync_to_async(llamada)()
+        return respuesta.status_code, respuesta.get('Location')
+
+
+def _abrir_en_proceso():
+    """Sockets con WebsocketCommunicator contra el router de WebSockets, sin servidor"""
+    from channels.routing import URLRouter
+    from channels.testing import WebsocketCommunicator
+    from juego.routing import websocket_urlpatterns
+
+    aplicacion = URLRouter(websocket_urlpatterns)
+
+    async def abrir(codigo, escucha):
+        comunicador = WebsocketCommunicator(aplicacion, f'/ws/lobby/{codigo}/')
+        conectado, _ = await comunicador.connect()
+        if not conectado:
+            raise RuntimeError(f'Conexión rechazada en la sala {codigo}')
+
+        async def leer():
+            while True:
+                mensaje = await comunicador.receive_output(timeout=3600)
+                if mensaje['type'] == 'websocket.close':
+                    return
+                escucha.recibir(mensaje['text'])
+        lector = asyncio.ensure_future(leer())
+
+        async def cerrar():
+            lector.cancel()
+            await comunicador.disconnect()
+        return cerrar
+    return abrir
+
+
+async def _leer_trama(lector):
+    """Lee una trama WebSocket del servidor (sin máscara): (opcode, datos)"""
+    cabecera = await lector.readexactly(2)
+    opcode, longitud = cabecera[0] & 0x0F, cabecera[1] & 0x7F
+    if longitud == 126:
+        longitud = int.from_bytes(await lector.readexactly(2), 'big')
+    elif longitud == 127:
+        longitud = int.from_bytes(await lector.readexactly(8), 'big')
+    return opcode, await lector.readexactly(longitud)
+
+
+def _trama(opcode, datos):
+    """Trama WebSocket del cliente (con máscara), para mensajes cortos"""
+    mascara = secrets.token_bytes(4)
+    return (bytes([0x80 | opcode, 0x80 | len(datos)]) + mascara
+            + bytes(b ^ mascara[i % 4] for i, b in enumerate(datos)))
+
+
+def _abrir_contra_daphne(puerto):
+    """
+    Sockets de verdad contra un daphne local, con un cliente WebSocket
+    mínimo sobre asyncio (el de autobahn no convive con twisted, que ya
+    carga daphne en este proceso)
+    """
+    import base64
+
+    async def abrir(codigo, escucha):
+        lector, escritor = await asyncio.open_connection('127.0.0.1', puerto)
+        escritor.write('\r\n'.join([
+            f'GET /ws/lobby/{codigo}/ HTTP/1.1',
+            f'Host: 127.0.0.1:{puerto}',
+            f'Origin: http://127.0.0.1:{puerto}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {base64.b64encode(secrets.token_bytes(16)).decode()}',
+            'Sec-WebSocket-Version: 13',
+        ]).encode() + b'\r\n\r\n')
+        respuesta = await lector.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in respuesta.split(b'\r\n')[0]:
+            raise RuntimeError(f'Conexión rechazada en la sala {codigo}')
+
+        async def leer():
+            while True:
+                opcode, datos = await _leer_trama(lector)
+                if opcode == 0x1:
+                    escucha.recibir(datos.decode())
+                elif opcode == 0x8:
+                    return
+                elif opcode == 0x9:
+                    escritor.write(_trama(0xA, datos))
+        lector_tarea = asyncio.ensure_future(leer())
+
+        async def cerrar():
+            escritor.write(_trama(0x8, (1000).to_bytes(2, 'big')))
+            await escritor.drain()
+            lector_tarea.cancel()
+            escritor.close()
+        return cerrar
+    return abrir
+
+
+def _memoria_kb(pid):
+    """Memoria residente (VmRSS) del proceso en KB, o None fuera de Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as estado:
+            for linea in estado:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1])
+    except OSError:
+        return None
+
+
+async def _unir_sala(nuevo_cliente, abrir, jugadores, metricas):
+    """El líder crea la sala y `jugadores` jugadores se unen y abren su socket"""
+    lider = nuevo_cliente()
+    await lider.peticion('POST', '/', {'nombre': 'Líder'})
+    _, ubicacion = await lider.peticion('POST', '/pre_lobby/', {'accion': 'crear'})
+    codigo = ubicacion.strip('/').split('/')[-1]
+
+    async def conectar():
+        escucha = _Escucha()
+        inicio = time.perf_counter()
+        cerrar = await abrir(codigo, escucha)
+        metricas['conexion'].append(await escucha.esperar('actualizar_jugadores', inicio))
+        return escucha, cerrar
+
+    async def unirse(i):
+        cliente = nuevo_cliente()
+        await cliente.peticion('POST', '/', {'nombre': f'Jugador {i}'})
+        await cliente.peticion('GET', f'/unirse/{codigo}/')
+        return await conectar()
+
+    sockets = [await conectar()]
+    sockets += await asyncio.gather(*(unirse(i) for i in range(jugadores)))
+    return {'codigo': codigo, 'lider': lider, 'sockets': sockets}
+
+
+async def _difundir_accion(sala, tipo, peticion, metricas):
+    """Lanza la acción del líder y mide cuánto tarda en llegar `tipo` a cada socket"""
+    inicio = time.perf_counter()
+    await peticion
+    latencias = await asyncio.gather(*(
+        escucha.esperar(tipo, inicio) for escucha, _ in sala['sockets']
+    ))
+    metricas[tipo].extend(latencias)
+
+
+async def _carga_websockets(nuevo_cliente, abrir, salas, jugadores, pid):
+    # Una sala de calentamiento, para que la memoria medida sea la de las conexiones
+    calentamiento = await _unir_sala(nuevo_cliente, abrir, 1, defaultdict(list))
+    for _, cerrar in calentamiento['sockets']:
+        await cerrar()
+
+    metricas = defaultdict(list)
+    memoria_inicial = _memoria_kb(pid)
+    inicio = time.perf_counter()
+
+    todas = await asyncio.gather(*(
+        _unir_sala(nuevo_cliente, abrir, jugadores, metricas) for _ in range(salas)
+    ))
+    # Que terminen de llegar las difusiones agrupadas de las uniones
+    await asyncio.sleep(0.5)
+    import gc
+    gc.collect()
+    memoria_conectados = _memoria_kb(pid)
+
+    configuracion = {'lobo': 2, 'vidente': 1, 'aldeano': 3}
+    await asyncio.gather(*(
+        _difundir_accion(sala, 'configuracion_actualizada', sala['lider'].peticion(
+            'POST', f"/guardar_configuracion/{sala['codigo']}/",
+            cuerpo_json={'configuracion': configuracion},
+        ), metricas)
+        for sala in todas
+    ))
+    await asyncio.gather(*(
+        _difundir_accion(sala, 'partida_iniciada', sala['lider'].peticion(
+            'GET', f"/iniciar_partida/{sala['codigo']}/",
+        ), metricas)
+        for sala in todas
+    ))
+    segundos = time.perf_counter() - inicio
+
+    sockets = [socket for sala in todas for socket in sala['sockets']]
+    mensajes = sum(escucha.mensajes for escucha, _ in sockets)
+    for _, cerrar in sockets:
+        await cerrar()
+
+    memoria = None
+    if memoria_inicial is not None and memoria_conectados is not None:
+        memoria = (memoria_conectados - memoria_inicial) / len(sockets)
+    return {
+        'sockets': len(sockets),
+        'conexion': metricas['conexion'],
+        'configuracion': metricas['configuracion_actualizada'],
+        'inicio': metricas['partida_iniciada'],
+        'mensajes_por_segundo': mensajes / segundos,
+        'memoria_kb_por_conexion': memoria,
+    }
+
+
+def _imprimir_carga_websockets(resultado):
+    print(f"{'Medida':>24} | {'p50 (ms)':>9} | {'p99 (ms)':>9} | {'máx (ms)':>9}")
+    print("-" * 80)
+    for nombre, clave in (('Conexión', 'conexion'), ('Difusión configuración', 'configuracion'),
+                          ('Difusión inicio', 'inicio')):
+        valores = resultado[clave]
+        print(f"{nombre:>24} | {statistics.median(valores) * 1000:>9.1f} | "
+              f"{_percentil(valores, 0.99) * 1000:>9.1f} | {max(valores) * 1000:>9.1f}")
+    print("-" * 80)
+    print(f"Mensajes recibidos por segundo (toda la prueba): {resultado['mensajes_por_segundo']:.0f}")
+    if resultado['memoria_kb_por_conexion'] is not None:
+        print(f"Memoria por conexión: {resultado['memoria_kb_por_conexion']:.1f} KB")
+    print("-" * 80)
+
+
+def benchmark_websockets(salas=20, jugadores=10, modo='proceso'):
+    """
+    Carga del LobbyConsumer: `salas` salas de `jugadores` jugadores que se
+    unen, cambian la configuración y empiezan la partida a la vez. Mide la
+    latencia de conexión y de difusión (p50/p99), los mensajes por segundo
+    y la memoria por conexión. `modo` 'proceso' usa WebsocketCommunicator
+    en este proceso (memoria de clientes y servidor juntos); 'daphne',
+    sockets reales contra un daphne local (memoria solo del servidor).
+    """
+    print(f"\n📊 Carga de WebSockets del lobby ({modo}): {salas} salas de "
+          f"{jugadores} jugadores + líder")
+    print("=" * 80)
+    if modo == 'proceso':
+        from django.test.utils import override_settings, setup_test_environment
+
+        setup_test_environment()
+        with tempfile.TemporaryDirectory() as directorio, _bd_de_prueba(directorio), override_settings(
+            STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+        ):
+            resultado = asyncio.run(_carga_websockets(
+                _ClienteDjango, _abrir_en_proceso(), salas, jugadores, os.getpid()
+            ))
+    else:
+        with _servidor_daphne() as (puerto, servidor):
+            resultado = asyncio.run(_carga_websockets(
+                lambda: _ClienteHTTP('127.0.0.1', puerto), _abrir_contra_daphne(puerto),
+                salas, jugadores, servidor.pid
+            ))
+    _imprimir_carga_websockets(resultado)
+    return resultado
+
+
+# Flujo completo de vistas: crear -> unirse -> configurar -> empezar
+
+# Respuesta esperada de cada paso del flujo
+PASOS_FLUJO = {
+    'inicio_get': 200,
+    'inicio_post': 302,
+    'pre_lobby_get': 200,
+    'pre_lobby_crear': 302,
+    'unirse_directo': 302,
+    'lobby': 200,
+    'guardar_configuracion': 200,
+    'iniciar_partida': 302,
+}
+
+
+class _Cronometro:
+    """Tiempo y consultas de cada petición, agrupados por paso del flujo"""
+
+    def __init__(self):
+        self.tiempos = defaultdict(list)
+        self.consultas = defaultdict(list)
+
+    def medir(self, paso, peticion):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as consultas:
+            inicio = time.perf_counter()
+            respuesta = peticion()
+            self.tiempos[paso].append(time.perf_counter() - inicio)
+        self.consultas[paso].append(len(consultas))
+        if respuesta.status_code != PASOS_FLUJO[paso]:
+            raise RuntimeError(f'{paso} devolvió {respuesta.status_code}')
+        return respuesta
+
+    def informe(self):
+        return {
+            paso: {
+                'peticiones': len(self.tiempos[paso]),
+                'p50_ms': round(statistics.median(self.tiempos[paso]) * 1000, 3),
+                'p99_ms': round(_percentil(self.tiempos[paso], 0.99) * 1000, 3),
+                'consultas_media': round(statistics.mean(self.consultas[paso]), 2),
+                'consultas_max': max(self.consultas[paso]),
+            }
+            for paso in PASOS_FLUJO if self.tiempos[paso]
+        }
+
+
+def _poblar(salas, jugadores):
+    """Crea `salas` salas sintéticas de `jugadores` jugadores con bulk_create"""
+    from juego.models import Jugador
+
+    usados = set(Sala.objects.values_list('codigo', flat=True))
+    nuevos = set()
+    while len(nuevos) < salas:
+        codigo = ''.join(random.choices(codigos.ALFABETO, k=codigos.LONGITUD))
+        if codigo not in usados:
+            nuevos.add(codigo)
+    configuracion = Sala().get_configuracion_default()
+    Sala.objects.bulk_create(
+        [Sala(codigo=codigo, configuracion_roles=configuracion) for codigo in nuevos],
+        batch_size=500,
+    )
+    ids = Sala.objects.filter(codigo__in=nuevos).values_list('id', flat=True).iterator()
+    Jugador.objects.bulk_create(
+        [
+            Jugador(session_id=f'sintetico-{id_sala}-{j}', nombre=f'Jugador {j}',
+                    sala_id=id_sala, es_lider=j == 0)
+            for id_sala in ids for j in range(jugadores)
+        ],
+        batch_size=1000,
+    )
+
+
+def _flujo_completo(cronometro, jugadores):
+    from django.test import Client
+
+    lider = Client()
+    cronometro.medir('inicio_get', lambda: lider.get('/'))
+    cronometro.medir('inicio_post', lambda: lider.post('/', {'nombre': 'Líder'}))
+    cronometro.medir('pre_lobby_get', lambda: lider.get('/pre_lobby/'))
+    codigo = cronometro.medir(
+        'pre_lobby_crear', lambda: lider.post('/pre_lobby/', {'accion': 'crear'})
+    ).url.strip('/').split('/')[-1]
+    cronometro.medir('lobby', lambda: lider.get(f'/lobby/{codigo}/'))
+
+    for i in range(jugadores):
+        cliente = Client()
+        cronometro.medir('inicio_post', lambda: cliente.post('/', {'nombre': f'Jugador {i}'}))
+        cronometro.medir('unirse_directo', lambda: cliente.get(f'/unirse/{codigo}/'))
+        cronometro.medir('lobby', lambda: cliente.get(f'/lobby/{codigo}/'))
+
+    # El resto de jugadores se rellena con aldeanos al repartir
+    configuracion = {'lobo': 2, 'vidente': 1, 'aldeano': 3}
+    cronometro.medir('guardar_configuracion', lambda: lider.post(
+        f'/guardar_configuracion/{codigo}/', {'configuracion': configuracion},
+        content_type='application/json',
+    ))
+    cronometro.medir('iniciar_partida', lambda: lider.get(f'/iniciar_partida/{codigo}/'))
+    cronometro.medir('lobby', lambda: lider.get(f'/lobby/{codigo}/'))
+
+
+def _comparar_con_base(informe, base, tolerancia):
+    """Regresiones frente a `base`: más consultas o p50 más de `tolerancia` peor"""
+    regresiones = []
+    for paso, actual in informe['pasos'].items():
+        previo = base.get('pasos', {}).get(paso)
+        if previo is None:
+            continue
+        if actual['consultas_max'] > previo['consultas_max']:
+            regresiones.append(
+                f"{paso}: {previo['consultas_max']} -> {actual['consultas_max']} consultas"
+            )
+        # Menos de 1 ms de diferencia es ruido de la máquina
+        if (actual['p50_ms'] > previo['p50_ms'] * (1 + tolerancia)
+                and actual['p50_ms'] - previo['p50_ms'] > 1):
+            regresiones.append(
+                f"{paso}: p50 {previo['p50_ms']:.2f} -> {actual['p50_ms']:.2f} ms"
+            )
+    return regresiones
+
+
+def benchmark_flujo(repeticiones=200, jugadores=10, salas_sinteticas=1000,
+                    informe=None, base=None, tolerancia=0.25):
+    """
+    Flujo completo de las vistas (inicio, pre_lobby, unirse_directo, lobby,
+    guardar_configuracion_roles, iniciar_partida) en una base de datos de
+    prueba con `salas_sinteticas` salas ya creadas. Mide tiempo y consultas
+    por petición, guarda el informe JSON en `informe` y lo compara con el
+    de `base`. Devuelve False si hay regresiones.
+    """
+    from django.conf import settings
+    from django.test.utils import override_settings, setup_test_environment
+
+    flujos = max(1, repeticiones // 10)
+    setup_test_environment()
+    with tempfile.TemporaryDirectory() as directorio, _bd_de_prueba(directorio), override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    ):
+        _poblar(salas_sinteticas, jugadores)
+        cronometro = _Cronometro()
+        # Un flujo de calentamiento (plantillas, códigos usados, conexiones)
+        _flujo_completo(_Cronometro(), jugadores)
+        for _ in range(flujos):
+            _flujo_completo(cronometro, jugadores)
+
+    resultado = {
+        'parametros': {
+            'flujos': flujos,
+            'jugadores': jugadores,
+            'salas_sinteticas': salas_sinteticas,
+            'sesiones': settings.SESSION_ENGINE,
+            'vistas_async': settings.VISTAS_ASYNC,
+        },
+        'pasos': cronometro.informe(),
+    }
+
+    print(f"\n📊 Flujo completo de vistas: {flujos} salas de {jugadores} jugadores + líder "
+          f"({salas_sinteticas} salas sintéticas en la BD)")
+    print("=" * 80)
+    print(f"{'Paso':>22} | {'Peticiones':>10} | {'p50 (ms)':>9} | {'p99 (ms)':>9} | {'Consultas':>9}")
+    print("-" * 80)
+    for paso, datos in resultado['pasos'].items():
+        print(f"{paso:>22} | {datos['peticiones']:>10} | {datos['p50_ms']:>9.2f} | "
+              f"{datos['p99_ms']:>9.2f} | {datos['consultas_max']:>9}")
+    print("-" * 80)
+
+    if informe:
+        with open(informe, 'w') as archivo:
+            json.dump(resultado, archivo, indent=2, ensure_ascii=False)
+        print(f"Informe guardado en {informe}")
+
+    if base:
+        with open(base) as archivo:
+            regresiones = _comparar_con_base(resultado, json.load(archivo), tolerancia)
+        if regresiones:
+            print(f"❌ Regresiones frente a {base}:")
+            for regresion in regresiones:
+                print(f"   - {regresion}")
+            return False
+        print(f"✅ Sin regresiones frente a {base}")
+    return True
+
+
+def _sala_con_clientes(jugadores):
+    """Líder y `jugadores` navegadores unidos a una sala nueva por las vistas"""
+    from django.test import Client
+
+    lider = Client()
+    lider.post('/', {'nombre': 'Líder'})
+    codigo = lider.post('/pre_lobby/', {'accion': 'crear'}).url.strip('/').split('/')[-1]
+    clientes = [lider]
+    for i in range(jugadores):
+        cliente = Client()
+        cliente.post('/', {'nombre': f'Jugador {i}'})
+        cliente.get(f'/unirse/{codigo}/')
+        clientes.append(cliente)
+    return codigo, clientes
+
+
+def _medir_inicio(codigo, clientes, recargar, capa):
+    """Consultas, tiempo y bytes del servidor para un inicio de partida"""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from juego import metricas
+
+    lider = clientes[0]
+    bytes_socket = [0]
+    group_send = metricas.group_send
+
+    async def contar(channel_layer, grupo, evento, tipo):
+        bytes_socket[0] += sum(len(texto.encode()) for texto in evento['textos'])
+        await group_send(capa, grupo, evento, tipo)
+
+    metricas.group_send = contar
+    try:
+        with CaptureQueriesContext(connection) as consultas:
+            inicio = time.perf_counter()
+            if recargar:
+                # Como antes: fetch sigue la redirección y cada navegador
+                # recarga el lobby al recibir 'partida_iniciada'
+                respuestas = [lider.get(f'/iniciar_partida/{codigo}/', follow=True)]
+                respuestas += [c.get(f'/lobby/{codigo}/') for c in clientes[1:]]
+            else:
+                respuestas = [lider.get(f'/iniciar_partida/{codigo}/',
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')]
+            segundos = time.perf_counter() - inicio
+    finally:
+        metricas.group_send = group_send
+    return {
+        'peticiones': len(respuestas) + (1 if recargar else 0),
+        'consultas': len(consultas),
+        'ms': segundos * 1000,
+        'bytes_http': sum(len(r.content) for r in respuestas),
+        'bytes_socket': bytes_socket[0],
+    }
+
+
+def benchmark_inicio_partida(repeticiones=200, jugadores=10):
+    """
+    Trabajo del servidor por inicio de partida: recargando el lobby en cada
+    navegador (antes) o enviando a cada jugador su rol por el socket (ahora)
+    """
+    from channels.layers import InMemoryChannelLayer
+    from django.test.utils import override_settings, setup_test_environment
+
+    partidas = max(1, repeticiones // 20)
+    setup_test_environment()
+    resultados = {'recarga': [], 'socket': []}
+    with tempfile.TemporaryDirectory() as directorio, _bd_de_prueba(directorio), override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    ):
+        capa = InMemoryChannelLayer()
+        # Calentamiento: plantillas y conexiones
+        _medir_inicio(*_sala_con_clientes(jugadores), True, capa)
+        for _ in range(partidas):
+            for modo in resultados:
+                codigo, clientes = _sala_con_clientes(jugadores)
+                resultados[modo].append(_medir_inicio(codigo, clientes, modo == 'recarga', capa))
+
+    print(f"\n📊 Inicio de partida: {partidas} salas de {jugadores} jugadores + líder")
+    print("=" * 80)
+    print(f"{'Modo':>10} | {'Peticiones':>10} | {'Consultas':>9} | {'p50 (ms)':>9} | "
+          f"{'HTTP (KB)':>9} | {'Socket (KB)':>11}")
+    print("-" * 80)
+    for modo, medidas in resultados.items():
+        print(f"{modo:>10} | {medidas[0]['peticiones']:>10} | "
+              f"{statistics.median(m['consultas'] for m in medidas):>9.0f} | "
+              f"{statistics.median(m['ms'] for m in medidas):>9.2f} | "
+              f"{statistics.median(m['bytes_http'] for m in medidas) / 1024:>9.1f} | "
+              f"{statistics.median(m['bytes_socket'] for m in medidas) / 1024:>11.2f}")
+    print("-" * 80)
+
+
+def _bytes_recurso(raiz, ruta):
+    """Bytes de un archivo de STATIC_ROOT sin comprimir, con gzip y con brotli"""
+    archivo = os.path.join(raiz, ruta)
+    tamanos = {'identidad': os.path.getsize(archivo)}
+    for codificacion, extension in (('gzip', '.gz'), ('br', '.br')):
+        # whitenoise solo guarda la versión comprimida si ahorra algo
+        if os.path.exists(archivo + extension):
+            tamanos[codificacion] = os.path.getsize(archivo + extension)
+        else:
+            tamanos[codificacion] = tamanos['identidad'] if codificacion == 'gzip' else None
+    return tamanos
+
+
+def benchmark_paginas():
+    """
+    Bytes transferidos por página (inicio, pre_lobby, lobby): HTML y
+    recursos estáticos que enlaza, en la primera visita y en las siguientes
+    (con los recursos versionados ya en la caché del navegador)
+    """
+    import re
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test import Client
+    from django.test.utils import override_settings, setup_test_environment
+
+    setup_test_environment()
+    with tempfile.TemporaryDirectory() as directorio, _bd_de_prueba(directorio), override_settings(
+        STATIC_ROOT=os.path.join(directorio, 'static'),
+    ):
+        call_command('collectstatic', interactive=False, verbosity=0)
+        codigo, (lider, jugador) = _sala_con_clientes(1)
+        paginas = {
+            'inicio': (Client(), '/'),
+            'pre_lobby': (jugador, '/pre_lobby/'),
+            'lobby': (jugador, f'/lobby/{codigo}/'),
+        }
+        enlace = re.compile(r'(?:href|src)="' + re.escape(settings.STATIC_URL) + r'([^"]+)"')
+        resultados = {}
+        for nombre, (cliente, url) in paginas.items():
+            plano = cliente.get(url).content
+            comprimido = cliente.get(url, HTTP_ACCEPT_ENCODING='gzip, br').content
+            recursos = [
+                _bytes_recurso(settings.STATIC_ROOT, ruta)
+                for ruta in set(enlace.findall(plano.decode()))
+                if not ruta.endswith('.ico')
+            ]
+            mejor = sum(r['br'] or r['gzip'] for r in recursos)
+            resultados[nombre] = {
+                'html': len(plano),
+                'html_comprimido': len(comprimido),
+                'recursos': sum(r['identidad'] for r in recursos),
+                'recursos_comprimidos': mejor,
+                'primera_visita': len(comprimido) + mejor,
+                'siguientes': len(comprimido),
+            }
+
+    print("\n📊 Bytes transferidos por página (navegador con gzip/brotli)")
+    print("=" * 80)
+    print(f"{'Página':>10} | {'HTML':>8} | {'HTML comp.':>10} | {'Estáticos':>9} | "
+          f"{'Est. comp.':>10} | {'1ª visita':>9} | {'Siguientes':>10}")
+    print("-" * 80)
+    for nombre, datos in resultados.items():
+        print(f"{nombre:>10} | {datos['html']:>8} | {datos['html_comprimido']:>10} | "
+              f"{datos['recursos']:>9} | {datos['recursos_comprimidos']:>10} | "
+              f"{datos['primera_visita']:>9} | {datos['siguientes']:>10}")
+    print("-" * 80)
+
+
+def _deflate(texto):
+    # Como permessage-deflate sin reutilizar el contexto entre mensajes
+    compresor = zlib.compressobj(6, zlib.DEFLATED, -11)
+    return len(compresor.compress(texto.encode()) + compresor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def benchmark_protocolo(repeticiones=200):
+    """Tamaño y coste de codificar/decodificar: protocolo JSON frente al compacto"""
+    from juego import protocolo
+
+    roles = protocolo.ROLES
+    mensajes = {}
+    for n in (10, 50):
+        jugadores = [
+            {'id': i, 'nombre': f'Jugador {i}', 'es_lider': i == 1, 'rol': roles[i % len(roles)]}
+            for i in range(1, n + 1)
+        ]
+        mensajes[f'estado ({n})'] = protocolo.mensaje_estado(
+            {'epoca': secrets.token_hex(4), 'version': n, 'jugadores': jugadores}
+        )
+        mensajes[f'roles_asignados ({n})'] = protocolo.mensaje_roles_asignados(jugadores)
+        mensajes[f'presencia ({n})'] = protocolo.mensaje_presencia(
+            {j['id']: 'conectado' for j in jugadores}
+        )
+    mensajes['cambios (5)'] = protocolo.mensaje_cambios('abcd1234', [
+        {'evento': 'unido', 'version': v, 'jugador': {'id': v, 'nombre': f'Jugador {v}',
+                                                      'es_lider': False, 'rol': 'aldeano'}}
+        for v in range(1, 6)
+    ])
+    mensajes['configuracion'] = protocolo.mensaje_configuracion(Sala().get_configuracion_default())
+    mensajes['tu_rol'] = protocolo.mensaje_tu_rol('lobo_albino')
+
+    print(f"\n📊 Protocolo JSON frente al compacto ({repeticiones} repeticiones)")
+    print("=" * 118)
+    print(f"{'Mensaje':>22} | {'JSON B':>7} | {'Comp. B':>7} | {'JSON+defl':>9} | {'Comp.+defl':>10} | "
+          f"{'Transcod. µs':>12} | {'Dec. JSON µs':>12} | {'Dec. comp. µs':>13}")
+    print("-" * 118)
+    for nombre, texto in mensajes.items():
+        compacto = protocolo.compactar(texto)
+        transcodificar = _medir(lambda: protocolo.compactar.__wrapped__(texto), repeticiones)
+        decodificar_json = _medir(lambda: json.loads(texto), repeticiones)
+        decodificar_compacto = _medir(lambda: protocolo.descompactar(compacto), repeticiones)
+        print(f"{nombre:>22} | {len(texto.encode()):>7} | {len(compacto.encode()):>7} | "
+              f"{_deflate(texto):>9} | {_deflate(compacto):>10} | {transcodificar * 1000:>12.1f} | "
+              f"{decodificar_json * 1000:>12.1f} | {decodificar_compacto * 1000:>13.1f}")
+    print("-" * 118)
+    print("Transcod.: del texto JSON al compacto sin la caché (una vez por mensaje y proceso)")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks del juego Los Lobos')
+    parser.add_argument('accion', choices=['difusion', 'reparto', 'codigos', 'sesiones', 'vistas', 'websockets', 'flujo',
+                                           'inicio_partida', 'paginas', 'protocolo'],
+                        help='Benchmark a ejecutar')
+    parser.add_argument('--repeticiones', type=int, default=200,
+                        help='Repeticiones base de cada medición')
+    parser.add_argument('--clientes', type=int, default=100,
+                        help='Clientes simultáneos (vistas)')
+    parser.add_argument('--salas', type=int, default=20,
+                        help='Salas simultáneas (websockets)')
+    parser.add_argument('--jugadores', type=int, default=10,
+                        help='Jugadores por sala, además del líder (websockets, flujo, inicio_partida)')
+    parser.add_argument('--modo', choices=['proceso', 'daphne'], default='proceso',
+                        help='WebsocketCommunicator en este proceso o sockets contra daphne (websockets)')
+    parser.add_argument('--salas-sinteticas', type=int, default=1000,
+                        help='Salas creadas en la BD antes de medir (flujo)')
+    parser.add_argument('--informe', help='Guardar el informe JSON en esta ruta (flujo)')
+    parser.add_argument('--base', help='Informe JSON con el que comparar; falla si hay regresiones (flujo)')
+    parser.add_argument('--tolerancia', type=float, default=0.25,
+                        help='Empeoramiento del p50 tolerado frente a la base (flujo)')
+
+    args = parser.parse_args()
+
+    if args.accion == 'difusion':
+        benchmark_difusion(args.repeticiones)
+    
+    elif args.accion == 'reparto':
+        benchmark_reparto(args.repeticiones)
+
+    elif args.accion == 'codigos':
+        benchmark_codigos(args.repeticiones)
+
+    elif args.accion == 'sesiones':
+        benchmark_sesiones(args.repeticiones)
+
+    elif args.accion == 'vistas':
+        benchmark_vistas(args.repeticiones, args.clientes)
+
+    elif args.accion == 'websockets':
+        benchmark_websockets(args.salas, args.jugadores, args.modo)
+
+    elif args.accion == 'flujo':
+        correcto = benchmark_flujo(args.repeticiones, args.jugadores, args.salas_sinteticas,
+                                   args.informe, args.base, args.tolerancia)
+        sys.exit(0 if correcto else 1)
+
+    elif args.accion == 'inicio_partida':
+        benchmark_inicio_partida(args.repeticiones, args.jugadores)
+
+    elif args.accion == 'paginas':
+        benchmark_paginas()
+
+    elif args.accion == 'protocolo':
+        benchmark_protocolo(args.repeticiones)
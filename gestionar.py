@@ -3,8 +3,13 @@
 Script de utilidad para gestionar el juego Los Lobos
 """
 
+import csv
+import json
 import os
 import sys
+import time
+from datetime import timedelta
+
 import django
 
 # Configurar Django
@@ -12,135 +17,286 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lobos.settings')
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 django.setup()
 
+from django.db.models import Count, F
+from django.utils import timezone
+
+from juego import cache_salas
+from juego.limpieza import borrar_lote_jugadores_sin_sala, borrar_lote_salas
 from juego.models import Jugador, Sala
 
-def limpiar_todo():
-    """Elimina todas las salas y jugadores de la base de datos"""
-    num_jugadores = Jugador.objects.count()
-    num_salas = Sala.objects.count()
-    
-    Jugador.objects.all().delete()
-    Sala.objects.all().delete()
-    
-    print(f"✅ Se eliminaron {num_salas} sala(s) y {num_jugadores} jugador(es)")
-
-def listar_salas():
-    """Lista todas las salas activas"""
+# Filas que se leen de la base de datos (o se borran) de cada vez
+LOTE = 500
+
+NOMBRES_ROLES = dict(Jugador.ROLES)
+
+CAMPOS_SALA = ['codigo', 'num_jugadores', 'partida_iniciada', 'creada_en', 'actividad', 'configuracion_roles']
+CAMPOS_JUGADOR = ['nombre', 'codigo_sala', 'rol', 'esta_vivo', 'es_lider']
+
+
+def filtrar_salas(iniciadas=None, inactivas_min=None, antiguas_h=None):
+    """
+    Salas según el estado de la partida (`iniciadas` True/False), sin
+    actividad desde hace `inactivas_min` minutos o creadas hace más de
+    `antiguas_h` horas
+    """
     salas = Sala.objects.all()
-    if not salas:
-        print("No hay salas en la base de datos")
-        return
-    
-    print(f"\n📋 Salas Activas ({salas.count()}):")
-    print("=" * 80)
-    for sala in salas:
-        estado = "🟢 Iniciada" if sala.partida_iniciada else "⏳ Esperando"
-        num_jugadores = sala.jugadores.count()
-        
-        # Calcular total de roles configurados
-        config = sala.configuracion_roles or {}
-        total_roles = sum(config.values()) if config else 0
-        
-        print(f"Código: {sala.codigo} | Jugadores: {num_jugadores} | Estado: {estado}")
-        print(f"Creada: {sala.creada_en.strftime('%d/%m/%Y %H:%M:%S')}")
-        
-        if config:
-            print(f"Configuración de roles (Total: {total_roles}):")
-            roles_activos = {k: v for k, v in config.items() if v > 0}
-            if roles_activos:
-                for rol, cant in roles_activos.items():
-                    print(f"  - {rol.replace('_', ' ').title()}: {cant}")
-            else:
-                print("  (Sin roles configurados)")
-        
-        print("-" * 80)
-
-def listar_jugadores(codigo_sala=None):
-    """Lista todos los jugadores, opcionalmente filtrados por sala"""
+    ahora = timezone.now()
+    if iniciadas is not None:
+        salas = salas.filter(partida_iniciada=iniciadas)
+    if inactivas_min is not None:
+        salas = salas.filter(actividad__lt=ahora - timedelta(minutes=inactivas_min))
+    if antiguas_h is not None:
+        salas = salas.filter(creada_en__lt=ahora - timedelta(hours=antiguas_h))
+    return salas
+
+
+class Salida:
+    """Escribe filas como texto, JSON o CSV sin acumularlas en memoria"""
+
+    def __init__(self, formato, campos, destino=None):
+        self.formato = formato
+        self.campos = campos
+        self.destino = destino or sys.stdout
+        self.filas = 0
+        if formato == 'csv':
+            self.csv = csv.DictWriter(self.destino, fieldnames=campos, extrasaction='ignore')
+            self.csv.writeheader()
+        elif formato == 'json':
+            self.destino.write('[')
+
+    def escribir(self, fila, texto):
+        if self.formato == 'texto':
+            self.destino.write(texto() + '\n')
+        elif self.formato == 'csv':
+            self.csv.writerow({
+                campo: json.dumps(valor) if isinstance(valor, dict) else valor
+                for campo, valor in fila.items()
+            })
+        else:
+            separador = ',\n ' if self.filas else '\n '
+            self.destino.write(separador + json.dumps(fila, default=str, ensure_ascii=False))
+        self.filas += 1
+
+    def cerrar(self):
+        if self.formato == 'json':
+            self.destino.write('\n]\n' if self.filas else ']\n')
+
+
+def limpiar_todo(salas=None, lote=LOTE):
+    """Elimina las salas (todas, o las del queryset `salas`) y sus jugadores por lotes"""
+    filtradas = salas is not None
+    salas = Sala.objects.all() if salas is None else salas
+    inicio = time.perf_counter()
+    total = {'salas': 0, 'jugadores': 0, 'jugadores_sin_sala': 0}
+
+    pasos = [lambda: borrar_lote_salas(salas, lote)]
+    if not filtradas:
+        pasos.append(lambda: borrar_lote_jugadores_sin_sala(lote))
+    for paso in pasos:
+        hay_mas = True
+        while hay_mas:
+            contadores, hay_mas = paso()
+            for clave, valor in contadores.items():
+                total[clave] += valor
+            print(
+                f"\r   … {total['salas']} sala(s) y "
+                f"{total['jugadores'] + total['jugadores_sin_sala']} jugador(es) eliminados",
+                end='', file=sys.stderr, flush=True
+            )
+    print(file=sys.stderr)
+
+    print(f"✅ Se eliminaron {total['salas']} sala(s) y "
+          f"{total['jugadores'] + total['jugadores_sin_sala']} jugador(es) "
+          f"en {time.perf_counter() - inicio:.1f} s")
+
+
+def listar_salas(salas=None, formato='texto', lote=LOTE, destino=None):
+    """Lista las salas (todas, o las del queryset `salas`) con su número de jugadores"""
+    salas = Sala.objects.all() if salas is None else salas
+    # Una sola consulta, leída por partes: el recuento va en la propia consulta
+    filas = (
+        salas.annotate(num_jugadores=Count('jugadores'))
+        .order_by('id')
+        .values(*CAMPOS_SALA)
+        .iterator(chunk_size=lote)
+    )
+    salida = Salida(formato, CAMPOS_SALA, destino)
+    if formato == 'texto':
+        salida.destino.write("\n📋 Salas:\n" + "=" * 80 + "\n")
+
+    for fila in filas:
+        salida.escribir(fila, lambda: _texto_sala(fila))
+    salida.cerrar()
+
+    if formato == 'texto':
+        if salida.filas:
+            salida.destino.write(f"Total: {salida.filas} sala(s)\n")
+        else:
+            salida.destino.write("No hay salas en la base de datos\n")
+
+
+def _texto_sala(sala):
+    estado = "🟢 Iniciada" if sala['partida_iniciada'] else "⏳ Esperando"
+    lineas = [
+        f"Código: {sala['codigo']} | Jugadores: {sala['num_jugadores']} | Estado: {estado}",
+        f"Creada: {sala['creada_en'].strftime('%d/%m/%Y %H:%M:%S')} | "
+        f"Última actividad: {sala['actividad'].strftime('%d/%m/%Y %H:%M:%S')}",
+    ]
+
+    # Calcular total de roles configurados
+    config = sala['configuracion_roles'] or {}
+    if config:
+        lineas.append(f"Configuración de roles (Total: {sum(config.values())}):")
+        roles_activos = {k: v for k, v in config.items() if v > 0}
+        if roles_activos:
+            for rol, cant in roles_activos.items():
+                lineas.append(f"  - {rol.replace('_', ' ').title()}: {cant}")
+        else:
+            lineas.append("  (Sin roles configurados)")
+
+    lineas.append("-" * 80)
+    return "\n".join(lineas)
+
+
+def _error(mensaje):
+    # A stderr: no se mezcla con la salida JSON/CSV de los listados
+    print(f"❌ Error: {mensaje}", file=sys.stderr)
+
+
+def listar_jugadores(codigo_sala=None, salas=None, formato='texto', lote=LOTE, destino=None):
+    """Lista todos los jugadores, opcionalmente filtrados por sala (False si la sala no existe)"""
+    jugadores = Jugador.objects.all()
     if codigo_sala:
-        try:
-            sala = Sala.objects.get(codigo=codigo_sala.upper())
-            jugadores = sala.jugadores.all()
-            print(f"\n📋 Jugadores de la Sala {sala.codigo} ({jugadores.count()}):")
-        except Sala.DoesNotExist:
-            print(f"❌ Error: No existe la sala con código {codigo_sala}")
-            return
+        codigo_sala = codigo_sala.upper()
+        if not Sala.objects.filter(codigo=codigo_sala).exists():
+            _error(f"No existe la sala con código {codigo_sala}")
+            return False
+        jugadores = jugadores.filter(sala__codigo=codigo_sala)
+        titulo = f"Jugadores de la Sala {codigo_sala}"
+    elif salas is not None:
+        jugadores = jugadores.filter(sala__in=salas)
+        titulo = "Jugadores de las salas filtradas"
     else:
-        jugadores = Jugador.objects.all()
-        print(f"\n📋 Todos los Jugadores ({jugadores.count()}):")
-    
-    if not jugadores:
-        print("No hay jugadores")
-        return
-    
-    print("-" * 80)
-    for j in jugadores:
-        estado = "💚 Vivo" if j.esta_vivo else "💀 Muerto"
-        lider = "👑" if j.es_lider else "  "
-        sala_info = j.sala.codigo if j.sala else "Sin sala"
-        print(f"{lider} {j.nombre:20} | Sala: {sala_info:8} | Rol: {j.get_rol_display():15} | {estado}")
-    print("-" * 80)
+        titulo = "Todos los Jugadores"
+
+    # El código de la sala viene en la misma consulta (join), no una consulta por jugador
+    filas = (
+        jugadores.order_by('id')
+        .values('nombre', 'rol', 'esta_vivo', 'es_lider', codigo_sala=F('sala__codigo'))
+        .iterator(chunk_size=lote)
+    )
+    salida = Salida(formato, CAMPOS_JUGADOR, destino)
+    if formato == 'texto':
+        salida.destino.write(f"\n📋 {titulo}:\n" + "-" * 80 + "\n")
+
+    for fila in filas:
+        salida.escribir(fila, lambda: _texto_jugador(fila))
+    salida.cerrar()
+
+    if formato == 'texto':
+        if salida.filas:
+            salida.destino.write("-" * 80 + f"\nTotal: {salida.filas} jugador(es)\n")
+        else:
+            salida.destino.write("No hay jugadores\n")
+    return True
+
+
+def _texto_jugador(j):
+    estado = "💚 Vivo" if j['esta_vivo'] else "💀 Muerto"
+    lider = "👑" if j['es_lider'] else "  "
+    sala_info = j['codigo_sala'] or "Sin sala"
+    rol = NOMBRES_ROLES.get(j['rol'], j['rol'])
+    return f"{lider} {j['nombre']:20} | Sala: {sala_info:8} | Rol: {rol:15} | {estado}"
+
 
 def resetear_sala(codigo_sala):
-    """Resetea una sala específica (roles y estado)"""
+    """Resetea una sala específica (roles y estado); False si no existe"""
     try:
         sala = Sala.objects.get(codigo=codigo_sala.upper())
         sala.partida_iniciada = False
         sala.save()
-        
+
         jugadores = sala.jugadores.all()
         count = jugadores.update(rol='aldeano', esta_vivo=True)
-        
+        # Sin write-through: los procesos del servidor vuelven a leer la sala
+        cache_salas.registrar_cambios_externos(codigos=[sala.codigo])
+
         print(f"✅ Sala {sala.codigo} reseteada:")
         print(f"   - Partida marcada como no iniciada")
         print(f"   - {count} jugador(es) reseteados a aldeano")
+        return True
     except Sala.DoesNotExist:
-        print(f"❌ Error: No existe la sala con código {codigo_sala}")
+        _error(f"No existe la sala con código {codigo_sala}")
+        return False
+
 
 def eliminar_sala(codigo_sala):
-    """Elimina una sala específica y todos sus jugadores"""
-    try:
-        sala = Sala.objects.get(codigo=codigo_sala.upper())
-        num_jugadores = sala.jugadores.count()
-        sala.delete()
-        print(f"✅ Sala {codigo_sala} eliminada (incluyendo {num_jugadores} jugador(es))")
-    except Sala.DoesNotExist:
-        print(f"❌ Error: No existe la sala con código {codigo_sala}")
+    """Elimina una sala específica y todos sus jugadores; False si no existe"""
+    contadores, _ = borrar_lote_salas(Sala.objects.filter(codigo=codigo_sala.upper()), 1)
+    if not contadores:
+        _error(f"No existe la sala con código {codigo_sala}")
+        return False
+    print(f"✅ Sala {codigo_sala} eliminada (incluyendo {contadores['jugadores']} jugador(es))")
+    return True
+
+
+def _confirmar(pregunta, si):
+    return si or input(pregunta).lower() == 's'
+
 
 if __name__ == '__main__':
     import argparse
-    
+
     parser = argparse.ArgumentParser(description='Gestión del juego Los Lobos')
-    parser.add_argument('accion', 
+    parser.add_argument('accion',
                        choices=['limpiar', 'listar_salas', 'listar_jugadores', 'resetear', 'eliminar'],
                        help='Acción a realizar')
     parser.add_argument('codigo', nargs='?', help='Código de la sala (para acciones específicas)')
-    
+    parser.add_argument('--formato', '--format', choices=['texto', 'json', 'csv'], default='texto',
+                        help='Formato de salida de los listados')
+    parser.add_argument('--lote', type=int, default=LOTE,
+                        help='Filas leídas o borradas de cada vez')
+    estado = parser.add_mutually_exclusive_group()
+    estado.add_argument('--iniciadas', dest='iniciadas', action='store_true', default=None,
+                        help='Solo salas con la partida iniciada')
+    estado.add_argument('--esperando', dest='iniciadas', action='store_false',
+                        help='Solo salas esperando a empezar')
+    parser.add_argument('--inactivas', type=int, metavar='MINUTOS',
+                        help='Solo salas sin actividad desde hace MINUTOS')
+    parser.add_argument('--antiguas', type=int, metavar='HORAS',
+                        help='Solo salas creadas hace más de HORAS')
+    parser.add_argument('-s', '--si', action='store_true',
+                        help='No pedir confirmación al borrar')
+
     args = parser.parse_args()
-    
+
+    hay_filtros = args.iniciadas is not None or args.inactivas is not None or args.antiguas is not None
+    salas = filtrar_salas(args.iniciadas, args.inactivas, args.antiguas) if hay_filtros else None
+
     if args.accion == 'limpiar':
-        confirmar = input("⚠️  ¿Estás seguro de eliminar TODAS las salas y jugadores? (s/n): ")
-        if confirmar.lower() == 's':
-            limpiar_todo()
-    
+        if hay_filtros:
+            pregunta = "⚠️  ¿Estás seguro de eliminar las salas filtradas y sus jugadores? (s/n): "
+        else:
+            pregunta = "⚠️  ¿Estás seguro de eliminar TODAS las salas y jugadores? (s/n): "
+        if _confirmar(pregunta, args.si):
+            limpiar_todo(salas, lote=args.lote)
+
     elif args.accion == 'listar_salas':
-        listar_salas()
-    
+        listar_salas(salas, formato=args.formato, lote=args.lote)
+
     elif args.accion == 'listar_jugadores':
-        listar_jugadores(args.codigo)
-    
-    elif args.accion == 'resetear':
-        if not args.codigo:
-            print("❌ Error: Debes proporcionar el código de la sala")
-            print("Uso: python gestionar.py resetear ABC123")
-        else:
-            resetear_sala(args.codigo)
-    
-    elif args.accion == 'eliminar':
+        if not listar_jugadores(args.codigo, salas, formato=args.formato, lote=args.lote):
+            sys.exit(1)
+
+    elif args.accion in ('resetear', 'eliminar'):
         if not args.codigo:
-            print("❌ Error: Debes proporcionar el código de la sala")
-            print("Uso: python gestionar.py eliminar ABC123")
+            _error("Debes proporcionar el código de la sala")
+            print(f"Uso: python gestionar.py {args.accion} ABC123", file=sys.stderr)
+            sys.exit(2)
+        if args.accion == 'resetear':
+            exito = resetear_sala(args.codigo)
         else:
-            confirmar = input(f"⚠️  ¿Estás seguro de eliminar la sala {args.codigo}? (s/n): ")
-            if confirmar.lower() == 's':
-                eliminar_sala(args.codigo)
+            pregunta = f"⚠️  ¿Estás seguro de eliminar la sala {args.codigo}? (s/n): "
+            exito = not _confirmar(pregunta, args.si) or eliminar_sala(args.codigo)
+        if not exito:
+            sys.exit(1)
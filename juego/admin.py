@@ -1,20 +1,139 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count
+from django.utils.functional import cached_property
+
+from . import cache_salas
 from .models import Jugador, Sala
 
+
+class PaginadorEstimado(Paginator):
+    """
+    Paginador que, en tablas grandes sin filtros, usa el número de filas
+    estimado por PostgreSQL (pg_class.reltuples) en vez de un COUNT(*) que
+    recorre toda la tabla. Con otras bases de datos, o con filtros, cuenta.
+    """
+
+    # Por debajo de estas filas estimadas se cuenta de verdad
+    UMBRAL = 10000
+
+    @cached_property
+    def count(self):
+        estimacion = self._estimar()
+        if estimacion is not None and estimacion > self.UMBRAL:
+            return estimacion
+        return super().count
+
+    def _estimar(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where or query.distinct:
+            return None
+        conexion = connections[self.object_list.db]
+        if conexion.vendor != 'postgresql':
+            return None
+        with conexion.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                [self.object_list.model._meta.db_table]
+            )
+            fila = cursor.fetchone()
+        return fila[0] if fila else None
+
+
+class FiltroSala(admin.SimpleListFilter):
+    """Filtro por código de sala escrito a mano, sin listar todas las salas"""
+    title = 'sala'
+    parameter_name = 'sala'
+    template = 'admin/juego/filtro_sala.html'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(sala__codigo=self.value().strip().upper())
+        return queryset
+
+    def choices(self, changelist):
+        # Los demás filtros, la búsqueda y el orden viajan como campos ocultos
+        otros = {
+            clave: valor for clave, valor in changelist.params.items()
+            if clave != self.parameter_name
+        }
+        yield {
+            'valor': self.value() or '',
+            'parametro': self.parameter_name,
+            'otros': otros.items(),
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+        }
+
+
 @admin.register(Sala)
 class SalaAdmin(admin.ModelAdmin):
-    list_display = ('codigo', 'partida_iniciada', 'creada_en', 'num_jugadores')
-    list_filter = ('partida_iniciada', 'creada_en')
+    list_display = ('codigo', 'partida_iniciada', 'creada_en', 'actividad', 'num_jugadores')
+    list_filter = ('partida_iniciada', 'creada_en', 'actividad')
     search_fields = ('codigo',)
     readonly_fields = ('creada_en',)
-    
+    paginator = PaginadorEstimado
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # El número de jugadores sale en la misma consulta que las salas
+        return super().get_queryset(request).annotate(_num_jugadores=Count('jugadores'))
+
+    @admin.display(description='Jugadores', ordering='_num_jugadores')
     def num_jugadores(self, obj):
-        return obj.jugadores.count()
-    num_jugadores.short_description = 'Jugadores'
+        return obj._num_jugadores
+
+    # Lo editado aquí no pasa por las vistas: se invalida la caché de salas
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        codigos = [obj.codigo]
+        if change and 'codigo' in form.changed_data:
+            codigos.append(form.initial['codigo'])
+        cache_salas.registrar_cambios_externos(codigos=codigos)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        cache_salas.registrar_salas_eliminadas([obj.codigo])
+
+    def delete_queryset(self, request, queryset):
+        codigos = list(queryset.values_list('codigo', flat=True))
+        super().delete_queryset(request, queryset)
+        cache_salas.registrar_salas_eliminadas(codigos)
 
 @admin.register(Jugador)
 class JugadorAdmin(admin.ModelAdmin):
     list_display = ('nombre', 'rol', 'esta_vivo', 'es_lider', 'sala', 'session_id')
-    list_filter = ('rol', 'esta_vivo', 'es_lider', 'sala')
-    search_fields = ('nombre', 'session_id')
+    list_filter = ('rol', 'esta_vivo', 'es_lider', FiltroSala)
+    search_fields = ('nombre', 'session_id', '=sala__codigo')
     list_select_related = ('sala',)
+    autocomplete_fields = ('sala',)
+    paginator = PaginadorEstimado
+    show_full_result_count = False
+
+    def _invalidar(self, jugadores):
+        # La sala anterior del jugador la encuentra la caché por su id
+        cache_salas.registrar_cambios_externos(
+            codigos=[codigo for _, codigo in jugadores if codigo],
+            jugadores=[jugador_id for jugador_id, _ in jugadores],
+        )
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self._invalidar([(obj.id, obj.sala.codigo if obj.sala_id else None)])
+
+    def delete_model(self, request, obj):
+        jugadores = [(obj.id, obj.sala.codigo if obj.sala_id else None)]
+        super().delete_model(request, obj)
+        self._invalidar(jugadores)
+
+    def delete_queryset(self, request, queryset):
+        jugadores = list(queryset.values_list('id', 'sala__codigo'))
+        super().delete_queryset(request, queryset)
+        self._invalidar(jugadores)
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class JuegoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'juego'
+
+    def ready(self):
+        # Conecta la señal que recicla los códigos de salas eliminadas
+        from . import codigos  # noqa: F401
+        # y las que cuentan las consultas de cada petición (métricas y perfilado)
+        from . import metricas, perfilado  # noqa: F401
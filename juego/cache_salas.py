@@ -0,0 +1,474 @@
+"""
+Caché en memoria (por proceso) del estado de las salas.
+
+Guarda, por código de sala, la lista de jugadores, el líder, la
+configuración de roles y si la partida ya comenzó, para que el
+LobbyConsumer no tenga que consultar la base de datos en cada conexión.
+
+Las vistas actualizan la caché cuando escriben en la base de datos
+(write-through); el admin y gestionar.py invalidan las salas que tocan.
+Las salas se expulsan por LRU y, como mucho TTL segundos después de
+cargarlas, se vuelven a leer de la base de datos.
+Los cambios en la lista de jugadores quedan además como eventos
+versionados, que el consumer difunde en lugar de la lista completa.
+
+Con varios procesos (CAPA_CANALES='compartida') cada uno tiene su propia
+caché: las escrituras se avisan al resto por la capa de canales y cada
+proceso invalida las salas afectadas.
+"""
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .models import Jugador, Sala
+
+
+CAMPOS_JUGADOR = ('id', 'nombre', 'es_lider', 'rol')
+# Conexión para leer el estado de las salas: la de solo lectura si existe
+BD_LECTURA = 'lectura' if 'lectura' in settings.DATABASES else 'default'
+
+
+def _copiar_estado(estado):
+    """Copia el estado para que nadie modifique la entrada cacheada"""
+    copia = dict(estado)
+    copia['jugadores'] = [dict(j) for j in estado['jugadores']]
+    copia['configuracion'] = dict(estado['configuracion'])
+    return copia
+
+
+def _calcular_lider(jugadores):
+    for j in jugadores:
+        if j['es_lider']:
+            return j['id']
+    return None
+
+
+def nueva_epoca():
+    """
+    Identificador de la serie de versiones de una sala.
+
+    Cambia cada vez que la sala se (re)carga en la caché, de modo que un
+    cliente con versiones de otra carga (o de otro proceso) pida el estado
+    completo en vez de aplicar cambios que no encajan.
+    """
+    return uuid.uuid4().hex[:8]
+
+
+class _Entrada:
+    __slots__ = ('estado', 'expira', 'eventos')
+
+    def __init__(self, estado, expira, max_eventos):
+        self.estado = estado
+        self.expira = expira
+        self.eventos = deque(maxlen=max_eventos)
+
+
+class CacheSalas:
+    """
+    Diccionario LRU con expiración absoluta y seguro entre hilos.
+
+    Cada sala caduca `ttl` segundos después de guardarla aunque se siga
+    leyendo, para que lo escrito por otras vías acabe viéndose.
+
+    Cada sala lleva una `epoca` y una `version` que aumenta con cada cambio
+    en la lista de jugadores; los últimos cambios se guardan como eventos
+    para poder enviar solo las diferencias a los clientes.
+    """
+
+    def __init__(self, max_salas=1000, ttl=600, max_eventos=50, reloj=time.monotonic):
+        self.max_salas = max_salas
+        self.ttl = ttl
+        self.max_eventos = max_eventos
+        self._reloj = reloj
+        self._entradas = OrderedDict()
+        # jugador_id -> código de la sala cacheada en la que está
+        self._sala_de_jugador = {}
+        # Escrituras por sala, para descartar lecturas que llegan tarde
+        self._escrituras = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def _quitar(self, codigo):
+        entrada = self._entradas.pop(codigo)
+        for j in entrada.estado['jugadores']:
+            if self._sala_de_jugador.get(j['id']) == codigo:
+                del self._sala_de_jugador[j['id']]
+
+    def _expulsar(self, codigo):
+        self._quitar(codigo)
+        self.expulsiones += 1
+
+    def _marcar_escritura(self, codigo):
+        self._escrituras[codigo] = self._escrituras.pop(codigo, 0) + 1
+        while len(self._escrituras) > 2 * self.max_salas:
+            self._escrituras.popitem(last=False)
+
+    def generacion(self, codigo):
+        """Contador de escrituras de la sala; ver `guardar(..., generacion=)`"""
+        with self._lock:
+            return self._escrituras.get(codigo, 0)
+
+    def _purgar_expiradas(self, ahora):
+        # El orden es el de uso (LRU), no el de caducidad: se recorren todas
+        for codigo in [c for c, e in self._entradas.items() if e.expira <= ahora]:
+            self._expulsar(codigo)
+
+    def _entrada_viva(self, codigo):
+        entrada = self._entradas.get(codigo)
+        if entrada is None:
+            return None
+        if entrada.expira <= self._reloj():
+            self._expulsar(codigo)
+            return None
+        self._entradas.move_to_end(codigo)
+        return entrada
+
+    def _agregar_evento(self, entrada, evento):
+        estado = entrada.estado
+        estado['version'] += 1
+        evento['version'] = estado['version']
+        entrada.eventos.append(evento)
+
+    def obtener(self, codigo):
+        """Devuelve una copia del estado de la sala o None si no está cacheada"""
+        with self._lock:
+            entrada = self._entrada_viva(codigo)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            return _copiar_estado(entrada.estado)
+
+    def guardar(self, codigo, estado, generacion=None):
+        """
+        Guarda (o reemplaza) el estado completo de una sala, abriendo una
+        nueva época de versiones.
+
+        Si se indica `generacion` y hubo escrituras en la sala después de
+        tomarla, el estado se considera obsoleto y no se guarda.
+        """
+        estado = _copiar_estado(estado)
+        estado['lider'] = _calcular_lider(estado['jugadores'])
+        estado['epoca'] = nueva_epoca()
+        estado['version'] = 0
+        # Última versión enviada al grupo; None hasta enviar el primer estado
+        estado['difundida'] = None
+        with self._lock:
+            if generacion is not None and self._escrituras.get(codigo, 0) != generacion:
+                return False
+            if codigo in self._entradas:
+                self._quitar(codigo)
+            ahora = self._reloj()
+            self._entradas[codigo] = _Entrada(estado, ahora + self.ttl, self.max_eventos)
+            for j in estado['jugadores']:
+                self._sala_de_jugador[j['id']] = codigo
+            self._purgar_expiradas(ahora)
+            while len(self._entradas) > self.max_salas:
+                self._expulsar(next(iter(self._entradas)))
+        return True
+
+    def invalidar(self, codigo):
+        with self._lock:
+            self._marcar_escritura(codigo)
+            if codigo in self._entradas:
+                self._expulsar(codigo)
+
+    def invalidar_jugador(self, jugador_id):
+        """Invalida la sala cacheada en la que está el jugador, si hay alguna"""
+        with self._lock:
+            codigo = self._sala_de_jugador.get(jugador_id)
+            if codigo is not None:
+                self._marcar_escritura(codigo)
+                if codigo in self._entradas:
+                    self._expulsar(codigo)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._sala_de_jugador.clear()
+            self._escrituras.clear()
+
+    def actualizar_sala(self, codigo, **campos):
+        """Actualiza campos de la sala (configuracion, partida_iniciada) si está cacheada"""
+        with self._lock:
+            self._marcar_escritura(codigo)
+            entrada = self._entrada_viva(codigo)
+            if entrada is None:
+                return
+            entrada.estado.update(campos)
+
+    def registrar_jugador(self, jugador, codigo):
+        """
+        Refleja en la caché que `jugador` (dict con CAMPOS_JUGADOR) está en la
+        sala `codigo`, quitándolo de la sala en la que estuviera antes.
+
+        Genera los eventos `salio`, `unido`, `renombrado` y `lider` que
+        correspondan en cada sala afectada.
+        """
+        jugador = {campo: jugador[campo] for campo in CAMPOS_JUGADOR}
+        with self._lock:
+            self._marcar_escritura(codigo)
+            codigo_anterior = self._sala_de_jugador.pop(jugador['id'], None)
+            if codigo_anterior not in (None, codigo) and codigo_anterior in self._entradas:
+                self._marcar_escritura(codigo_anterior)
+                anterior = self._entradas[codigo_anterior]
+                anterior.estado['jugadores'] = [
+                    j for j in anterior.estado['jugadores'] if j['id'] != jugador['id']
+                ]
+                self._agregar_evento(anterior, {'evento': 'salio', 'id': jugador['id']})
+                self._actualizar_lider(anterior)
+
+            entrada = self._entrada_viva(codigo)
+            if entrada is None:
+                return
+            jugadores = entrada.estado['jugadores']
+            for i, j in enumerate(jugadores):
+                if j['id'] == jugador['id']:
+                    jugadores[i] = jugador
+                    if j['nombre'] != jugador['nombre']:
+                        self._agregar_evento(entrada, {
+                            'evento': 'renombrado',
+                            'id': jugador['id'],
+                            'nombre': jugador['nombre'],
+                        })
+                    break
+            else:
+                jugadores.append(jugador)
+                jugadores.sort(key=lambda j: j['id'])
+                # El historial se reenvía a toda la sala: el rol no entra en él
+                publico = {campo: valor for campo, valor in jugador.items() if campo != 'rol'}
+                self._agregar_evento(entrada, {'evento': 'unido', 'jugador': publico})
+            self._actualizar_lider(entrada)
+            self._sala_de_jugador[jugador['id']] = codigo
+
+    def _actualizar_lider(self, entrada):
+        lider = _calcular_lider(entrada.estado['jugadores'])
+        if lider != entrada.estado['lider']:
+            entrada.estado['lider'] = lider
+            self._agregar_evento(entrada, {'evento': 'lider', 'id': lider})
+
+    def asignar_roles(self, codigo, roles):
+        """Actualiza los roles (dict jugador_id -> rol) y marca la partida como iniciada"""
+        with self._lock:
+            self._marcar_escritura(codigo)
+            entrada = self._entrada_viva(codigo)
+            if entrada is None:
+                return
+            for j in entrada.estado['jugadores']:
+                if j['id'] in roles:
+                    j['rol'] = roles[j['id']]
+            entrada.estado['partida_iniciada'] = True
+
+    def eventos_desde(self, codigo, epoca, version):
+        """
+        Eventos de jugadores posteriores a `version` de la época `epoca`.
+
+        Devuelve None si la sala no está cacheada, la época no coincide o
+        los eventos pedidos ya no están en el historial; en esos casos hay
+        que enviar el estado completo.
+        """
+        with self._lock:
+            entrada = self._entrada_viva(codigo)
+            if entrada is None or entrada.estado['epoca'] != epoca:
+                return None
+            return self._eventos_desde(entrada, version)
+
+    def _eventos_desde(self, entrada, version):
+        actual = entrada.estado['version']
+        if version is None or version > actual:
+            return None
+        if version == actual:
+            return []
+        eventos = [dict(e) for e in entrada.eventos if e['version'] > version]
+        if not eventos or eventos[0]['version'] != version + 1:
+            return None
+        return eventos
+
+    def tomar_pendientes(self, codigo):
+        """
+        Marca como difundidos los cambios de la sala que aún no se enviaron
+        al grupo y los devuelve como (estado, eventos).
+
+        `eventos` es None cuando hay que difundir el estado completo (sala
+        recién cargada o historial insuficiente). Devuelve None si la sala
+        no está cacheada.
+        """
+        with self._lock:
+            entrada = self._entrada_viva(codigo)
+            if entrada is None:
+                return None
+            estado = entrada.estado
+            eventos = self._eventos_desde(entrada, estado['difundida'])
+            estado['difundida'] = estado['version']
+            return _copiar_estado(estado), eventos
+
+
+_config = getattr(settings, 'CACHE_SALAS', {})
+cache = CacheSalas(
+    max_salas=_config.get('MAX_SALAS', 1000),
+    ttl=_config.get('TTL', 600),
+    max_eventos=_config.get('MAX_EVENTOS', 50),
+)
+
+
+def estado_desde_bd(codigo):
+    """Lee el estado de la sala desde la base de datos (None si no existe)"""
+    try:
+        sala = Sala.objects.using(BD_LECTURA).get(codigo=codigo)
+    except Sala.DoesNotExist:
+        return None
+    jugadores = list(
+        Jugador.objects.using(BD_LECTURA).filter(sala=sala).values(*CAMPOS_JUGADOR)
+    )
+    return {
+        'jugadores': jugadores,
+        'lider': _calcular_lider(jugadores),
+        'configuracion': sala.configuracion_roles or sala.get_configuracion_default(),
+        'partida_iniciada': sala.partida_iniciada,
+    }
+
+
+def obtener_estado(codigo):
+    """Estado de la sala desde la caché, cargándolo de la base de datos si falta"""
+    estado = cache.obtener(codigo)
+    if estado is None:
+        generacion = cache.generacion(codigo)
+        estado = estado_desde_bd(codigo)
+        if estado is None:
+            return None
+        if cache.guardar(codigo, estado, generacion=generacion):
+            estado = cache.obtener(codigo) or estado
+        else:
+            # Otra escritura ganó la carrera: se usa la lectura sin cachearla
+            estado.update(epoca=None, version=0)
+    return estado
+
+
+# Escrituras desde las vistas: se aplican al confirmar la transacción para
+# que la caché nunca muestre datos que luego se deshacen.
+
+def registrar_sala_creada(sala):
+    def aplicar():
+        cache.guardar(sala.codigo, {
+            'jugadores': [],
+            'configuracion': sala.configuracion_roles,
+            'partida_iniciada': sala.partida_iniciada,
+        })
+    transaction.on_commit(aplicar)
+
+
+def registrar_jugador(jugador, sala):
+    datos = {campo: getattr(jugador, campo) for campo in CAMPOS_JUGADOR}
+
+    def aplicar():
+        cache.registrar_jugador(datos, sala.codigo)
+        _avisar_otros_procesos(codigos=[sala.codigo], jugadores=[datos['id']])
+    transaction.on_commit(aplicar)
+
+
+def registrar_configuracion(codigo, configuracion):
+    configuracion = dict(configuracion)
+
+    def aplicar():
+        cache.actualizar_sala(codigo, configuracion=configuracion)
+        _avisar_otros_procesos(codigos=[codigo])
+    transaction.on_commit(aplicar)
+
+
+def registrar_partida_iniciada(sala, jugadores):
+    roles = {j.id: j.rol for j in jugadores}
+
+    def aplicar():
+        cache.asignar_roles(sala.codigo, roles)
+        _avisar_otros_procesos(codigos=[sala.codigo])
+    transaction.on_commit(aplicar)
+
+
+def registrar_cambios_externos(codigos=(), jugadores=()):
+    """
+    Escrituras fuera de las vistas (admin, gestionar.py): como no llevan
+    write-through, se invalidan las salas y jugadores afectados.
+
+    Desde otro proceso sin capa de canales compartida el aviso no llega;
+    entonces es el TTL de la caché el que acota cuánto dura el dato viejo.
+    """
+    codigos = list(codigos)
+    jugadores = list(jugadores)
+
+    def aplicar():
+        for jugador_id in jugadores:
+            cache.invalidar_jugador(jugador_id)
+        for codigo in codigos:
+            cache.invalidar(codigo)
+        _avisar_otros_procesos(codigos=codigos, jugadores=jugadores)
+    transaction.on_commit(aplicar)
+
+
+def registrar_salas_eliminadas(codigos):
+    codigos = list(codigos)
+
+    def aplicar():
+        for codigo in codigos:
+            cache.invalidar(codigo)
+        _avisar_otros_procesos(codigos=codigos)
+    transaction.on_commit(aplicar)
+
+
+# Invalidación entre procesos
+
+GRUPO_INVALIDACIONES = 'cache_salas'
+ORIGEN = uuid.uuid4().hex
+_escuchas = weakref.WeakKeyDictionary()
+
+
+def _avisar_otros_procesos(codigos=(), jugadores=()):
+    if not _config.get('INVALIDAR_ENTRE_PROCESOS'):
+        return
+    async_to_sync(get_channel_layer().group_send)(GRUPO_INVALIDACIONES, {
+        'type': 'cache.invalidar',
+        'origen': ORIGEN,
+        'codigos': list(codigos),
+        'jugadores': list(jugadores),
+    })
+
+
+def aplicar_invalidacion(mensaje):
+    if mensaje.get('origen') == ORIGEN:
+        return
+    for jugador_id in mensaje.get('jugadores', ()):
+        cache.invalidar_jugador(jugador_id)
+    for codigo in mensaje.get('codigos', ()):
+        cache.invalidar(codigo)
+
+
+def iniciar_escucha_invalidaciones():
+    """Arranca, una vez por bucle de eventos, la escucha de avisos de otros procesos"""
+    if not _config.get('INVALIDAR_ENTRE_PROCESOS'):
+        return
+    loop = asyncio.get_running_loop()
+    tarea = _escuchas.get(loop)
+    if tarea is None or tarea.done():
+        _escuchas[loop] = loop.create_task(_escuchar_invalidaciones())
+
+
+async def _escuchar_invalidaciones():
+    channel_layer = get_channel_layer()
+    canal = await channel_layer.new_channel()
+    await channel_layer.group_add(GRUPO_INVALIDACIONES, canal)
+    # Lo cacheado antes de escuchar pudo perderse avisos: se descarta
+    cache.limpiar()
+    while True:
+        aplicar_invalidacion(await channel_layer.receive(canal))
@@ -0,0 +1,463 @@
+"""
+Channel layer compartida entre varios procesos locales.
+
+InMemoryChannelLayer solo sirve con un proceso de daphne. Esta capa usa
+publicación/suscripción sobre el protocolo de Redis (RESP), de modo que
+funciona igual contra:
+
+  - el broker incluido en este módulo, escuchando en un socket Unix
+    (``unix:///tmp/lobos-canales.sock``) o en TCP, que se arranca con
+    ``python -m juego.capa_canales --socket /tmp/lobos-canales.sock``
+  - un servidor Redis real (``redis://host:6379``), sin cambiar nada más.
+
+Cada proceso (y cada bucle de eventos dentro de él) se suscribe a un tema
+propio para los canales específicos y a un tema por cada grupo en el que
+tenga algún canal local; ``group_send`` publica una sola vez por grupo y
+cada proceso reparte el mensaje entre sus canales de ese grupo.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import string
+import time
+import uuid
+import weakref
+from collections import defaultdict
+from urllib.parse import unquote, urlparse
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorRESP(Exception):
+    """Respuesta de error (-ERR ...) del servidor"""
+
+
+# Protocolo RESP
+
+def _codificar(valor):
+    if isinstance(valor, (list, tuple)):
+        return b'*%d\r\n' % len(valor) + b''.join(_codificar(v) for v in valor)
+    if isinstance(valor, int):
+        return b':%d\r\n' % valor
+    if isinstance(valor, str):
+        valor = valor.encode()
+    return b'$%d\r\n%s\r\n' % (len(valor), valor)
+
+
+async def _leer(reader):
+    linea = await reader.readline()
+    if not linea.endswith(b'\r\n'):
+        raise ConnectionError('Conexión cerrada')
+    tipo, resto = linea[:1], linea[1:-2]
+    if tipo == b'+':
+        return resto.decode()
+    if tipo == b'-':
+        raise ErrorRESP(resto.decode())
+    if tipo == b':':
+        return int(resto)
+    if tipo == b'$':
+        largo = int(resto)
+        if largo < 0:
+            return None
+        return (await reader.readexactly(largo + 2))[:-2]
+    if tipo == b'*':
+        largo = int(resto)
+        if largo < 0:
+            return None
+        return [await _leer(reader) for _ in range(largo)]
+    raise ConnectionError(f'Respuesta RESP no válida: {linea!r}')
+
+
+async def abrir_conexion(url):
+    """Abre una conexión RESP a `unix:///ruta` o `redis://[:clave@]host:puerto[/db]`"""
+    partes = urlparse(url)
+    if partes.scheme == 'unix':
+        reader, writer = await asyncio.open_unix_connection(partes.path)
+    elif partes.scheme in ('redis', 'tcp'):
+        reader, writer = await asyncio.open_connection(
+            partes.hostname or 'localhost', partes.port or 6379
+        )
+    else:
+        raise ValueError(f'Esquema de URL no soportado: {url}')
+
+    if partes.password:
+        comando = ['AUTH', unquote(partes.password)]
+        if partes.username:
+            comando.insert(1, unquote(partes.username))
+        writer.write(_codificar(comando))
+        await _leer(reader)
+    return reader, writer
+
+
+# Serialización de mensajes (JSON con soporte para bytes)
+
+def _por_defecto(valor):
+    if isinstance(valor, bytes):
+        return {'__bytes__': base64.b64encode(valor).decode()}
+    raise TypeError(f'No se puede serializar {type(valor).__name__}')
+
+
+def _decodificar_objeto(objeto):
+    if len(objeto) == 1 and '__bytes__' in objeto:
+        return base64.b64decode(objeto['__bytes__'])
+    return objeto
+
+
+def serializar(datos):
+    return json.dumps(datos, default=_por_defecto, separators=(',', ':')).encode()
+
+
+def deserializar(datos):
+    return json.loads(datos, object_hook=_decodificar_objeto)
+
+
+class _EstadoBucle:
+    """Conexiones, colas y grupos locales de la capa en un bucle de eventos"""
+
+    def __init__(self):
+        self.prefijo_cliente = uuid.uuid4().hex[:12]
+        self.publicacion = None
+        self.suscripcion = None
+        self.lector = None
+        self.bloqueo = asyncio.Lock()
+        self.colas = {}
+        self.grupos = defaultdict(set)
+        self.temas = set()
+        self.confirmaciones = {}
+
+
+class CapaCanalesLocal(BaseChannelLayer):
+    """
+    Channel layer de publicación/suscripción sobre RESP.
+
+    Los mensajes se entregan como mucho una vez: si un proceso no está
+    conectado cuando se publica, no lo recibe (igual que el grupo de un
+    proceso que se reinicia con InMemoryChannelLayer).
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, url='unix:///tmp/lobos-canales.sock', prefijo='lobos',
+                 expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.url = url
+        self.prefijo = prefijo
+        self._estados = weakref.WeakKeyDictionary()
+
+    # Conexión
+
+    async def _estado(self):
+        """Estado de la capa para el bucle de eventos actual"""
+        loop = asyncio.get_running_loop()
+        estado = self._estados.get(loop)
+        if estado is None:
+            # La conexión de suscripción la abre (y reabre) el lector; la de
+            # publicación se abre al publicar por primera vez
+            estado = self._estados[loop] = _EstadoBucle()
+            estado.lector = loop.create_task(self._leer_suscripciones(estado))
+        return estado
+
+    async def _leer_suscripciones(self, estado):
+        espera = 0.1
+        while True:
+            try:
+                if estado.suscripcion is None:
+                    estado.suscripcion = await abrir_conexion(self.url)
+                    if estado.temas:
+                        estado.suscripcion[1].write(_codificar(['SUBSCRIBE', *estado.temas]))
+                    espera = 0.1
+                respuesta = await _leer(estado.suscripcion[0])
+            except ErrorRESP as e:
+                logger.warning('Error del servidor de canales: %s', e)
+                continue
+            except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+                logger.warning('Conexión de suscripción perdida (%s); reintentando', e)
+                estado.suscripcion = None
+                await asyncio.sleep(espera)
+                espera = min(espera * 2, 5)
+                continue
+
+            if not isinstance(respuesta, list) or len(respuesta) < 3:
+                continue
+            tipo, tema = respuesta[0], respuesta[1].decode()
+            if tipo == b'message':
+                self._entregar(estado, respuesta[2])
+            elif tipo == b'subscribe':
+                confirmacion = estado.confirmaciones.pop(tema, None)
+                if confirmacion is not None and not confirmacion.done():
+                    confirmacion.set_result(True)
+
+    async def _publicar(self, tema, datos):
+        estado = await self._estado()
+        async with estado.bloqueo:
+            for intento in range(2):
+                try:
+                    if estado.publicacion is None:
+                        estado.publicacion = await abrir_conexion(self.url)
+                    reader, writer = estado.publicacion
+                    writer.write(_codificar(['PUBLISH', tema, datos]))
+                    return await _leer(reader)
+                except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                    estado.publicacion = None
+                    if intento:
+                        raise
+
+    async def _suscribir(self, estado, tema):
+        if tema in estado.temas:
+            confirmacion = estado.confirmaciones.get(tema)
+            if confirmacion is None:
+                return
+        else:
+            estado.temas.add(tema)
+            confirmacion = asyncio.get_running_loop().create_future()
+            estado.confirmaciones[tema] = confirmacion
+            if estado.suscripcion is not None:
+                estado.suscripcion[1].write(_codificar(['SUBSCRIBE', tema]))
+        # Esperar a que el servidor confirme para no perder el siguiente mensaje
+        try:
+            await asyncio.wait_for(asyncio.shield(confirmacion), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning('El servidor no confirmó la suscripción a %s', tema)
+
+    def _desuscribir(self, estado, tema):
+        if tema not in estado.temas:
+            return
+        estado.temas.discard(tema)
+        if estado.suscripcion is not None:
+            estado.suscripcion[1].write(_codificar(['UNSUBSCRIBE', tema]))
+
+    # Temas
+
+    def _tema_canal(self, canal):
+        return f'{self.prefijo}:{self.non_local_name(canal)}'
+
+    def _tema_grupo(self, grupo):
+        return f'{self.prefijo}:grupo:{grupo}'
+
+    # Entrega local
+
+    def _encolar(self, estado, canal, mensaje):
+        """False si el canal está lleno"""
+        cola = estado.colas.get(canal)
+        if cola is None:
+            # Canal ya cerrado (o que nunca se abrió aquí): nadie lo va a
+            # leer, así que no se crea una cola que luego nadie liberaría
+            return True
+        if cola.qsize() >= self.get_capacity(canal):
+            return False
+        cola.put_nowait(mensaje)
+        return True
+
+    def _entregar(self, estado, datos):
+        try:
+            paquete = deserializar(datos)
+        except ValueError:
+            logger.warning('Mensaje no válido en la capa de canales')
+            return
+        if paquete['e'] < time.time():
+            return
+        if paquete.get('g') is not None:
+            for canal in list(estado.grupos.get(paquete['g'], ())):
+                if not self._encolar(estado, canal, dict(paquete['m'])):
+                    logger.warning('Canal %s lleno; mensaje de grupo descartado', canal)
+        elif not self._encolar(estado, paquete['c'], paquete['m']):
+            logger.warning('Canal %s lleno; mensaje descartado', paquete['c'])
+
+    # API de channel layer
+
+    async def new_channel(self, prefix='specific.'):
+        estado = await self._estado()
+        await self._suscribir(estado, self._tema_canal(f'{prefix}{estado.prefijo_cliente}!'))
+        sufijo = ''.join(random.choices(string.ascii_letters, k=12))
+        canal = f'{prefix}{estado.prefijo_cliente}!{sufijo}'
+        estado.colas[canal] = asyncio.Queue()
+        return canal
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        estado = await self._estado()
+        # Atajo para canales de este mismo bucle
+        if channel in estado.colas:
+            if not self._encolar(estado, channel, message):
+                raise ChannelFull(channel)
+            return
+        await self._publicar(self._tema_canal(channel), serializar({
+            'c': channel, 'm': message, 'e': time.time() + self.expiry,
+        }))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        estado = await self._estado()
+        if '!' not in channel:
+            await self._suscribir(estado, self._tema_canal(channel))
+        cola = estado.colas.get(channel)
+        if cola is None:
+            cola = estado.colas[channel] = asyncio.Queue()
+        try:
+            return await cola.get()
+        except asyncio.CancelledError:
+            # El consumer se cerró: liberar la cola si no quedó nada pendiente
+            if cola.empty() and estado.colas.get(channel) is cola:
+                del estado.colas[channel]
+            raise
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        estado = await self._estado()
+        estado.grupos[group].add(channel)
+        await self._suscribir(estado, self._tema_grupo(group))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        estado = await self._estado()
+        canales = estado.grupos.get(group)
+        if canales is None:
+            return
+        canales.discard(channel)
+        if not canales:
+            del estado.grupos[group]
+            self._desuscribir(estado, self._tema_grupo(group))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        await self._publicar(self._tema_grupo(group), serializar({
+            'g': group, 'm': message, 'e': time.time() + self.expiry,
+        }))
+
+    async def flush(self):
+        estado = await self._estado()
+        for tema in list(estado.temas):
+            self._desuscribir(estado, tema)
+        estado.colas.clear()
+        estado.grupos.clear()
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        estado = self._estados.pop(loop, None)
+        if estado is None:
+            return
+        estado.lector.cancel()
+        for conexion in (estado.publicacion, estado.suscripcion):
+            if conexion is not None:
+                conexion[1].close()
+
+
+class BrokerCanales:
+    """
+    Servidor mínimo compatible con el pub/sub de Redis (PUBLISH, SUBSCRIBE,
+    UNSUBSCRIBE, PING) para compartir la capa de canales entre procesos
+    locales sin instalar Redis.
+
+    Un suscriptor que no lee y acumula más de `max_pendiente` bytes por
+    enviar se desconecta (como `client-output-buffer-limit pubsub` de
+    Redis); la capa vuelve a conectarse y suscribirse sola.
+    """
+
+    def __init__(self, max_pendiente=8 * 1024 * 1024):
+        self.max_pendiente = max_pendiente
+        self._suscriptores = defaultdict(set)
+        # writer -> temas a los que está suscrito
+        self._temas = {}
+        self.publicados = 0
+        self.desconectados = 0
+
+    def publicar(self, tema, datos):
+        """Reparte el mensaje entre los suscriptores del tema; devuelve cuántos lo reciben"""
+        mensaje = _codificar([b'message', tema, datos])
+        entregados = 0
+        for destino in list(self._suscriptores.get(tema, ())):
+            pendiente = destino.transport.get_write_buffer_size()
+            if pendiente > self.max_pendiente:
+                logger.warning('Suscriptor lento desconectado (%d bytes sin enviar)', pendiente)
+                self.desconectados += 1
+                self._desconectar(destino)
+                continue
+            destino.write(mensaje)
+            entregados += 1
+        self.publicados += 1
+        return entregados
+
+    def _desconectar(self, writer):
+        for tema in self._temas.pop(writer, ()):
+            self._quitar(tema, writer)
+        writer.close()
+
+    async def atender(self, reader, writer):
+        temas = self._temas[writer] = set()
+        try:
+            while True:
+                comando = await _leer(reader)
+                # Desconectado por lento mientras esperaba el comando
+                if writer.is_closing() or not isinstance(comando, list) or not comando:
+                    break
+                nombre = comando[0].upper()
+                if nombre == b'PUBLISH':
+                    writer.write(_codificar(self.publicar(comando[1], comando[2])))
+                elif nombre == b'SUBSCRIBE':
+                    for tema in comando[1:]:
+                        self._suscriptores[tema].add(writer)
+                        temas.add(tema)
+                        writer.write(_codificar([b'subscribe', tema, len(temas)]))
+                elif nombre == b'UNSUBSCRIBE':
+                    for tema in comando[1:]:
+                        self._quitar(tema, writer)
+                        temas.discard(tema)
+                        writer.write(_codificar([b'unsubscribe', tema, len(temas)]))
+                elif nombre == b'PING':
+                    writer.write(b'+PONG\r\n')
+                elif nombre in (b'AUTH', b'SELECT', b'CLIENT'):
+                    writer.write(b'+OK\r\n')
+                else:
+                    writer.write(b'-ERR comando no soportado\r\n')
+                await writer.drain()
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._desconectar(writer)
+
+    def _quitar(self, tema, writer):
+        suscriptores = self._suscriptores.get(tema)
+        if suscriptores is not None:
+            suscriptores.discard(writer)
+            if not suscriptores:
+                del self._suscriptores[tema]
+
+    async def servir(self, socket=None, host=None, puerto=None):
+        if socket:
+            if os.path.exists(socket):
+                os.unlink(socket)
+            servidor = await asyncio.start_unix_server(self.atender, path=socket)
+        else:
+            servidor = await asyncio.start_server(self.atender, host or '127.0.0.1', puerto or 6379)
+        async with servidor:
+            await servidor.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Broker local de la capa de canales de Los Lobos')
+    parser.add_argument('--socket', help='Ruta del socket Unix (por defecto /tmp/lobos-canales.sock)')
+    parser.add_argument('--host', help='Escuchar en TCP en lugar de un socket Unix')
+    parser.add_argument('--puerto', type=int, default=6379, help='Puerto TCP')
+
+    args = parser.parse_args()
+    socket = None if args.host else (args.socket or '/tmp/lobos-canales.sock')
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info('Broker de canales escuchando en %s', socket or f'{args.host}:{args.puerto}')
+    try:
+        asyncio.run(BrokerCanales().servir(socket=socket, host=args.host, puerto=args.puerto))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,152 @@
+"""
+Asignación de códigos de sala.
+
+En lugar de consultar la base de datos en cada intento, el proceso guarda
+en memoria el conjunto de códigos en uso (cargado una vez) y elige códigos
+libres al azar. Si otro proceso se adelantó con el mismo código, el
+IntegrityError del índice único se reintenta un número limitado de veces.
+Los códigos de salas eliminadas se reciclan tras una cuarentena, para que
+un enlace viejo no lleve a una sala nueva recién creada.
+"""
+import logging
+import random
+import string
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Sala
+
+logger = logging.getLogger(__name__)
+
+ALFABETO = string.ascii_uppercase + string.digits
+LONGITUD = 6
+
+
+class SinCodigosLibres(Exception):
+    """No se pudo asignar un código libre tras varios intentos"""
+
+
+class AsignadorCodigos:
+    def __init__(self, max_intentos=5, cuarentena=3600, reloj=time.monotonic):
+        self.max_intentos = max_intentos
+        self.cuarentena = cuarentena
+        self._reloj = reloj
+        self._usados = None
+        self._reciclados = deque()
+        self._lock = threading.Lock()
+        self._rng = random.SystemRandom()
+        self.estadisticas = {
+            'asignaciones': 0,
+            'colisiones_memoria': 0,
+            'colisiones_bd': 0,
+            'reciclados': 0,
+            'tiempo_total': 0.0,
+            'tiempo_max': 0.0,
+        }
+
+    def _cargar(self):
+        if self._usados is None:
+            self._usados = set(Sala.objects.values_list('codigo', flat=True).iterator())
+        return self._usados
+
+    def generar(self, reservar=True):
+        """
+        Devuelve un código que no está en uso en este proceso. Con `reservar`
+        queda apartado para la sala que se va a crear; quien lo reserva debe
+        crearla o soltarlo.
+        """
+        with self._lock:
+            usados = self._cargar()
+            codigo = self._reciclado(usados) or self._aleatorio(usados)
+            if reservar:
+                usados.add(codigo)
+            return codigo
+
+    def _reciclado(self, usados):
+        ahora = self._reloj()
+        while self._reciclados and self._reciclados[0][0] <= ahora:
+            _, codigo = self._reciclados.popleft()
+            if codigo not in usados:
+                self.estadisticas['reciclados'] += 1
+                return codigo
+        return None
+
+    def _aleatorio(self, usados):
+        while True:
+            codigo = ''.join(self._rng.choices(ALFABETO, k=LONGITUD))
+            if codigo not in usados:
+                return codigo
+            self.estadisticas['colisiones_memoria'] += 1
+
+    def marcar_usado(self, codigo):
+        with self._lock:
+            if self._usados is not None:
+                self._usados.add(codigo)
+
+    def soltar(self, codigo):
+        """Devuelve un código reservado cuya sala no llegó a crearse"""
+        with self._lock:
+            if self._usados is not None:
+                self._usados.discard(codigo)
+
+    def liberar(self, codigo):
+        """El código quedó libre (sala eliminada): se reutiliza tras la cuarentena"""
+        with self._lock:
+            if self._usados is not None and codigo in self._usados:
+                self._usados.discard(codigo)
+                self._reciclados.append((self._reloj() + self.cuarentena, codigo))
+
+    def crear_sala(self, **campos):
+        """Crea una sala con un código libre, reintentando si otro proceso lo tomó"""
+        inicio = time.perf_counter()
+        for _ in range(self.max_intentos):
+            codigo = self.generar()
+            try:
+                with transaction.atomic():
+                    sala = Sala.objects.create(codigo=codigo, **campos)
+                break
+            except IntegrityError:
+                # Código creado por otro proceso: queda marcado como usado
+                self.estadisticas['colisiones_bd'] += 1
+            except BaseException:
+                self.soltar(codigo)
+                raise
+        else:
+            raise SinCodigosLibres(f'Sin código libre tras {self.max_intentos} intentos')
+
+        duracion = time.perf_counter() - inicio
+        self.estadisticas['asignaciones'] += 1
+        self.estadisticas['tiempo_total'] += duracion
+        self.estadisticas['tiempo_max'] = max(self.estadisticas['tiempo_max'], duracion)
+        logger.debug('Código %s asignado en %.2f ms', codigo, duracion * 1000)
+        return sala
+
+    def latencia_media(self):
+        asignaciones = self.estadisticas['asignaciones']
+        return self.estadisticas['tiempo_total'] / asignaciones if asignaciones else 0.0
+
+
+_config = getattr(settings, 'CODIGOS_SALA', {})
+asignador = AsignadorCodigos(
+    max_intentos=_config.get('MAX_INTENTOS', 5),
+    cuarentena=_config.get('CUARENTENA', 3600),
+)
+
+
+@receiver(post_save, sender=Sala)
+def _marcar_codigo(sender, instance, created, **kwargs):
+    # Salas creadas sin crear_sala (admin, Sala.generar_codigo): su código
+    # pasa a estar en uso solo cuando la fila existe de verdad
+    if created:
+        transaction.on_commit(lambda: asignador.marcar_usado(instance.codigo))
+
+
+@receiver(post_delete, sender=Sala)
+def _liberar_codigo(sender, instance, **kwargs):
+    transaction.on_commit(lambda: asignador.liberar(instance.codigo))
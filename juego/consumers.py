@@ -1,12 +1,273 @@
+import asyncio
 import json
+import logging
+import time
+import weakref
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import Sala, Jugador
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metricas, perfilado, presencia
+from .cache_salas import cache, iniciar_escucha_invalidaciones, obtener_estado
+from .protocolo import (
+    SUBPROTOCOLO_COMPACTO, SUBPROTOCOLO_JSON, compactar, evento_grupo, mensaje_cambios,
+    mensaje_configuracion, mensaje_estado, mensaje_presencia, mensaje_roles_asignados,
+    mensaje_tu_rol,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Mensajes que envía el navegador (el resto se cuentan como 'otro')
+TIPOS_CLIENTE = {'jugador_unido', 'solicitar_estado', 'latido'}
+
+# Código de cierre del socket cuando la sala ya no existe: el cliente no reconecta
+CIERRE_SALA_INEXISTENTE = 4404
+
+
+def grupo_sala(codigo_sala):
+    """Nombre del grupo del channel layer con los sockets del lobby"""
+    return f'lobby_{codigo_sala}'
+
+
+def grupo_jugador(jugador_id):
+    """Grupo con los sockets de un jugador, para sus mensajes privados (su rol)"""
+    return f'jugador_{jugador_id}'
+
+
+# Lecturas de la BD en curso por sala: tras reiniciar el servidor todos los
+# sockets de una sala reconectan a la vez y basta con una sola lectura
+_lecturas_en_curso = {}
+
+
+async def leer_estado_sala(codigo_sala):
+    """Estado de la sala desde la caché; solo consulta la BD si no está cacheada"""
+    estado = cache.obtener(codigo_sala)
+    if estado is not None:
+        return estado
+    clave = (asyncio.get_running_loop(), codigo_sala)
+    lectura = _lecturas_en_curso.get(clave)
+    if lectura is None:
+        lectura = asyncio.ensure_future(
+            metricas.database_sync_to_async(obtener_estado)(codigo_sala)
+        )
+        _lecturas_en_curso[clave] = lectura
+        lectura.add_done_callback(lambda _: _lecturas_en_curso.pop(clave, None))
+    return await asyncio.shield(lectura)
+
+
+def _jugador_de_sesion(session, codigo_sala):
+    """Id del jugador de la sesión si es miembro de la sala"""
+    if session is None:
+        return None
+    membresia = session.get('membresia') or {}
+    if membresia.get('sala') != codigo_sala:
+        return None
+    return membresia.get('jugador')
+
+
+def _token_reanudar(scope):
+    """(epoca, version) del parámetro ?reanudar=EPOCA.VERSION, o None"""
+    valores = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('reanudar')
+    if not valores:
+        return None
+    epoca, _, version = valores[0].rpartition('.')
+    try:
+        return epoca, int(version)
+    except ValueError:
+        return None
+
+
+class _Pendiente:
+    __slots__ = ('tipos', 'primero', 'ultimo', 'eventos', 'tarea')
+
+    def __init__(self, ahora):
+        self.tipos = set()
+        self.primero = ahora
+        self.ultimo = ahora
+        self.eventos = 0
+        self.tarea = None
+
+
+class AgrupadorDifusiones:
+    """
+    Agrupa por sala las difusiones de jugadores y configuración originadas
+    en los sockets.
+
+    Los avisos que llegan dentro de `ventana` segundos del anterior se
+    juntan en una sola lectura del estado y un solo group_send; nunca se
+    espera más de `max_espera` segundos desde el primer aviso.
+
+    `reloj` y `dormir` son por defecto los del bucle de eventos; las
+    pruebas los sustituyen para avanzar el tiempo a mano.
+    """
+
+    def __init__(self, ventana=0.075, max_espera=0.25, reloj=None, dormir=None):
+        self.ventana = ventana
+        self.max_espera = max_espera
+        self._reloj = reloj
+        self._dormir = dormir or asyncio.sleep
+        self._pendientes = {}
+        self.estadisticas = {'eventos': 0, 'difusiones': 0, 'agrupados': 0}
+
+    async def programar(self, codigo_sala, tipo):
+        """Anota que `tipo` cambió en la sala y programa la difusión"""
+        self.estadisticas['eventos'] += 1
+        loop = asyncio.get_running_loop()
+        ahora = self._reloj() if self._reloj else loop.time()
+        pendiente = self._pendientes.get(codigo_sala)
+        if pendiente is None or pendiente.tarea is None or pendiente.tarea.done():
+            pendiente = self._pendientes[codigo_sala] = _Pendiente(ahora)
+        pendiente.tipos.add(tipo)
+        pendiente.ultimo = ahora
+        pendiente.eventos += 1
+
+        if self.ventana <= 0:
+            del self._pendientes[codigo_sala]
+            await self._difundir(codigo_sala, pendiente)
+        elif pendiente.tarea is None:
+            pendiente.tarea = loop.create_task(self._esperar(codigo_sala, pendiente))
+
+    async def _esperar(self, codigo_sala, pendiente):
+        reloj = self._reloj or asyncio.get_running_loop().time
+        while True:
+            limite = min(pendiente.ultimo + self.ventana, pendiente.primero + self.max_espera)
+            restante = limite - reloj()
+            if restante <= 0:
+                break
+            await self._dormir(restante)
+        if self._pendientes.get(codigo_sala) is pendiente:
+            del self._pendientes[codigo_sala]
+        try:
+            await self._difundir(codigo_sala, pendiente)
+        except Exception:
+            logger.exception('Error difundiendo cambios de la sala %s', codigo_sala)
+
+    async def _difundir(self, codigo_sala, pendiente):
+        self.estadisticas['difusiones'] += 1
+        self.estadisticas['agrupados'] += pendiente.eventos - 1
+
+        estado = await leer_estado_sala(codigo_sala)
+        if estado is None:
+            return
+        # Los mensajes se codifican aquí una vez para todos los sockets
+        textos = []
+        version = None
+        if 'jugadores' in pendiente.tipos:
+            pendientes = cache.tomar_pendientes(codigo_sala)
+            if pendientes is None:
+                textos.append(mensaje_estado(estado))
+            else:
+                estado_cache, eventos = pendientes
+                if eventos is None:
+                    textos.append(mensaje_estado(estado_cache))
+                elif eventos:
+                    textos.append(mensaje_cambios(estado_cache['epoca'], eventos))
+                if textos:
+                    version = (estado_cache['epoca'], estado_cache['version'])
+        if 'configuracion' in pendiente.tipos:
+            textos.append(mensaje_configuracion(estado['configuracion']))
+        if not textos:
+            return
+
+        await metricas.group_send(
+            get_channel_layer(), grupo_sala(codigo_sala), evento_grupo(*textos, jugadores=version),
+            '+'.join(sorted(pendiente.tipos))
+        )
+
+
+_config_difusion = getattr(settings, 'LOBBY_DIFUSION', {})
+agrupador = AgrupadorDifusiones(
+    ventana=_config_difusion.get('VENTANA', 0.075),
+    max_espera=_config_difusion.get('MAX_ESPERA', 0.25),
+)
+
+
+class CuboTokens:
+    """
+    Limitador de cubo de tokens: admite ráfagas de hasta `capacidad`
+    mensajes y, a la larga, `ritmo` mensajes por segundo
+    """
+
+    __slots__ = ('capacidad', 'ritmo', 'reloj', 'tokens', 'ultimo', '__weakref__')
+
+    def __init__(self, capacidad, ritmo, reloj=time.monotonic):
+        self.capacidad = capacidad
+        self.ritmo = ritmo
+        self.reloj = reloj
+        self.tokens = capacidad
+        self.ultimo = reloj()
+
+    def tomar(self, costo=1):
+        """Gasta `costo` tokens si los hay; False si hay que descartar el mensaje"""
+        ahora = self.reloj()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.ritmo)
+        self.ultimo = ahora
+        if self.tokens < costo:
+            return False
+        self.tokens -= costo
+        return True
+
+
+_config_limites = getattr(settings, 'LOBBY_LIMITES', {})
+MAX_BYTES_MENSAJE = _config_limites.get('MAX_BYTES', 2048)
+VENTANA_DUPLICADOS = _config_limites.get('DUPLICADOS', 1.0)
+
+
+def _excede_bytes(texto, limite):
+    """Si `texto` ocupa más de `limite` bytes en UTF-8 (de 1 a 4 por carácter)"""
+    if len(texto) > limite:
+        return True
+    if len(texto) * 4 <= limite:
+        return False
+    return len(texto.encode('utf-8', 'surrogatepass')) > limite
+
+# Mensajes que repetidos no cambian nada: un duplicado exacto dentro de
+# VENTANA_DUPLICADOS segundos se descarta sin gastar tokens
+TIPOS_IDEMPOTENTES = {'jugador_unido', 'solicitar_estado'}
+
+# Un cubo por sala compartido por sus sockets de este proceso; desaparece
+# con el último socket de la sala
+_cubos_sala = weakref.WeakValueDictionary()
+
+
+def _cubo_conexion():
+    return CuboTokens(
+        _config_limites.get('CONEXION_RAFAGA', 10), _config_limites.get('CONEXION_POR_SEGUNDO', 2)
+    )
+
+
+def _cubo_sala(codigo_sala):
+    cubo = _cubos_sala.get(codigo_sala)
+    if cubo is None:
+        cubo = _cubos_sala[codigo_sala] = CuboTokens(
+            _config_limites.get('SALA_RAFAGA', 50), _config_limites.get('SALA_POR_SEGUNDO', 20)
+        )
+    return cubo
+
+
+def elegir_subprotocolo(subprotocolos):
+    """El compacto si el navegador lo ofrece, si no el JSON (o ninguno)"""
+    for subprotocolo in (SUBPROTOCOLO_COMPACTO, SUBPROTOCOLO_JSON):
+        if subprotocolo in subprotocolos:
+            return subprotocolo
+    return None
+
 
 class LobbyConsumer(AsyncWebsocketConsumer):
+    # Protocolo compacto negociado al conectar (ver juego/protocolo.py)
+    compacto = False
+    # (epoca, version) de la lista de jugadores que ya tiene este socket
+    version_jugadores = None
+
+    @perfilado.medido
     async def connect(self):
         self.codigo_sala = self.scope['url_route']['kwargs']['codigo_sala']
-        self.room_group_name = f'lobby_{self.codigo_sala}'
+        self.room_group_name = grupo_sala(self.codigo_sala)
+        self.cubo = _cubo_conexion()
+        self.cubo_sala = _cubo_sala(self.codigo_sala)
+        self.ultimo_idempotente = (None, 0)
+        iniciar_escucha_invalidaciones()
 
         # Unirse al grupo de la sala
         await self.channel_layer.group_add(
@@ -14,101 +275,175 @@ class LobbyConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
-        
-        # Notificar a todos que un jugador conectó (para actualizar la lista)
-        jugadores = await self.get_jugadores()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'actualizar_jugadores',
-                'jugadores': jugadores
-            }
+        self.jugador_id = await metricas.database_sync_to_async(_jugador_de_sesion)(
+            self.scope.get('session'), self.codigo_sala
         )
 
+        if self.jugador_id is not None:
+            await self.channel_layer.group_add(grupo_jugador(self.jugador_id), self.channel_name)
+
+        # Si el navegador ofrece subprotocolos hay que elegir uno de ellos o
+        # el navegador cierra la conexión
+        subprotocolo = elegir_subprotocolo(self.scope.get('subprotocols') or [])
+        self.compacto = subprotocolo == SUBPROTOCOLO_COMPACTO
+        await self.accept(subprotocol=subprotocolo)
+        metricas.PROTOCOLOS.inc('compacto' if self.compacto else 'json')
+        metricas.socket_conectado(self.codigo_sala)
+
+        # Un cliente que reconecta con ?reanudar=EPOCA.VERSION recibe solo los
+        # eventos que se perdió; si ya no están, el estado completo
+        reanudar = _token_reanudar(self.scope)
+        eventos = cache.eventos_desde(self.codigo_sala, *reanudar) if reanudar else None
+        estado = await self.get_estado_sala()
+        if eventos is not None and estado is not None:
+            await self.enviar_cambios(estado['epoca'], eventos, reanudar[1])
+        else:
+            # El que conecta recibe el estado completo; el resto del grupo solo
+            # los cambios pendientes (por ejemplo, que este jugador se unió).
+            # reenviar() no le repite lo que ya tiene.
+            await self.enviar_estado(estado)
+            await agrupador.programar(self.codigo_sala, 'jugadores')
+
+        # Quien reconecta con la partida ya empezada puede haberse perdido su
+        # rol: se le reenvía desde el estado cacheado
+        if estado is not None and estado['partida_iniciada'] and self.jugador_id is not None:
+            for j in estado['jugadores']:
+                if j['id'] == self.jugador_id:
+                    await self.enviar(
+                        mensaje_roles_asignados(estado['jugadores']) if j['es_lider']
+                        else mensaje_tu_rol(j['rol'])
+                    )
+                    break
+
+        # Presencia: el que conecta recibe la de los demás una vez y su propio
+        # cambio le llega con el del resto de la sala
+        estados = presencia.registro.estados(self.codigo_sala)
+        if estados:
+            await self.enviar(mensaje_presencia(estados))
+        if self.jugador_id is not None:
+            presencia.registro.conectar(self.codigo_sala, self.jugador_id, self.channel_name)
+            await presencia.difundir_cambios(self.codigo_sala)
+            presencia.iniciar_revision()
+
+    @perfilado.medido
     async def disconnect(self, close_code):
+        if hasattr(self, 'codigo_sala'):
+            metricas.socket_desconectado(self.codigo_sala)
+        if getattr(self, 'jugador_id', None) is not None:
+            # La desconexión se difunde en la revisión periódica, pasada la
+            # gracia: si el jugador reconecta antes no se avisa a nadie
+            presencia.registro.desconectar(self.codigo_sala, self.jugador_id, self.channel_name)
+            await self.channel_layer.group_discard(grupo_jugador(self.jugador_id), self.channel_name)
         # Salir del grupo
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    def admitir(self, text_data):
+        """
+        El mensaje ya decodificado si se atiende, o None si se descarta
+        (contando el motivo): demasiado grande, binario, JSON inválido,
+        duplicado o por encima del límite de la conexión o de la sala
+        """
+        if text_data is None:
+            motivo = 'binario'
+        elif _excede_bytes(text_data, MAX_BYTES_MENSAJE):
+            # Antes de json.loads: un mensaje enorme no llega a decodificarse
+            motivo = 'tamano'
+        else:
+            try:
+                data = json.loads(text_data)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                motivo = 'invalido'
+            elif data.get('tipo') in TIPOS_IDEMPOTENTES and self._duplicado(text_data):
+                motivo = 'duplicado'
+            elif not self.cubo.tomar():
+                motivo = 'limite_conexion'
+            elif not self.cubo_sala.tomar():
+                motivo = 'limite_sala'
+            else:
+                return data
+        metricas.DESCARTADOS.inc(motivo)
+        return None
+
+    def _duplicado(self, text_data):
+        ahora = time.monotonic()
+        anterior, instante = self.ultimo_idempotente
+        if text_data == anterior and ahora - instante < VENTANA_DUPLICADOS:
+            return True
+        self.ultimo_idempotente = (text_data, ahora)
+        return False
+
+    @perfilado.medido
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.admitir(text_data)
+        if data is None:
+            return
         tipo = data.get('tipo')
+        metricas.MENSAJES.inc(tipo if tipo in TIPOS_CLIENTE else 'otro')
 
         if tipo == 'jugador_unido':
-            # Obtener lista actualizada de jugadores
-            jugadores = await self.get_jugadores()
-            
-            # Enviar a todos en el grupo
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'actualizar_jugadores',
-                    'jugadores': jugadores
-                }
-            )
-        
-        elif tipo == 'partida_iniciada':
-            # Notificar a todos que la partida comenzó
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'iniciar_juego',
-                    'codigo_sala': self.codigo_sala
-                }
-            )
+            # Difundir los cambios de jugadores que aún no se enviaron
+            await agrupador.programar(self.codigo_sala, 'jugadores')
         
-        elif tipo == 'configuracion_actualizada':
-            # Obtener configuración actualizada
-            configuracion = await self.get_configuracion_roles()
-            
-            # Enviar a todos en el grupo
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'actualizar_configuracion',
-                    'configuracion': configuracion
-                }
+        elif tipo == 'solicitar_estado':
+            # El cliente detectó un salto de versión: se le envían solo los
+            # eventos que le faltan o, si ya no están, el estado completo
+            eventos = cache.eventos_desde(
+                self.codigo_sala, data.get('epoca'), data.get('version')
             )
+            estado = await self.get_estado_sala()
+            if eventos is not None and estado is not None:
+                await self.enviar_cambios(estado['epoca'], eventos, data.get('version'))
+            else:
+                await self.enviar_estado(estado)
 
-    async def actualizar_jugadores(self, event):
-        # Enviar lista de jugadores al WebSocket
-        await self.send(text_data=json.dumps({
-            'tipo': 'actualizar_jugadores',
-            'jugadores': event['jugadores']
-        }))
-
-    async def iniciar_juego(self, event):
-        # Notificar que la partida ha comenzado
-        await self.send(text_data=json.dumps({
-            'tipo': 'partida_iniciada',
-            'codigo_sala': event['codigo_sala']
-        }))
-    
-    async def actualizar_configuracion(self, event):
-        # Enviar configuración actualizada al WebSocket
-        await self.send(text_data=json.dumps({
-            'tipo': 'configuracion_actualizada',
-            'configuracion': event['configuracion']
-        }))
-
-    @database_sync_to_async
-    def get_jugadores(self):
-        """Obtiene la lista de jugadores de la sala con sus roles"""
-        try:
-            sala = Sala.objects.get(codigo=self.codigo_sala)
-            jugadores = sala.jugadores.all().values('nombre', 'es_lider', 'rol')
-            return list(jugadores)
-        except Sala.DoesNotExist:
-            return []
-    
-    @database_sync_to_async
-    def get_configuracion_roles(self):
-        """Obtiene la configuración de roles de la sala"""
-        try:
-            sala = Sala.objects.get(codigo=self.codigo_sala)
-            return sala.configuracion_roles or sala.get_configuracion_default()
-        except Sala.DoesNotExist:
-            return {}
+        elif tipo == 'latido':
+            if self.jugador_id is not None:
+                presencia.registro.latido(self.codigo_sala, self.jugador_id, data.get('visible', True))
+                await presencia.difundir_cambios(self.codigo_sala)
+                await presencia.renovar_actividad(self.codigo_sala)
+
+    async def enviar(self, texto):
+        """Envía un mensaje del protocolo en el formato que negoció este socket"""
+        await self.send(text_data=compactar(texto) if self.compacto else texto)
+
+    async def reenviar(self, event):
+        # Los mensajes de grupo ya vienen codificados: se reenvían tal cual
+        textos = event['textos']
+        if 'jugadores' in event:
+            # El primero es la lista de jugadores en esa versión: si este socket
+            # ya la tiene (p. ej. el estado que recibió al conectar) se omite
+            epoca, version = event['jugadores']
+            if self.version_jugadores is not None and self.version_jugadores[0] == epoca \
+                    and self.version_jugadores[1] >= version:
+                textos = textos[1:]
+            else:
+                self.version_jugadores = (epoca, version)
+        for texto in textos:
+            await self.enviar(texto)
+        if 'enviado' in event:
+            metricas.ENTREGA.observar(time.time() - event['enviado'])
+
+    async def sala_cerrada(self, event):
+        # La limpieza periódica borró la sala (juego/limpieza.py)
+        await self.close(code=CIERRE_SALA_INEXISTENTE)
+
+    async def get_estado_sala(self):
+        return await leer_estado_sala(self.codigo_sala)
+
+    async def enviar_estado(self, estado):
+        """Envía a este socket el estado completo de la lista de jugadores"""
+        await self.enviar(mensaje_estado(estado))
+        if estado is not None and estado.get('epoca') is not None:
+            self.version_jugadores = (estado['epoca'], estado['version'])
+
+    async def enviar_cambios(self, epoca, eventos, version):
+        """Envía a este socket los eventos posteriores a `version` (si hay)"""
+        if eventos:
+            await self.enviar(mensaje_cambios(epoca, eventos))
+            version = eventos[-1]['version']
+        self.version_jugadores = (epoca, version)
@@ -0,0 +1,210 @@
+"""
+Limpieza periódica de salas inactivas y sesiones caducadas.
+
+Borra las salas cuya última actividad (Sala.actividad) es anterior a
+TTL_SALAS segundos, con sus jugadores; los jugadores que se quedaron sin
+sala y las sesiones caducadas. Se borra por lotes pequeños, cada uno en su
+propia transacción, para no retener el bloqueo de escritura de SQLite
+mientras otros jugadores se unen. De las salas borradas se descarta
+también el estado en memoria (caché de salas, también en otros procesos)
+y se cierran los sockets que siguieran en su grupo.
+
+Corre como tarea del servidor ASGI (LimpiezaPeriodica, en lobos/asgi.py)
+o a mano con `python manage.py limpiar_inactivas`.
+"""
+import asyncio
+import logging
+import random
+import time
+import weakref
+from datetime import timedelta
+from importlib import import_module
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.utils import timezone
+
+from . import cache_salas, metricas
+from .consumers import grupo_sala
+from .models import Jugador, Sala
+
+logger = logging.getLogger(__name__)
+
+_config = getattr(settings, 'LIMPIEZA', {})
+
+# Motores de sesión que guardan las sesiones en la tabla django_session
+MOTORES_SESION_BD = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+)
+
+
+def _cerrar_sockets(codigos):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    for codigo in codigos:
+        async_to_sync(channel_layer.group_send)(grupo_sala(codigo), {'type': 'sala.cerrada'})
+
+
+def borrar_lote_salas(salas, lote):
+    """
+    Borra, en una transacción, hasta `lote` salas del queryset `salas` con
+    sus jugadores; las quita de la caché y cierra sus sockets. Devuelve
+    (contadores, hay_mas).
+    """
+    with transaction.atomic():
+        elegidas = list(salas.order_by('id').values_list('id', 'codigo')[:lote])
+        if not elegidas:
+            return {}, False
+        # Se vuelve a aplicar el filtro: una sala que revivió entre medias no se borra
+        _, borrados = salas.filter(id__in=[id_sala for id_sala, _ in elegidas]).delete()
+        codigos = [codigo for _, codigo in elegidas]
+        cache_salas.registrar_salas_eliminadas(codigos)
+    _cerrar_sockets(codigos)
+    contadores = {
+        'salas': borrados.get('juego.Sala', 0),
+        'jugadores': borrados.get('juego.Jugador', 0),
+    }
+    return contadores, len(elegidas) == lote
+
+
+def _lote_por_clave(queryset, clave, lote):
+    with transaction.atomic():
+        claves = list(queryset.values_list('pk', flat=True)[:lote])
+        if not claves:
+            return {}, False
+        borrados, _ = queryset.model.objects.filter(pk__in=claves).delete()
+    return {clave: borrados}, len(claves) == lote
+
+
+def borrar_lote_jugadores_sin_sala(lote):
+    """Borra hasta `lote` jugadores sin sala; devuelve (contadores, hay_mas)"""
+    return _lote_por_clave(
+        Jugador.objects.filter(sala__isnull=True), 'jugadores_sin_sala', lote
+    )
+
+
+def _lote_sesiones(lote):
+    if settings.SESSION_ENGINE in MOTORES_SESION_BD:
+        return _lote_por_clave(
+            Session.objects.filter(expire_date__lt=timezone.now()), 'sesiones', lote
+        )
+    # Archivo o cookie: el propio motor sabe limpiar lo suyo (la cookie no guarda nada)
+    import_module(settings.SESSION_ENGINE).SessionStore.clear_expired()
+    return {}, False
+
+
+def _pasos(ttl, lote):
+    """Funciones que borran un lote cada una y devuelven (contadores, hay_mas)"""
+    limite = timezone.now() - timedelta(seconds=ttl)
+    return [
+        lambda: borrar_lote_salas(Sala.objects.filter(actividad__lt=limite), lote),
+        lambda: borrar_lote_jugadores_sin_sala(lote),
+        lambda: _lote_sesiones(lote),
+    ]
+
+
+def _parametros(ttl, lote, pausa):
+    return (
+        _config.get('TTL_SALAS', 6 * 3600) if ttl is None else ttl,
+        _config.get('LOTE', 200) if lote is None else lote,
+        _config.get('PAUSA', 0.05) if pausa is None else pausa,
+    )
+
+
+def _resumen(contadores, lotes, inicio):
+    resumen = {'salas': 0, 'jugadores': 0, 'jugadores_sin_sala': 0, 'sesiones': 0}
+    resumen.update(contadores)
+    resumen['lotes'] = lotes
+    resumen['segundos'] = round(time.perf_counter() - inicio, 3)
+    logger.info(
+        'Limpieza: %(salas)d salas, %(jugadores)d jugadores, '
+        '%(jugadores_sin_sala)d jugadores sin sala y %(sesiones)d sesiones '
+        'en %(lotes)d lotes (%(segundos).3f s)', resumen
+    )
+    return resumen
+
+
+def _sumar(total, contadores):
+    for clave, valor in contadores.items():
+        total[clave] = total.get(clave, 0) + valor
+
+
+def limpiar(ttl=None, lote=None, pausa=None):
+    """
+    Borra salas inactivas hace más de `ttl` segundos, jugadores sin sala y
+    sesiones caducadas, en lotes de `lote` filas con `pausa` segundos entre
+    lotes. Devuelve cuántas filas borró de cada tipo.
+    """
+    ttl, lote, pausa = _parametros(ttl, lote, pausa)
+    inicio = time.perf_counter()
+    total, lotes = {}, 0
+    for paso in _pasos(ttl, lote):
+        hay_mas = True
+        while hay_mas:
+            contadores, hay_mas = paso()
+            _sumar(total, contadores)
+            lotes += 1
+            if hay_mas:
+                time.sleep(pausa)
+    return _resumen(total, lotes, inicio)
+
+
+async def alimpiar(ttl=None, lote=None, pausa=None):
+    """Como `limpiar`, liberando el hilo de la base de datos entre lotes"""
+    ttl, lote, pausa = _parametros(ttl, lote, pausa)
+    inicio = time.perf_counter()
+    total, lotes = {}, 0
+    for paso in _pasos(ttl, lote):
+        hay_mas = True
+        while hay_mas:
+            contadores, hay_mas = await metricas.database_sync_to_async(paso)()
+            _sumar(total, contadores)
+            lotes += 1
+            if hay_mas:
+                await asyncio.sleep(pausa)
+    return _resumen(total, lotes, inicio)
+
+
+# Tarea periódica en el servidor ASGI
+
+_tareas = weakref.WeakKeyDictionary()
+
+
+async def _bucle(intervalo):
+    # Arranque escalonado para que varios procesos no limpien a la vez
+    await asyncio.sleep(random.uniform(0, intervalo))
+    while True:
+        try:
+            await alimpiar()
+        except Exception:
+            logger.exception('Error en la limpieza periódica')
+        await asyncio.sleep(intervalo)
+
+
+def iniciar_limpieza_periodica():
+    """Arranca, una vez por bucle de eventos, la limpieza cada INTERVALO segundos"""
+    if not _config.get('ACTIVA', True):
+        return
+    loop = asyncio.get_running_loop()
+    tarea = _tareas.get(loop)
+    if tarea is None or tarea.done():
+        _tareas[loop] = loop.create_task(_bucle(_config.get('INTERVALO', 300)))
+
+
+class LimpiezaPeriodica:
+    """
+    Aplicación ASGI que envuelve a otra y arranca la limpieza periódica con
+    la primera conexión (daphne no envía eventos de arranque 'lifespan').
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        iniciar_limpieza_periodica()
+        return await self.app(scope, receive, send)
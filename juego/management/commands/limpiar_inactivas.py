@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from juego.limpieza import limpiar
+
+
+class Command(BaseCommand):
+    help = 'Borra salas inactivas, jugadores sin sala y sesiones caducadas, por lotes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int,
+                            help='Segundos sin actividad tras los que se borra una sala '
+                                 '(por defecto LIMPIEZA["TTL_SALAS"])')
+        parser.add_argument('--lote', type=int, help='Filas por transacción')
+        parser.add_argument('--pausa', type=float, help='Segundos de espera entre lotes')
+
+    def handle(self, *args, **opciones):
+        resumen = limpiar(ttl=opciones['ttl'], lote=opciones['lote'], pausa=opciones['pausa'])
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Eliminadas {resumen['salas']} sala(s), {resumen['jugadores']} jugador(es), "
+            f"{resumen['jugadores_sin_sala']} jugador(es) sin sala y "
+            f"{resumen['sesiones']} sesión(es) en {resumen['lotes']} lote(s) "
+            f"({resumen['segundos']:.2f} s)"
+        ))
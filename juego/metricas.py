@@ -0,0 +1,302 @@
+"""
+Métricas del proceso en formato de texto de Prometheus.
+
+Contadores, indicadores e histogramas propios, sin dependencias: registrar
+una medida es sumar en un diccionario bajo un cerrojo, y todo lo que cuesta
+(recorrer las salas, contar en la base de datos, formatear) se hace solo
+cuando alguien consulta /interno/metricas/. Cada proceso de daphne expone
+sus propias métricas; Prometheus las agrega por instancia.
+
+Qué se mide:
+  - sockets del lobby conectados, por sala, conexiones y desconexiones;
+  - mensajes recibidos de los navegadores por `tipo`;
+  - difusiones: duración de group_send y tiempo hasta que cada socket
+    reenvía el mensaje (el evento lleva la hora de envío, ver protocolo);
+  - database_sync_to_async: espera hasta tener el hilo y tiempo de consulta;
+  - vistas: latencia y número de consultas por petición (MetricasVistas).
+"""
+import functools
+import ipaddress
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from channels.db import database_sync_to_async as _database_sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models import Count
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+
+_config = getattr(settings, 'METRICAS', {})
+
+BUCKETS_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50)
+BUCKETS_SOCKETS = (1, 2, 5, 10, 20, 50)
+
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ''
+    pares = ','.join(
+        '{}="{}"'.format(n, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for n, v in zip(nombres, valores)
+    )
+    return '{' + pares + '}'
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._cerrojo = threading.Lock()
+        registro.append(self)
+
+    def cabecera(self):
+        return [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+
+
+class Contador(_Metrica):
+    tipo = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._valores = {}
+
+    def inc(self, *etiquetas, cantidad=1):
+        with self._cerrojo:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + cantidad
+
+    def exponer(self):
+        lineas = self.cabecera()
+        with self._cerrojo:
+            valores = list(self._valores.items())
+        for etiquetas, valor in sorted(valores):
+            lineas.append(f'{self.nombre}{_etiquetas(self.etiquetas, etiquetas)} {valor}')
+        return lineas
+
+
+class Indicador(_Metrica):
+    """Valor que sube y baja; si se da `leer`, se calcula al exponer"""
+    tipo = 'gauge'
+
+    def __init__(self, *args, leer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._valor = 0
+        self._leer = leer
+
+    def sumar(self, cantidad):
+        with self._cerrojo:
+            self._valor += cantidad
+
+    def exponer(self):
+        lineas = self.cabecera()
+        valores = self._leer() if self._leer is not None else {(): self._valor}
+        for etiquetas, valor in sorted(valores.items()):
+            lineas.append(f'{self.nombre}{_etiquetas(self.etiquetas, etiquetas)} {valor}')
+        return lineas
+
+
+class Histograma(_Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, *args, buckets=BUCKETS_SEGUNDOS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observar(self, valor, *etiquetas):
+        with self._cerrojo:
+            self._anotar(self._series, valor, etiquetas)
+
+    def _anotar(self, series, valor, etiquetas):
+        serie = series.get(etiquetas)
+        if serie is None:
+            serie = series[etiquetas] = [[0] * (len(self.buckets) + 1), 0, 0]
+        # Cada bucket guarda solo lo suyo; se acumula al exponer
+        serie[0][bisect_left(self.buckets, valor)] += 1
+        serie[1] += valor
+        serie[2] += 1
+
+    def exponer(self):
+        lineas = self.cabecera()
+        with self._cerrojo:
+            series = [(e, (list(s[0]), s[1], s[2])) for e, s in self._series.items()]
+        nombres = self.etiquetas + ('le',)
+        for etiquetas, (cuentas, suma, total) in sorted(series):
+            acumulado = 0
+            for limite, cuenta in zip(self.buckets + ('+Inf',), cuentas):
+                acumulado += cuenta
+                lineas.append(
+                    f'{self.nombre}_bucket{_etiquetas(nombres, etiquetas + (limite,))} {acumulado}'
+                )
+            lineas.append(f'{self.nombre}_sum{_etiquetas(self.etiquetas, etiquetas)} {suma}')
+            lineas.append(f'{self.nombre}_count{_etiquetas(self.etiquetas, etiquetas)} {total}')
+        return lineas
+
+
+registro = []
+
+
+# Sockets del lobby
+
+_sockets_por_sala = {}
+_cerrojo_sockets = threading.Lock()
+
+
+def socket_conectado(codigo_sala):
+    with _cerrojo_sockets:
+        _sockets_por_sala[codigo_sala] = _sockets_por_sala.get(codigo_sala, 0) + 1
+    CONEXIONES.inc()
+
+
+def socket_desconectado(codigo_sala):
+    with _cerrojo_sockets:
+        restantes = _sockets_por_sala.get(codigo_sala, 0) - 1
+        if restantes > 0:
+            _sockets_por_sala[codigo_sala] = restantes
+        else:
+            _sockets_por_sala.pop(codigo_sala, None)
+    DESCONEXIONES.inc()
+
+
+def _leer_sockets():
+    with _cerrojo_sockets:
+        return {(): sum(_sockets_por_sala.values())}
+
+
+def _leer_salas_con_sockets():
+    with _cerrojo_sockets:
+        return {(): len(_sockets_por_sala)}
+
+
+def _leer_salas_bd():
+    from .models import Sala
+
+    filas = Sala.objects.values('partida_iniciada').annotate(total=Count('id'))
+    valores = {('true',): 0, ('false',): 0}
+    for fila in filas:
+        valores[('true' if fila['partida_iniciada'] else 'false',)] = fila['total']
+    return valores
+
+
+class _HistogramaSocketsPorSala(Histograma):
+    """Reparto de sockets por sala, calculado al exponer"""
+
+    def exponer(self):
+        with _cerrojo_sockets:
+            cantidades = list(_sockets_por_sala.values())
+        # Se calcula aparte y se sustituye de una vez: dos lecturas a la vez
+        # no pueden sumar cada una sobre la serie de la otra
+        series = {}
+        for cantidad in cantidades:
+            self._anotar(series, cantidad, ())
+        with self._cerrojo:
+            self._series = series
+        return super().exponer()
+
+
+SOCKETS = Indicador('lobos_sockets_conectados', 'Sockets del lobby abiertos en este proceso',
+                    leer=_leer_sockets)
+SALAS_CON_SOCKETS = Indicador('lobos_salas_con_sockets', 'Salas con algún socket en este proceso',
+                              leer=_leer_salas_con_sockets)
+SOCKETS_POR_SALA = _HistogramaSocketsPorSala('lobos_sockets_por_sala', 'Sockets abiertos por sala',
+                                             buckets=BUCKETS_SOCKETS)
+SALAS_BD = Indicador('lobos_salas', 'Salas en la base de datos', ('iniciada',), leer=_leer_salas_bd)
+CONEXIONES = Contador('lobos_conexiones_total', 'Sockets del lobby aceptados')
+DESCONEXIONES = Contador('lobos_desconexiones_total', 'Sockets del lobby cerrados')
+PROTOCOLOS = Contador('lobos_conexiones_protocolo_total', 'Sockets aceptados por protocolo',
+                      ('protocolo',))
+MENSAJES = Contador('lobos_mensajes_recibidos_total', 'Mensajes recibidos de los navegadores',
+                    ('tipo',))
+DESCARTADOS = Contador('lobos_mensajes_descartados_total',
+                       'Mensajes de los navegadores descartados (tamaño, límites, duplicados)',
+                       ('motivo',))
+DIFUSIONES = Contador('lobos_difusiones_total', 'Difusiones enviadas a un grupo de sala', ('tipo',))
+GROUP_SEND = Histograma('lobos_group_send_segundos', 'Duración de group_send', ('tipo',))
+ENTREGA = Histograma('lobos_difusion_entrega_segundos',
+                     'Desde group_send hasta que un socket reenvía el mensaje')
+BD_ESPERA = Histograma('lobos_bd_espera_segundos',
+                       'Espera de database_sync_to_async hasta tener el hilo')
+BD_DURACION = Histograma('lobos_bd_segundos', 'Duración de las funciones en database_sync_to_async')
+VISTAS = Histograma('lobos_vista_segundos', 'Latencia de las vistas', ('vista',))
+VISTAS_CONSULTAS = Histograma('lobos_vista_consultas', 'Consultas SQL por petición', ('vista',),
+                              buckets=BUCKETS_CONSULTAS)
+
+
+async def group_send(channel_layer, grupo, evento, tipo):
+    """channel_layer.group_send midiendo su duración"""
+    inicio = time.perf_counter()
+    await channel_layer.group_send(grupo, evento)
+    GROUP_SEND.observar(time.perf_counter() - inicio, tipo)
+    DIFUSIONES.inc(tipo)
+
+
+def database_sync_to_async(funcion):
+    """Como channels.db.database_sync_to_async, midiendo la espera y la duración"""
+    @functools.wraps(funcion)
+    async def envoltura(*args, **kwargs):
+        encolada = time.perf_counter()
+
+        def en_hilo():
+            inicio = time.perf_counter()
+            BD_ESPERA.observar(inicio - encolada)
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                BD_DURACION.observar(time.perf_counter() - inicio)
+        return await _database_sync_to_async(en_hilo)()
+    return envoltura
+
+
+# Consultas por petición: cada conexión nueva suma en el contador de la
+# petición en curso (una ContextVar, que también ven los hilos de sync_to_async)
+
+consultas_peticion = ContextVar('consultas_peticion', default=None)
+
+
+def _contar_consulta(execute, sql, params, many, context):
+    contador = consultas_peticion.get()
+    if contador is not None:
+        contador[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def _instalar_contador(sender, connection, **kwargs):
+    if _contar_consulta not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_contar_consulta)
+
+
+# Vista /interno/metricas/
+
+def _autorizado(request):
+    token = _config.get('TOKEN')
+    if token:
+        return request.headers.get('Authorization') == f'Bearer {token}'
+    # Sin token, solo en desarrollo y desde la propia máquina: detrás de un
+    # proxy inverso en el mismo host todas las peticiones llegan de 127.0.0.1
+    if not settings.DEBUG:
+        return False
+    try:
+        return ipaddress.ip_address(request.META.get('REMOTE_ADDR', '')).is_loopback
+    except ValueError:
+        return False
+
+
+def exponer():
+    """Todas las métricas en formato de texto de Prometheus"""
+    lineas = []
+    for metrica in registro:
+        lineas.extend(metrica.exponer())
+    return '\n'.join(lineas) + '\n'
+
+
+def vista(request):
+    if not _config.get('ACTIVAS', True) or not _autorizado(request):
+        raise Http404
+    return HttpResponse(exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
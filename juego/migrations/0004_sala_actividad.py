@@ -0,0 +1,24 @@
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def actividad_desde_creacion(apps, schema_editor):
+    Sala = apps.get_model('juego', 'Sala')
+    Sala.objects.update(actividad=F('creada_en'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('juego', '0003_sala_configuracion_roles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sala',
+            name='actividad',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(actividad_desde_creacion, migrations.RunPython.noop),
+    ]
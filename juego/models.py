@@ -1,23 +1,37 @@
+from datetime import timedelta
+
 from django.db import models
-import random
-import string
+from django.utils import timezone
 
 class Sala(models.Model):
     codigo = models.CharField(max_length=6, unique=True, db_index=True)
     partida_iniciada = models.BooleanField(default=False)
     creada_en = models.DateTimeField(auto_now_add=True)
     configuracion_roles = models.JSONField(default=dict)
+    # Última vez que alguien se unió, cambió la configuración, empezó la
+    # partida o envió un latido desde el lobby; la limpieza periódica borra
+    # las salas inactivas (juego/limpieza.py)
+    actividad = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    # Al unirse un jugador solo se actualiza `actividad` si pasó este tiempo
+    INTERVALO_ACTIVIDAD = timedelta(minutes=1)
     
     def __str__(self):
         return f"Sala {self.codigo}"
     
+    def actividad_desactualizada(self):
+        """True si conviene volver a guardar la actividad de la sala"""
+        return timezone.now() - self.actividad > self.INTERVALO_ACTIVIDAD
+    
     @staticmethod
     def generar_codigo():
-        """Genera un código único de 6 caracteres"""
-        while True:
-            codigo = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-            if not Sala.objects.filter(codigo=codigo).exists():
-                return codigo
+        """
+        Propone un código libre de 6 caracteres sin reservarlo: queda en uso
+        al guardar la sala. Para crear salas, mejor asignador.crear_sala(),
+        que reintenta si otro proceso se adelantó (ver juego/codigos.py).
+        """
+        from .codigos import asignador
+        return asignador.generar(reservar=False)
     
     def get_configuracion_default(self):
         """Configuración por defecto: 1 de cada rol"""
@@ -54,7 +68,8 @@ class Jugador(models.Model):
         ('vidente', 'Vidente'),
     ]
     
-    # Usamos la session_key de Django para identificar el navegador del usuario
+    # Usamos la session_key de Django (o una clave guardada en la sesión, con
+    # sesiones en cookie) para identificar el navegador del usuario
     session_id = models.CharField(max_length=40, unique=True)
     nombre = models.CharField(max_length=50) # El apodo que elijan para la partida
     rol = models.CharField(max_length=20, choices=ROLES, default='aldeano')
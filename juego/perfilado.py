@@ -0,0 +1,171 @@
+"""
+Presupuesto de consultas y tiempo por petición HTTP y por mensaje de
+WebSocket, para staging.
+
+Cada petición (PresupuestoPeticiones, en lobos/middleware.py) y cada
+manejador de LobbyConsumer decorado con `medido` anota las consultas SQL
+que hace, con su duración y la línea del proyecto que las lanzó. Si se
+pasa de MAX_CONSULTAS o de MAX_MS, se registra un aviso con las consultas
+agrupadas por SQL: la misma consulta repetida muchas veces es un N+1.
+Con MUESTREO = N, una de cada N mediciones se perfila con cProfile y el
+perfil se guarda en DIRECTORIO (se abre con `python -m pstats`).
+
+Desactivado por defecto (PERFILADO_ACTIVO): anotar la línea de cada
+consulta cuesta demasiado para producción.
+"""
+import cProfile
+import functools
+import itertools
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+_config = getattr(settings, 'PERFILADO', {})
+
+RAIZ = str(settings.BASE_DIR)
+
+# Módulos con envoltorios de consultas: no son quien lanza la consulta
+_ENVOLTORIOS = {__file__, os.path.join(os.path.dirname(__file__), 'metricas.py')}
+
+_medicion_actual = ContextVar('medicion_perfilado', default=None)
+_contador_muestreo = itertools.count(1)
+
+
+def activo():
+    return _config.get('ACTIVO', False)
+
+
+def _sitio():
+    """Primera línea del proyecto (fuera de este módulo) en la pila actual"""
+    marco = sys._getframe(2)
+    while marco is not None:
+        archivo = marco.f_code.co_filename
+        if (archivo.startswith(RAIZ) and archivo not in _ENVOLTORIOS
+                and 'site-packages' not in archivo):
+            return f'{os.path.relpath(archivo, RAIZ)}:{marco.f_lineno} ({marco.f_code.co_name})'
+        marco = marco.f_back
+    return '?'
+
+
+class Medicion:
+    """Consultas y tiempo de una petición o de un mensaje de WebSocket"""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.consultas = []
+        self.abierta = True
+        self.inicio = time.perf_counter()
+        self.duracion = None
+
+    def anotar(self, sql, duracion, sitio):
+        # Las tareas lanzadas durante la medición heredan el contexto: lo que
+        # consulten después de cerrarla ya no cuenta
+        if self.abierta:
+            self.consultas.append((sql, duracion, sitio))
+
+    def cerrar(self):
+        self.abierta = False
+        self.duracion = time.perf_counter() - self.inicio
+
+    def excedida(self):
+        return (len(self.consultas) > _config.get('MAX_CONSULTAS', 10)
+                or self.duracion * 1000 > _config.get('MAX_MS', 200))
+
+    def resumen(self):
+        """Consultas agrupadas por SQL, de más a menos repetidas"""
+        grupos = {}
+        for sql, duracion, sitio in self.consultas:
+            grupo = grupos.setdefault(sql, [0, 0.0, set()])
+            grupo[0] += 1
+            grupo[1] += duracion
+            grupo[2].add(sitio)
+        lineas = [
+            f'{self.nombre}: {len(self.consultas)} consultas '
+            f'(máx {_config.get("MAX_CONSULTAS", 10)}), {self.duracion * 1000:.1f} ms '
+            f'(máx {_config.get("MAX_MS", 200)})'
+        ]
+        for sql, (veces, duracion, sitios) in sorted(grupos.items(), key=lambda g: -g[1][0]):
+            lineas.append(
+                f'  ×{veces} {duracion * 1000:.1f} ms {sql[:300]} — {", ".join(sorted(sitios))}'
+            )
+        return '\n'.join(lineas)
+
+
+def _anotar_consulta(execute, sql, params, many, context):
+    medicion = _medicion_actual.get()
+    if medicion is None:
+        return execute(sql, params, many, context)
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        medicion.anotar(sql, time.perf_counter() - inicio, _sitio())
+
+
+@receiver(connection_created)
+def _instalar_anotador(sender, connection, **kwargs):
+    if _anotar_consulta not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_anotar_consulta)
+
+
+def _guardar_perfil(perfil, nombre):
+    directorio = _config.get('DIRECTORIO', '/tmp/lobos-perfiles')
+    os.makedirs(directorio, exist_ok=True)
+    limpio = ''.join(c if c.isalnum() else '_' for c in nombre)
+    ruta = os.path.join(directorio, f'{limpio}-{time.time_ns()}.prof')
+    perfil.dump_stats(ruta)
+    logger.info('Perfil de %s guardado en %s', nombre, ruta)
+
+
+@contextmanager
+def medir(nombre):
+    """
+    Mide el bloque; al salir avisa si se pasó del presupuesto. `nombre` se
+    puede cambiar en la medición devuelta (p. ej. al conocer la vista).
+    """
+    if not activo():
+        yield None
+        return
+    muestreo = _config.get('MUESTREO', 0)
+    perfil = None
+    if muestreo and next(_contador_muestreo) % muestreo == 0:
+        perfil = cProfile.Profile()
+    medicion = Medicion(nombre)
+    marca = _medicion_actual.set(medicion)
+    if perfil is not None:
+        try:
+            perfil.enable()
+        except ValueError:
+            # Otra medición de este hilo (otra tarea del bucle) ya está perfilando
+            perfil = None
+    try:
+        yield medicion
+    finally:
+        if perfil is not None:
+            perfil.disable()
+        medicion.cerrar()
+        _medicion_actual.reset(marca)
+        if medicion.excedida():
+            logger.warning('Presupuesto excedido en %s', medicion.resumen())
+        if perfil is not None:
+            _guardar_perfil(perfil, medicion.nombre)
+
+
+def medido(manejador):
+    """Decorador para los manejadores asíncronos de un consumer"""
+    @functools.wraps(manejador)
+    async def envoltura(self, *args, **kwargs):
+        if not activo():
+            return await manejador(self, *args, **kwargs)
+        with medir(f'{type(self).__name__}.{manejador.__name__}'):
+            return await manejador(self, *args, **kwargs)
+    return envoltura
@@ -0,0 +1,197 @@
+"""
+Presencia de los jugadores en el lobby (en memoria, por proceso).
+
+Cada socket del lobby se apunta al conectar con el jugador de su sesión y
+envía un latido cada LATIDO segundos con si la pestaña está visible. Un
+jugador está:
+  - 'conectado' si tiene algún socket abierto, la pestaña visible y envió
+    un latido hace menos de AUSENCIA segundos;
+  - 'ausente' si tiene socket pero la pestaña está oculta o dejó de enviar
+    latidos (conexión medio abierta);
+  - 'desconectado' si lleva GRACIA segundos sin ningún socket. La gracia
+    evita avisar de desconexiones que son solo una reconexión.
+
+Los cambios se difunden a la sala como un único mensaje 'presencia' por
+sala: al conectar o cambiar de visibilidad enseguida, y el resto (latidos
+perdidos, desconexiones) en una revisión cada REVISION segundos, que así
+agrupa las reconexiones masivas tras reiniciar el servidor.
+
+Los latidos renuevan además Sala.actividad (como mucho una vez por
+Sala.INTERVALO_ACTIVIDAD y sala en cada proceso), para que la limpieza
+periódica no cierre una partida en curso que ya nadie modifica.
+
+Con varios procesos cada uno conoce solo los sockets que atiende.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from . import metricas
+from .models import Sala
+from .protocolo import evento_grupo, mensaje_presencia
+
+logger = logging.getLogger(__name__)
+
+CONECTADO = 'conectado'
+AUSENTE = 'ausente'
+DESCONECTADO = 'desconectado'
+
+
+class _Presencia:
+    __slots__ = ('canales', 'ultimo_latido', 'visible', 'desconectado_desde', 'publicado')
+
+    def __init__(self, ahora):
+        self.canales = set()
+        self.ultimo_latido = ahora
+        self.visible = True
+        self.desconectado_desde = None
+        self.publicado = DESCONECTADO
+
+
+class RegistroPresencia:
+    def __init__(self, ausencia=40, gracia=5, reloj=time.monotonic):
+        self.ausencia = ausencia
+        self.gracia = gracia
+        self.reloj = reloj
+        self._salas = {}
+        self._lock = threading.Lock()
+
+    def _estado(self, presencia, ahora):
+        if not presencia.canales:
+            if ahora - presencia.desconectado_desde >= self.gracia:
+                return DESCONECTADO
+            return presencia.publicado
+        if not presencia.visible or ahora - presencia.ultimo_latido > self.ausencia:
+            return AUSENTE
+        return CONECTADO
+
+    def conectar(self, codigo, jugador_id, canal):
+        with self._lock:
+            ahora = self.reloj()
+            jugadores = self._salas.setdefault(codigo, {})
+            presencia = jugadores.get(jugador_id)
+            if presencia is None:
+                presencia = jugadores[jugador_id] = _Presencia(ahora)
+            presencia.canales.add(canal)
+            presencia.ultimo_latido = ahora
+            presencia.visible = True
+            presencia.desconectado_desde = None
+
+    def desconectar(self, codigo, jugador_id, canal):
+        with self._lock:
+            presencia = self._salas.get(codigo, {}).get(jugador_id)
+            if presencia is None:
+                return
+            presencia.canales.discard(canal)
+            if not presencia.canales:
+                presencia.desconectado_desde = self.reloj()
+
+    def latido(self, codigo, jugador_id, visible=True):
+        with self._lock:
+            presencia = self._salas.get(codigo, {}).get(jugador_id)
+            if presencia is not None:
+                presencia.ultimo_latido = self.reloj()
+                presencia.visible = bool(visible)
+
+    def estados(self, codigo):
+        """Estado actual de cada jugador conocido de la sala"""
+        with self._lock:
+            ahora = self.reloj()
+            return {
+                jugador_id: self._estado(presencia, ahora)
+                for jugador_id, presencia in self._salas.get(codigo, {}).items()
+            }
+
+    def tomar_cambios(self, codigo=None):
+        """
+        Cambios aún no difundidos, como {codigo: {jugador_id: estado}}, de
+        una sala o de todas. Los marca como difundidos y olvida a los
+        jugadores desconectados.
+        """
+        with self._lock:
+            ahora = self.reloj()
+            codigos = [codigo] if codigo is not None else list(self._salas)
+            cambios = {}
+            for codigo_sala in codigos:
+                jugadores = self._salas.get(codigo_sala)
+                if not jugadores:
+                    continue
+                for jugador_id, presencia in list(jugadores.items()):
+                    estado = self._estado(presencia, ahora)
+                    if estado != presencia.publicado:
+                        presencia.publicado = estado
+                        cambios.setdefault(codigo_sala, {})[jugador_id] = estado
+                    if estado == DESCONECTADO:
+                        del jugadores[jugador_id]
+                if not jugadores:
+                    del self._salas[codigo_sala]
+            return cambios
+
+
+_config = getattr(settings, 'LOBBY_PRESENCIA', {})
+INTERVALO_LATIDO = _config.get('LATIDO', 15)
+registro = RegistroPresencia(
+    ausencia=_config.get('AUSENCIA', 40),
+    gracia=_config.get('GRACIA', 5),
+)
+
+
+async def difundir_cambios(codigo=None):
+    """Envía a cada sala (o solo a `codigo`) sus cambios de presencia"""
+    from .consumers import grupo_sala
+
+    cambios = registro.tomar_cambios(codigo)
+    channel_layer = get_channel_layer()
+    for codigo_sala, estados in cambios.items():
+        await metricas.group_send(
+            channel_layer, grupo_sala(codigo_sala), evento_grupo(mensaje_presencia(estados)),
+            'presencia'
+        )
+
+
+# código de sala -> última renovación de su actividad desde este proceso
+_actividad_renovada = {}
+
+
+def _guardar_actividad(codigo):
+    Sala.objects.filter(codigo=codigo).update(actividad=timezone.now())
+
+
+async def renovar_actividad(codigo, reloj=time.monotonic):
+    """Renueva Sala.actividad por un latido, si no se hizo hace poco"""
+    ahora = reloj()
+    intervalo = Sala.INTERVALO_ACTIVIDAD.total_seconds()
+    ultima = _actividad_renovada.get(codigo)
+    if ultima is not None and ahora - ultima < intervalo:
+        return
+    _actividad_renovada[codigo] = ahora
+    if len(_actividad_renovada) > 10000:
+        for viejo in [c for c, t in _actividad_renovada.items() if ahora - t >= intervalo]:
+            del _actividad_renovada[viejo]
+    await metricas.database_sync_to_async(_guardar_actividad)(codigo)
+
+
+_revisiones = weakref.WeakKeyDictionary()
+
+
+async def _revisar(intervalo):
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await difundir_cambios()
+        except Exception:
+            logger.exception('Error revisando la presencia')
+
+
+def iniciar_revision():
+    """Arranca, una vez por bucle de eventos, la revisión periódica de presencia"""
+    loop = asyncio.get_running_loop()
+    tarea = _revisiones.get(loop)
+    if tarea is None or tarea.done():
+        _revisiones[loop] = loop.create_task(_revisar(_config.get('REVISION', 5)))
@@ -0,0 +1,225 @@
+"""
+Mensajes del protocolo del lobby (servidor -> navegador).
+
+Cada mensaje se codifica a texto una sola vez, en quien lo origina, y
+viaja ya codificado en el evento de grupo (`textos`); los consumers solo
+reenvían el texto a su WebSocket. Si está instalado `orjson` se usa para
+codificar, y si no, el módulo `json` estándar.
+
+Los navegadores que lo piden con el subprotocolo 'lobos.compacto.v1'
+reciben los mismos mensajes en forma compacta (ver `compactar`): listas
+posicionales en lugar de objetos con claves y roles, tipos y estados como
+enteros pequeños. El consumer transcodifica cada texto una vez por proceso.
+"""
+import functools
+import json
+import time
+
+from .models import Jugador
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
+
+NOMBRES_ROLES = dict(Jugador.ROLES)
+
+
+if orjson is not None:
+    def codificar(mensaje):
+        """Codifica un mensaje a texto JSON"""
+        return orjson.dumps(mensaje).decode()
+else:
+    def codificar(mensaje):
+        """Codifica un mensaje a texto JSON"""
+        return json.dumps(mensaje, separators=(',', ':'), ensure_ascii=False)
+
+
+def _sin_rol(jugador):
+    # El rol de cada jugador solo viaja en sus mensajes privados
+    return {campo: valor for campo, valor in jugador.items() if campo != 'rol'}
+
+
+def mensaje_estado(estado):
+    """Lista completa de jugadores (sin roles) con su época y versión"""
+    if estado is None:
+        return codificar({
+            'tipo': 'actualizar_jugadores', 'epoca': None, 'version': 0, 'jugadores': []
+        })
+    return codificar({
+        'tipo': 'actualizar_jugadores',
+        'epoca': estado['epoca'],
+        'version': estado['version'],
+        'jugadores': [_sin_rol(j) for j in estado['jugadores']],
+    })
+
+
+def mensaje_cambios(epoca, eventos):
+    """Eventos de jugadores (unido, salio, renombrado, lider), sin roles"""
+    eventos = [
+        {**ev, 'jugador': _sin_rol(ev['jugador'])} if 'jugador' in ev else ev
+        for ev in eventos
+    ]
+    return codificar({'tipo': 'cambios_jugadores', 'epoca': epoca, 'eventos': eventos})
+
+
+def mensaje_configuracion(configuracion):
+    return codificar({'tipo': 'configuracion_actualizada', 'configuracion': configuracion})
+
+
+def mensaje_presencia(estados):
+    """Presencia de jugadores: {id: 'conectado' | 'ausente' | 'desconectado'}"""
+    return codificar({
+        'tipo': 'presencia',
+        'jugadores': {str(jugador_id): estado for jugador_id, estado in estados.items()},
+    })
+
+
+def mensaje_partida_iniciada(codigo_sala):
+    return codificar({'tipo': 'partida_iniciada', 'codigo_sala': codigo_sala})
+
+
+def mensaje_tu_rol(rol):
+    """Rol de un jugador, solo para sus sockets"""
+    return codificar({'tipo': 'tu_rol', 'rol': rol, 'nombre_rol': NOMBRES_ROLES.get(rol, rol)})
+
+
+def mensaje_roles_asignados(jugadores):
+    """Roles de todos los jugadores salvo el líder, solo para el líder (narrador)"""
+    return codificar({'tipo': 'roles_asignados', 'jugadores': [
+        {'id': j['id'], 'nombre': j['nombre'], 'rol': j['rol'],
+         'nombre_rol': NOMBRES_ROLES.get(j['rol'], j['rol'])}
+        for j in jugadores if not j['es_lider']
+    ]})
+
+
+def mensajes_roles(jugadores):
+    """
+    Mensajes privados del inicio de la partida como {jugador_id: texto}.
+    `jugadores` son dicts con id, nombre, es_lider y rol.
+    """
+    texto_lider = mensaje_roles_asignados(jugadores)
+    return {
+        j['id']: texto_lider if j['es_lider'] else mensaje_tu_rol(j['rol'])
+        for j in jugadores
+    }
+
+
+def evento_grupo(*textos, jugadores=None):
+    """
+    Evento para group_send que lleva los mensajes ya codificados y la hora
+    de envío (para medir cuánto tarda en llegar a cada socket).
+
+    `jugadores` es (epoca, version) si el primer texto es la lista de
+    jugadores en esa versión, para no reenviarla a quien ya la tiene.
+    """
+    evento = {'type': 'reenviar', 'textos': list(textos), 'enviado': time.time()}
+    if jugadores is not None:
+        evento['jugadores'] = list(jugadores)
+    return evento
+
+
+# Protocolo compacto. Cada mensaje es una lista [tipo, ...campos]:
+#   actualizar_jugadores       [0, epoca, version, [[id, nombre, es_lider], ...]]
+#   cambios_jugadores          [1, epoca, [[evento, version, ...datos], ...]]
+#       unido [0, v, id, nombre, es_lider]; salio [1, v, id];
+#       renombrado [2, v, id, nombre]; lider [3, v, id]
+#   configuracion_actualizada  [2, [cantidad de cada rol en el orden de ROLES]]
+#   presencia                  [3, [id, estado, id, estado, ...]]
+#   partida_iniciada           [4]
+#   tu_rol                     [5, rol]
+#   roles_asignados            [6, [[id, nombre, rol], ...]]
+# es_lider va como 0/1 y rol, evento y estado como su índice en ROLES,
+# EVENTOS y PRESENCIAS. Los nombres de los roles los tiene el navegador.
+
+SUBPROTOCOLO_JSON = 'lobos.json.v1'
+SUBPROTOCOLO_COMPACTO = 'lobos.compacto.v1'
+
+TIPOS = [
+    'actualizar_jugadores', 'cambios_jugadores', 'configuracion_actualizada', 'presencia',
+    'partida_iniciada', 'tu_rol', 'roles_asignados',
+]
+ROLES = [clave for clave, _ in Jugador.ROLES]
+EVENTOS = ['unido', 'salio', 'renombrado', 'lider']
+PRESENCIAS = ['conectado', 'ausente', 'desconectado']
+
+_TIPO = {tipo: i for i, tipo in enumerate(TIPOS)}
+_ROL = {rol: i for i, rol in enumerate(ROLES)}
+_EVENTO = {evento: i for i, evento in enumerate(EVENTOS)}
+_PRESENCIA = {estado: i for i, estado in enumerate(PRESENCIAS)}
+
+
+def _compactar_evento(ev):
+    evento = ev['evento']
+    if evento == 'unido':
+        j = ev['jugador']
+        return [0, ev['version'], j['id'], j['nombre'], int(j['es_lider'])]
+    if evento == 'renombrado':
+        return [2, ev['version'], ev['id'], ev['nombre']]
+    return [_EVENTO[evento], ev['version'], ev['id']]
+
+
+def _compactar(mensaje):
+    tipo = mensaje['tipo']
+    if tipo == 'actualizar_jugadores':
+        return [0, mensaje['epoca'], mensaje['version'],
+                [[j['id'], j['nombre'], int(j['es_lider'])] for j in mensaje['jugadores']]]
+    if tipo == 'cambios_jugadores':
+        return [1, mensaje['epoca'], [_compactar_evento(ev) for ev in mensaje['eventos']]]
+    if tipo == 'configuracion_actualizada':
+        return [2, [mensaje['configuracion'].get(rol, 0) for rol in ROLES]]
+    if tipo == 'presencia':
+        return [3, [x for jugador_id, estado in mensaje['jugadores'].items()
+                    for x in (int(jugador_id), _PRESENCIA[estado])]]
+    if tipo == 'tu_rol':
+        return [5, _ROL[mensaje['rol']]]
+    if tipo == 'roles_asignados':
+        return [6, [[j['id'], j['nombre'], _ROL[j['rol']]] for j in mensaje['jugadores']]]
+    return [_TIPO[tipo]]
+
+
+@functools.lru_cache(maxsize=256)
+def compactar(texto):
+    """
+    Versión compacta de un mensaje ya codificado. Los mismos textos llegan
+    a todos los sockets de una sala: la caché hace que cada uno se
+    transcodifique una sola vez por proceso.
+    """
+    return codificar(_compactar(json.loads(texto)))
+
+
+def _expandir_evento(ev):
+    evento = EVENTOS[ev[0]]
+    if evento == 'unido':
+        return {'evento': evento, 'version': ev[1],
+                'jugador': {'id': ev[2], 'nombre': ev[3], 'es_lider': bool(ev[4])}}
+    if evento == 'renombrado':
+        return {'evento': evento, 'version': ev[1], 'id': ev[2], 'nombre': ev[3]}
+    return {'evento': evento, 'version': ev[1], 'id': ev[2]}
+
+
+def descompactar(texto):
+    """Inverso de `compactar` (como hace lobby.js): el mensaje como dict"""
+    m = json.loads(texto)
+    tipo = TIPOS[m[0]]
+    if tipo == 'actualizar_jugadores':
+        return {'tipo': tipo, 'epoca': m[1], 'version': m[2], 'jugadores': [
+            {'id': j[0], 'nombre': j[1], 'es_lider': bool(j[2])} for j in m[3]
+        ]}
+    if tipo == 'cambios_jugadores':
+        return {'tipo': tipo, 'epoca': m[1], 'eventos': [_expandir_evento(ev) for ev in m[2]]}
+    if tipo == 'configuracion_actualizada':
+        return {'tipo': tipo, 'configuracion': dict(zip(ROLES, m[1]))}
+    if tipo == 'presencia':
+        return {'tipo': tipo, 'jugadores': {
+            str(m[1][i]): PRESENCIAS[m[1][i + 1]] for i in range(0, len(m[1]), 2)
+        }}
+    if tipo == 'tu_rol':
+        rol = ROLES[m[1]]
+        return {'tipo': tipo, 'rol': rol, 'nombre_rol': NOMBRES_ROLES[rol]}
+    if tipo == 'roles_asignados':
+        return {'tipo': tipo, 'jugadores': [
+            {'id': j[0], 'nombre': j[1], 'rol': ROLES[j[2]], 'nombre_rol': NOMBRES_ROLES[ROLES[j[2]]]}
+            for j in m[1]
+        ]}
+    return {'tipo': tipo}
@@ -0,0 +1,165 @@
+"""
+Motor de reparto de roles.
+
+Construye la "bolsa de roles" a partir de la configuración de la sala
+(cacheada por configuración), la rellena con aldeanos si hay más
+jugadores que roles y elige un rol para cada jugador. Acepta una semilla
+para poder repetir un reparto (pruebas, revisar una partida) y permite
+repartir muchas salas de una vez, opcionalmente con NumPy.
+
+El motor se elige en settings.REPARTO_ROLES['MOTOR'].
+"""
+import random
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import Jugador
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - depende del entorno
+    numpy = None
+
+
+ROLES_VALIDOS = frozenset(clave for clave, _ in Jugador.ROLES)
+ROL_RELLENO = 'aldeano'
+# Máximos por rol (los mismos que los campos del lobby) y de la bolsa entera;
+# si hay más jugadores, el resto se rellena con aldeanos al repartir
+MAX_POR_ROL = {rol: 20 if rol == ROL_RELLENO else 10 for rol in ROLES_VALIDOS}
+MAX_ROLES = 50
+
+
+class ConfiguracionInvalida(ValueError):
+    """La configuración de roles tiene roles desconocidos o cantidades inválidas"""
+
+
+def validar_configuracion(configuracion):
+    """
+    Comprueba que todos los roles existan y las cantidades sean enteros
+    entre 0 y MAX_POR_ROL, sin pasar de MAX_ROLES en total
+    """
+    if not isinstance(configuracion, dict):
+        raise ConfiguracionInvalida('La configuración debe ser un objeto')
+    for rol, cantidad in configuracion.items():
+        if rol not in ROLES_VALIDOS:
+            raise ConfiguracionInvalida(f'Rol desconocido: {rol}')
+        if not isinstance(cantidad, int) or isinstance(cantidad, bool) or cantidad < 0:
+            raise ConfiguracionInvalida(f'Valor inválido para {rol}')
+        if cantidad > MAX_POR_ROL[rol]:
+            raise ConfiguracionInvalida(f'Como mucho {MAX_POR_ROL[rol]} de {rol}')
+    if sum(configuracion.values()) > MAX_ROLES:
+        raise ConfiguracionInvalida(f'Como mucho {MAX_ROLES} roles en total')
+    return configuracion
+
+
+def _clave(configuracion):
+    if not isinstance(configuracion, dict):
+        raise ConfiguracionInvalida('La configuración debe ser un objeto')
+    # True == 1 y 1.0 == 1 compartirían entrada de caché: se validan antes
+    if any(type(cantidad) is not int for cantidad in configuracion.values()):
+        validar_configuracion(configuracion)
+    return tuple(sorted(configuracion.items()))
+
+
+@lru_cache(maxsize=256)
+def _bolsa_compilada(clave):
+    # La validación queda cacheada junto con la bolsa
+    validar_configuracion(dict(clave))
+    bolsa = []
+    for rol, cantidad in clave:
+        bolsa.extend([rol] * cantidad)
+    return tuple(bolsa)
+
+
+def compilar_bolsa(configuracion, num_jugadores=0):
+    """
+    Bolsa de roles de la configuración (tupla, cacheada por configuración),
+    rellenada con aldeanos hasta `num_jugadores` si hace falta.
+    """
+    bolsa = _bolsa_compilada(_clave(configuracion))
+    if num_jugadores > len(bolsa):
+        bolsa = bolsa + (ROL_RELLENO,) * (num_jugadores - len(bolsa))
+    return bolsa
+
+
+class Repartidor:
+    """
+    Reparte roles a partir de una configuración.
+
+    `repartir(n, configuracion)` devuelve la lista de n roles en el orden en
+    que se asignan a los jugadores. Con la misma semilla, el mismo motor y
+    las mismas entradas, el resultado es siempre el mismo.
+    """
+
+    def __init__(self, semilla=None):
+        self.semilla = semilla
+
+    def repartir(self, num_jugadores, configuracion):
+        return self._elegir(compilar_bolsa(configuracion, num_jugadores), num_jugadores)
+
+    def repartir_lote(self, salas):
+        """Reparte varias salas: `salas` es una lista de (num_jugadores, configuracion)"""
+        return [self.repartir(n, configuracion) for n, configuracion in salas]
+
+    def _elegir(self, bolsa, num_jugadores):
+        raise NotImplementedError
+
+
+class RepartidorAleatorio(Repartidor):
+    """Motor por defecto, con el módulo random estándar"""
+
+    def __init__(self, semilla=None):
+        super().__init__(semilla)
+        self._rng = random.Random(semilla)
+
+    def _elegir(self, bolsa, num_jugadores):
+        if num_jugadores == len(bolsa):
+            roles = list(bolsa)
+            self._rng.shuffle(roles)
+            return roles
+        # Equivale a barajar toda la bolsa y quedarse con los primeros
+        return self._rng.sample(bolsa, num_jugadores)
+
+
+class RepartidorNumpy(Repartidor):
+    """
+    Motor con NumPy: en `repartir_lote` agrupa las salas con la misma
+    configuración y número de jugadores y las reparte en una operación.
+    """
+
+    def __init__(self, semilla=None):
+        if numpy is None:
+            raise ImportError('RepartidorNumpy necesita numpy instalado')
+        super().__init__(semilla)
+        self._rng = numpy.random.default_rng(semilla)
+
+    def _elegir(self, bolsa, num_jugadores):
+        indices = self._rng.permutation(len(bolsa))[:num_jugadores]
+        return [bolsa[i] for i in indices]
+
+    def repartir_lote(self, salas):
+        salas = list(salas)
+        resultado = [None] * len(salas)
+        grupos = {}
+        for i, (n, configuracion) in enumerate(salas):
+            grupos.setdefault((n, _clave(configuracion)), []).append(i)
+
+        for (n, clave), indices_salas in grupos.items():
+            bolsa = numpy.array(compilar_bolsa(dict(clave), n))
+            # Una permutación aleatoria por fila: argsort de claves uniformes
+            orden = numpy.argsort(self._rng.random((len(indices_salas), len(bolsa))), axis=1)
+            repartos = bolsa[orden[:, :n]].tolist()
+            for i, roles in zip(indices_salas, repartos):
+                resultado[i] = roles
+        return resultado
+
+
+def obtener_repartidor(semilla=None):
+    """Instancia el motor configurado en settings.REPARTO_ROLES"""
+    config = getattr(settings, 'REPARTO_ROLES', {})
+    motor = import_string(config.get('MOTOR', 'juego.reparto.RepartidorAleatorio'))
+    if semilla is None:
+        semilla = config.get('SEMILLA')
+    return motor(semilla)
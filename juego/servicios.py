@@ -0,0 +1,169 @@
+"""
+Lógica compartida por las vistas síncronas (views.py) y las asíncronas
+(views_async.py): sesión del jugador, contexto del lobby, reparto de
+roles y publicación de eventos en el channel layer.
+"""
+import asyncio
+import secrets
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import cache_salas, metricas, presencia
+from .consumers import grupo_jugador, grupo_sala
+from .models import Jugador, Sala
+from .protocolo import evento_grupo, mensaje_partida_iniciada, mensajes_roles
+from .reparto import ConfiguracionInvalida, obtener_repartidor
+
+
+def publicar_en_sala(codigo_sala, evento, tipo):
+    """
+    Envía `evento` al grupo del lobby cuando se confirme la transacción,
+    sin esperar a que el navegador del líder lo retransmita.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    transaction.on_commit(
+        lambda: async_to_sync(metricas.group_send)(
+            channel_layer, grupo_sala(codigo_sala), evento, tipo
+        ),
+        robust=True,
+    )
+
+
+def publicar_a_jugadores(mensajes, tipo):
+    """
+    Envía a cada jugador su mensaje privado ({jugador_id: texto}) cuando se
+    confirme la transacción, todos desde un mismo async_to_sync
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    async def enviar():
+        await asyncio.gather(*(
+            metricas.group_send(channel_layer, grupo_jugador(jugador_id), evento_grupo(texto), tipo)
+            for jugador_id, texto in mensajes.items()
+        ))
+    transaction.on_commit(async_to_sync(enviar), robust=True)
+
+
+def clave_sesion(request, crear=False):
+    """
+    Identificador estable del navegador (Jugador.session_id).
+
+    Es la session_key, salvo con sesiones en cookie firmada: ahí la clave
+    cambia con cada cambio de la sesión, así que se guarda una propia.
+    Con `crear` se genera si aún no existe; si no, puede devolver None.
+    """
+    if settings.SESSION_ENGINE == 'django.contrib.sessions.backends.signed_cookies':
+        clave = request.session.get('clave_jugador')
+        if clave is None and crear:
+            clave = request.session['clave_jugador'] = secrets.token_hex(20)
+        return clave
+    
+    if crear and not request.session.session_key:
+        request.session.create()
+    return request.session.session_key
+
+
+def buscar_jugador(estado, jugador_id):
+    return next((j for j in estado['jugadores'] if j['id'] == jugador_id), None)
+
+
+def jugador_de_membresia(request, estado, codigo_sala):
+    """Jugador de la sesión según la membresía guardada, si sigue en la sala"""
+    membresia = request.session.get('membresia') or {}
+    if membresia.get('sala') != codigo_sala:
+        return None
+    return buscar_jugador(estado, membresia['jugador'])
+
+
+def contexto_lobby(request, estado, codigo_sala, datos_jugador):
+    """Contexto de lobby.html armado con el estado cacheado, sin volver a leer la sala"""
+    configuracion = estado['configuracion'] or Sala().get_configuracion_default()
+    sala = Sala(
+        codigo=codigo_sala,
+        partida_iniciada=estado['partida_iniciada'],
+        configuracion_roles=configuracion,
+    )
+    jugador_actual = Jugador(**datos_jugador)
+    
+    # Generar URL completa para compartir
+    url_compartir = request.build_absolute_uri(f'/unirse/{sala.codigo}/')
+    
+    return {
+        'jugador': jugador_actual,
+        'todos_los_jugadores': [Jugador(**j) for j in estado['jugadores']],
+        'sala': sala,
+        'es_lider': jugador_actual.es_lider,
+        'configuracion_roles': configuracion,
+        'total_roles_configurados': sum(configuracion.values()),
+        'url_compartir': url_compartir,
+        # Datos para juego/js/lobby.js (json_script)
+        'datos_lobby': {
+            'codigo_sala': codigo_sala,
+            'es_lider': jugador_actual.es_lider,
+            'intervalo_latido': presencia.INTERVALO_LATIDO,
+            'configuracion': configuracion,
+            # Claves y nombres de los roles, en el orden del protocolo compacto
+            'roles': Jugador.ROLES,
+        },
+    }
+
+
+def repartir_roles(codigo_sala):
+    """
+    Marca la partida como iniciada y reparte los roles en una transacción.
+    Devuelve False si la partida ya había comenzado.
+    """
+    with transaction.atomic():
+        # Bloquear la sala para que dos clics en "empezar" no repartan a la vez
+        sala = Sala.objects.select_for_update().get(codigo=codigo_sala)
+        
+        # Reclamar el inicio: solo la primera petición cambia la fila. El
+        # filtro cubre también las bases de datos sin FOR UPDATE (SQLite).
+        if sala.partida_iniciada or not Sala.objects.filter(
+            pk=sala.pk, partida_iniciada=False
+        ).update(partida_iniciada=True, actividad=timezone.now()):
+            return False
+        sala.partida_iniciada = True
+        
+        # Todos los jugadores en una consulta: el líder solo recibe los roles
+        # de los demás (es el narrador)
+        todos = list(
+            Jugador.objects.filter(sala=sala).only('id', 'nombre', 'es_lider', 'rol').order_by('id')
+        )
+        jugadores = [j for j in todos if not j.es_lider]
+        
+        # Repartir la "bolsa de roles" de la configuración (rellenada con
+        # aldeanos si hay más jugadores que roles configurados)
+        configuracion = sala.configuracion_roles or sala.get_configuracion_default()
+        repartidor = obtener_repartidor()
+        try:
+            roles = repartidor.repartir(len(jugadores), configuracion)
+        except ConfiguracionInvalida:
+            # Configuración guardada antes de validar los roles: usar la de por defecto
+            roles = repartidor.repartir(len(jugadores), sala.get_configuracion_default())
+        
+        # Asignar roles SOLO a los jugadores no-líderes, en un único UPDATE
+        for jugador, rol in zip(jugadores, roles):
+            jugador.rol = rol
+        Jugador.objects.bulk_update(jugadores, ['rol'])
+        
+        # El líder no recibe rol (queda como 'aldeano' por defecto pero será tratado como narrador)
+        
+        cache_salas.registrar_partida_iniciada(sala, jugadores)
+        publicar_en_sala(
+            sala.codigo, evento_grupo(mensaje_partida_iniciada(sala.codigo)), 'partida_iniciada'
+        )
+        # Cada navegador recibe su rol por su socket y actualiza la página
+        # sin recargarla (antes toda la sala pedía el lobby a la vez)
+        publicar_a_jugadores(mensajes_roles([
+            {'id': j.id, 'nombre': j.nombre, 'es_lider': j.es_lider, 'rol': j.rol} for j in todos
+        ]), 'rol')
+    return True
@@ -0,0 +1,398 @@
+// Lobby: lista de jugadores, presencia y roles por WebSocket (ver lobby.html)
+
+const datosLobby = JSON.parse(document.getElementById('datos-lobby').textContent);
+const codigoSala = datosLobby.codigo_sala;
+const esLider = datosLobby.es_lider;
+const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+const wsBase = `${protocol}//${window.location.host}/ws/lobby/${codigoSala}/`;
+const intervaloLatido = datosLobby.intervalo_latido * 1000;
+
+let socket;
+let configuracionActual = datosLobby.configuracion;
+
+// Lista de jugadores versionada: el servidor envía el estado completo
+// al conectar y después solo eventos (unido, salio, renombrado, lider)
+let jugadoresActuales = [];
+let epocaJugadores = null;
+let versionJugadores = 0;
+// Presencia por id de jugador: 'conectado', 'ausente' o 'desconectado'
+let presenciaJugadores = {};
+// Reintentos seguidos sin recibir nada: la espera crece exponencialmente
+let reintentos = 0;
+let latido = null;
+
+function wsUrl() {
+    // Al reconectar se piden solo los eventos perdidos desde la versión conocida
+    if (epocaJugadores === null) return wsBase;
+    return `${wsBase}?reanudar=${encodeURIComponent(epocaJugadores)}.${versionJugadores}`;
+}
+
+function enviarLatido() {
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({
+            'tipo': 'latido',
+            'visible': document.visibilityState === 'visible'
+        }));
+    }
+}
+
+document.addEventListener('visibilitychange', enviarLatido);
+
+// Protocolo compacto (juego/protocolo.py): listas posicionales con tipos,
+// roles, eventos y estados como índices. Se pide en conexiones lentas o con
+// ahorro de datos, o con localStorage.protocolo = 'compacto'
+const SUBPROTOCOLO_COMPACTO = 'lobos.compacto.v1';
+const SUBPROTOCOLO_JSON = 'lobos.json.v1';
+const TIPOS = [
+    'actualizar_jugadores', 'cambios_jugadores', 'configuracion_actualizada', 'presencia',
+    'partida_iniciada', 'tu_rol', 'roles_asignados',
+];
+const ROLES = datosLobby.roles.map(([clave]) => clave);
+const NOMBRES_ROLES = Object.fromEntries(datosLobby.roles);
+const EVENTOS = ['unido', 'salio', 'renombrado', 'lider'];
+const PRESENCIAS = ['conectado', 'ausente', 'desconectado'];
+
+function usarProtocoloCompacto() {
+    const preferencia = window.localStorage && localStorage.getItem('protocolo');
+    if (preferencia) return preferencia === 'compacto';
+    const conexion = navigator.connection;
+    return Boolean(conexion && (conexion.saveData || /2g|3g/.test(conexion.effectiveType)));
+}
+
+function expandirEvento([evento, version, id, ...datos]) {
+    const ev = {evento: EVENTOS[evento], version: version};
+    if (ev.evento === 'unido') {
+        ev.jugador = {id: id, nombre: datos[0], es_lider: Boolean(datos[1])};
+    } else {
+        ev.id = id;
+        if (ev.evento === 'renombrado') ev.nombre = datos[0];
+    }
+    return ev;
+}
+
+function expandir(m) {
+    // Mensaje compacto -> el mismo objeto que enviaría el protocolo JSON
+    const tipo = TIPOS[m[0]];
+    if (tipo === 'actualizar_jugadores') {
+        return {tipo, epoca: m[1], version: m[2],
+                jugadores: m[3].map(([id, nombre, lider]) => ({id, nombre, es_lider: Boolean(lider)}))};
+    } else if (tipo === 'cambios_jugadores') {
+        return {tipo, epoca: m[1], eventos: m[2].map(expandirEvento)};
+    } else if (tipo === 'configuracion_actualizada') {
+        return {tipo, configuracion: Object.fromEntries(ROLES.map((rol, i) => [rol, m[1][i]]))};
+    } else if (tipo === 'presencia') {
+        const jugadores = {};
+        for (let i = 0; i < m[1].length; i += 2) jugadores[m[1][i]] = PRESENCIAS[m[1][i + 1]];
+        return {tipo, jugadores};
+    } else if (tipo === 'tu_rol') {
+        return {tipo, rol: ROLES[m[1]], nombre_rol: NOMBRES_ROLES[ROLES[m[1]]]};
+    } else if (tipo === 'roles_asignados') {
+        return {tipo, jugadores: m[1].map(([id, nombre, rol]) => (
+            {id, nombre, rol: ROLES[rol], nombre_rol: NOMBRES_ROLES[ROLES[rol]]}
+        ))};
+    }
+    return {tipo};
+}
+
+function conectarWebSocket() {
+    const subprotocolos = usarProtocoloCompacto()
+        ? [SUBPROTOCOLO_COMPACTO, SUBPROTOCOLO_JSON] : [SUBPROTOCOLO_JSON];
+    socket = new WebSocket(wsUrl(), subprotocolos);
+
+    socket.onopen = function(e) {
+        console.log('WebSocket conectado');
+        document.getElementById('estado-ws').textContent = 'En línea ✓';
+        document.getElementById('estado-ws').className = 'status-connected';
+        clearInterval(latido);
+        latido = setInterval(enviarLatido, intervaloLatido);
+        if (document.visibilityState !== 'visible') enviarLatido();
+    };
+
+    socket.onmessage = function(e) {
+        const mensaje = JSON.parse(e.data);
+        const data = socket.protocol === SUBPROTOCOLO_COMPACTO ? expandir(mensaje) : mensaje;
+        console.log('Mensaje recibido:', data);
+        reintentos = 0;
+
+        if (data.tipo === 'actualizar_jugadores') {
+            jugadoresActuales = data.jugadores;
+            epocaJugadores = data.epoca;
+            versionJugadores = data.version;
+            actualizarListaJugadores(jugadoresActuales);
+        } else if (data.tipo === 'cambios_jugadores') {
+            aplicarCambiosJugadores(data.epoca, data.eventos);
+        } else if (data.tipo === 'presencia') {
+            Object.assign(presenciaJugadores, data.jugadores);
+            actualizarListaJugadores(jugadoresActuales);
+        } else if (data.tipo === 'partida_iniciada') {
+            mostrarPartidaEnCurso();
+        } else if (data.tipo === 'tu_rol') {
+            document.getElementById('nombre-rol').textContent = data.nombre_rol;
+            const tuRol = document.getElementById('tu-rol');
+            if (tuRol) tuRol.textContent = data.nombre_rol;
+            mostrarPartidaEnCurso();
+        } else if (data.tipo === 'roles_asignados') {
+            mostrarRolesAsignados(data.jugadores);
+            mostrarPartidaEnCurso();
+        } else if (data.tipo === 'configuracion_actualizada') {
+            if (!esLider) {
+                actualizarVistaConfiguracion(data.configuracion);
+            }
+            configuracionActual = data.configuracion;
+        }
+    };
+
+    socket.onclose = function(e) {
+        console.log('WebSocket desconectado');
+        clearInterval(latido);
+        document.getElementById('estado-ws').className = 'status-disconnected';
+        if (e.code === 4404) {
+            // La sala se cerró por inactividad: no tiene sentido reconectar
+            document.getElementById('estado-ws').textContent = 'Sala cerrada ✗';
+            return;
+        }
+        document.getElementById('estado-ws').textContent = 'Desconectado ✗';
+        // Espera exponencial con variación aleatoria: tras reiniciar el
+        // servidor los clientes no reconectan todos a la vez
+        const espera = Math.min(30000, 1000 * 2 ** reintentos) * (0.5 + Math.random() / 2);
+        reintentos++;
+        setTimeout(conectarWebSocket, espera);
+    };
+
+    socket.onerror = function(error) {
+        console.error('Error en WebSocket:', error);
+    };
+}
+
+function aplicarCambiosJugadores(epoca, eventos) {
+    if (epoca !== epocaJugadores) {
+        solicitarEstado();
+        return;
+    }
+
+    for (const ev of eventos) {
+        if (ev.version <= versionJugadores) continue;  // Ya aplicado
+        if (ev.version !== versionJugadores + 1) {
+            // Nos perdimos algún evento: pedir lo que falta
+            solicitarEstado();
+            return;
+        }
+
+        if (ev.evento === 'unido') {
+            jugadoresActuales = jugadoresActuales.filter(j => j.id !== ev.jugador.id);
+            jugadoresActuales.push(ev.jugador);
+            jugadoresActuales.sort((a, b) => a.id - b.id);
+        } else if (ev.evento === 'salio') {
+            jugadoresActuales = jugadoresActuales.filter(j => j.id !== ev.id);
+        } else if (ev.evento === 'renombrado') {
+            jugadoresActuales.forEach(j => { if (j.id === ev.id) j.nombre = ev.nombre; });
+        } else if (ev.evento === 'lider') {
+            jugadoresActuales.forEach(j => { j.es_lider = (j.id === ev.id); });
+        }
+        versionJugadores = ev.version;
+    }
+    actualizarListaJugadores(jugadoresActuales);
+}
+
+function mostrarPartidaEnCurso() {
+    // Lo mismo que pintaría el lobby recargado con la partida iniciada
+    for (const id of ['seccion-compartir', 'seccion-configuracion']) {
+        const seccion = document.getElementById(id);
+        if (seccion) seccion.remove();
+    }
+    document.getElementById('rol-jugador').hidden = false;
+    document.getElementById('partida-en-curso').hidden = false;
+}
+
+function mostrarRolesAsignados(jugadores) {
+    const lista = document.getElementById('roles-asignados');
+    if (!lista) return;
+    lista.innerHTML = '';
+    jugadores.forEach(j => {
+        const fila = document.createElement('div');
+        fila.className = 'rol-asignado';
+        const nombre = document.createElement('span');
+        nombre.className = 'rol-asignado-nombre';
+        nombre.textContent = j.nombre;
+        const rol = document.createElement('span');
+        rol.className = 'rol-asignado-rol';
+        rol.textContent = j.nombre_rol;
+        fila.append(nombre, rol);
+        lista.appendChild(fila);
+    });
+}
+
+function solicitarEstado() {
+    socket.send(JSON.stringify({
+        'tipo': 'solicitar_estado',
+        'epoca': epocaJugadores,
+        'version': versionJugadores
+    }));
+}
+
+function actualizarListaJugadores(jugadores) {
+    const lista = document.getElementById('lista-jugadores');
+    const contador = document.getElementById('num-jugadores-total');
+
+    // Si el elemento no existe, no actualizar (probablemente la partida ya comenzó)
+    if (!lista) return;
+
+    // Contar solo jugadores que no son líderes (el líder/narrador no recibe rol)
+    const numJugadoresSinLider = jugadores.filter(j => !j.es_lider).length;
+    // El contador solo está en la configuración del líder antes de empezar
+    if (contador) contador.textContent = numJugadoresSinLider;
+    if (esLider) validarTotalRoles();
+
+    lista.innerHTML = '';
+    jugadores.forEach(j => {
+        const li = document.createElement('li');
+        const estado = presenciaJugadores[j.id];
+        if (estado) li.className = `presencia-${estado}`;
+        const punto = document.createElement('span');
+        punto.className = 'presencia';
+        punto.title = estado || '';
+        li.appendChild(punto);
+        const span = document.createElement('span');
+        span.textContent = j.nombre;
+        li.appendChild(span);
+
+        if (j.es_lider) {
+            const badge = document.createElement('span');
+            badge.className = 'leader-badge';
+            badge.textContent = '👑 LÍDER';
+            li.appendChild(badge);
+        }
+
+        lista.appendChild(li);
+    });
+}
+
+function actualizarVistaConfiguracion(configuracion) {
+    const resumen = document.getElementById('roles-resumen-readonly');
+    if (!resumen) return;
+
+    resumen.innerHTML = '';
+    for (const [rol, cantidad] of Object.entries(configuracion)) {
+        if (cantidad > 0) {
+            const badge = document.createElement('div');
+            badge.className = 'role-badge';
+            badge.innerHTML = `${rol.replace('_', ' ')}: <span>${cantidad}</span>`;
+            resumen.appendChild(badge);
+        }
+    }
+}
+
+function actualizarConfiguracion() {
+    if (!esLider) return;
+
+    const nuevaConfig = {
+        lobo: parseInt(document.getElementById('rol-lobo').value) || 0,
+        lobo_albino: parseInt(document.getElementById('rol-lobo_albino').value) || 0,
+        lobo_padre: parseInt(document.getElementById('rol-lobo_padre').value) || 0,
+        aldeano: parseInt(document.getElementById('rol-aldeano').value) || 0,
+        arbol: parseInt(document.getElementById('rol-arbol').value) || 0,
+        cupido: parseInt(document.getElementById('rol-cupido').value) || 0,
+        bruja: parseInt(document.getElementById('rol-bruja').value) || 0,
+        nina_salvaje: parseInt(document.getElementById('rol-nina_salvaje').value) || 0,
+        cazador: parseInt(document.getElementById('rol-cazador').value) || 0,
+        vidente: parseInt(document.getElementById('rol-vidente').value) || 0,
+    };
+
+    configuracionActual = nuevaConfig;
+    validarTotalRoles();
+
+    fetch(`/guardar_configuracion/${codigoSala}/`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': getCookie('csrftoken')
+        },
+        body: JSON.stringify({configuracion: nuevaConfig})
+    })
+    .then(response => response.json())
+    .then(data => {
+        // El servidor difunde la nueva configuración al resto de la sala
+        if (!data.success) console.error('Error:', data.error);
+    })
+    .catch(error => console.error('Error:', error));
+}
+
+function validarTotalRoles() {
+    const total = Object.values(configuracionActual).reduce((a, b) => a + b, 0);
+    const numJugadoresEl = document.getElementById('num-jugadores-total');
+
+    if (!numJugadoresEl) return; // Si el elemento no existe, salir
+
+    const numJugadores = parseInt(numJugadoresEl.textContent);
+    const totalElement = document.getElementById('total-roles');
+    const container = document.getElementById('total-roles-container');
+
+    if (totalElement) {
+        totalElement.textContent = total;
+    }
+
+    if (container) {
+        container.classList.remove('ok', 'warning');
+        container.classList.add(total <= numJugadores ? 'ok' : 'warning');
+    }
+}
+
+function iniciarPartida() {
+    if (!esLider) return;
+
+    const total = Object.values(configuracionActual).reduce((a, b) => a + b, 0);
+    const numJugadores = parseInt(document.getElementById('num-jugadores-total').textContent);
+
+    if (total > numJugadores) {
+        alert(`⚠️ Tienes ${total} roles pero solo ${numJugadores} jugadores`);
+        return;
+    }
+
+    const btn = document.getElementById('btn-empezar');
+    btn.disabled = true;
+    btn.textContent = 'Iniciando...';
+
+    fetch(`/iniciar_partida/${codigoSala}/`, {
+        method: 'GET',
+        headers: {'X-Requested-With': 'XMLHttpRequest'}
+    })
+    .then(response => {
+        // Si todo fue bien, el servidor avisa a la sala del inicio
+        if (!response.ok) {
+            btn.disabled = false;
+            btn.textContent = '🎲 EMPEZAR';
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        btn.disabled = false;
+        btn.textContent = '🎲 EMPEZAR';
+    });
+}
+
+function getCookie(name) {
+    let cookieValue = null;
+    if (document.cookie && document.cookie !== '') {
+        const cookies = document.cookie.split(';');
+        for (let i = 0; i < cookies.length; i++) {
+            const cookie = cookies[i].trim();
+            if (cookie.substring(0, name.length + 1) === (name + '=')) {
+                cookieValue = decodeURIComponent(cookie.substring(name.length + 1));
+                break;
+            }
+        }
+    }
+    return cookieValue;
+}
+
+function compartirWhatsApp() {
+    const input = document.getElementById('url-compartir');
+    const url = input.value;
+    const mensaje = encodeURIComponent('¡Únete a mi sala de Lobos! ' + url);
+    const whatsappUrl = `https://wa.me/?text=${mensaje}`;
+
+    window.open(whatsappUrl, '_blank');
+}
+
+conectarWebSocket();
+if (esLider) validarTotalRoles();
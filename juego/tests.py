@@ -1,3 +1,1263 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import (
+    cache_salas, capa_canales, codigos, consumers, limpieza, metricas, perfilado, presencia, protocolo,
+    reparto, routing, views_async,
+)
+from .models import Jugador, Sala
+from .reparto import ConfiguracionInvalida, RepartidorAleatorio, compilar_bolsa
+from .urls import patrones
+
+
+def crear_sala_con_jugadores(codigo, num_jugadores, cliente_lider=None):
+    """Crea una sala con un líder (la sesión del cliente dado) y N jugadores"""
+    sala = Sala.objects.create(codigo=codigo)
+    if cliente_lider is not None:
+        session = cliente_lider.session
+        session.save()
+        session_lider = session.session_key
+    else:
+        session_lider = f'{codigo}-lider'
+    Jugador.objects.create(session_id=session_lider, nombre='Líder', sala=sala, es_lider=True)
+    Jugador.objects.bulk_create([
+        Jugador(session_id=f'{codigo}-{i}', nombre=f'Jugador {i}', sala=sala)
+        for i in range(num_jugadores)
+    ])
+    return sala
+
+
+class RelojFalso:
+    """Reloj para las pruebas: el tiempo solo pasa al llamar a avanzar()"""
+
+    def __init__(self):
+        self.ahora = 1000.0
+        self._dormidos = []
+
+    def __call__(self):
+        return self.ahora
+
+    def avanzar(self, segundos):
+        self.ahora += segundos
+
+    async def dormir(self, segundos):
+        futuro = asyncio.get_running_loop().create_future()
+        self._dormidos.append((self.ahora + segundos, futuro))
+        await futuro
+
+    async def avanzar_async(self, segundos):
+        """Avanza el reloj despertando cada tarea dormida en su momento exacto"""
+        destino = self.ahora + segundos
+        while True:
+            await self._correr_tareas()
+            pendientes = [d for d in self._dormidos if d[0] <= destino]
+            if not pendientes:
+                break
+            limite, futuro = min(pendientes, key=lambda d: d[0])
+            self._dormidos.remove((limite, futuro))
+            self.ahora = max(self.ahora, limite)
+            futuro.set_result(None)
+        self.ahora = destino
+
+    async def _correr_tareas(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+
+def estado_de_prueba(*ids, lider=None):
+    """Estado de sala con los jugadores de `ids` para cargar en la caché"""
+    return {
+        'jugadores': [
+            {'id': i, 'nombre': f'J{i}', 'es_lider': i == lider, 'rol': 'aldeano'} for i in ids
+        ],
+        'configuracion': {},
+        'partida_iniciada': False,
+    }
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'x'))
+        self.creadas = 0
+
+    def _crear_salas(self, cantidad):
+        for _ in range(cantidad):
+            sala = Sala.objects.create(codigo=f'ADM{self.creadas:03d}')
+            for j in range(3):
+                Jugador.objects.create(session_id=f'adm-{self.creadas}-{j}', nombre=f'J{j}', sala=sala)
+            self.creadas += 1
+
+    def _consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        return len(consultas)
+
+    def test_consultas_constantes_al_crecer(self):
+        urls = [
+            '/admin/juego/sala/', '/admin/juego/sala/?o=5',
+            '/admin/juego/jugador/', '/admin/juego/jugador/?sala=adm001',
+        ]
+        self._crear_salas(3)
+        pocas = [self._consultas(url) for url in urls]
+        self._crear_salas(30)
+        self.assertEqual([self._consultas(url) for url in urls], pocas)
+
+    def test_filtro_por_codigo_de_sala(self):
+        self._crear_salas(2)
+        respuesta = self.client.get('/admin/juego/jugador/?sala=adm001&rol__exact=aldeano')
+        self.assertEqual(respuesta.context['cl'].result_count, 3)
+        self.assertContains(respuesta, 'name="rol__exact" value="aldeano"')
+        self.assertNotContains(respuesta, '?sala__id__exact=')
+
+    def test_editar_desde_el_admin_invalida_la_cache(self):
+        self._crear_salas(2)
+        cache_salas.cache.limpiar()
+        jugador = Jugador.objects.get(session_id='adm-0-0')
+        cache_salas.obtener_estado('ADM000')
+        cache_salas.obtener_estado('ADM001')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            respuesta = self.client.post(f'/admin/juego/jugador/{jugador.id}/change/', {
+                'session_id': jugador.session_id, 'nombre': 'Renombrado', 'rol': 'lobo',
+                'esta_vivo': 'on', 'sala': Sala.objects.get(codigo='ADM001').id,
+            })
+        self.assertEqual(respuesta.status_code, 302)
+        # Tanto la sala que deja como la sala a la que pasa se vuelven a leer
+        self.assertIsNone(cache_salas.cache.obtener('ADM000'))
+        self.assertIsNone(cache_salas.cache.obtener('ADM001'))
+        nombres = [j['nombre'] for j in cache_salas.obtener_estado('ADM001')['jugadores']]
+        self.assertIn('Renombrado', nombres)
+
+
+class AgrupadorDifusionesTests(SimpleTestCase):
+    def setUp(self):
+        self.reloj = RelojFalso()
+        self.agrupador = consumers.AgrupadorDifusiones(
+            ventana=0.1, max_espera=0.25, reloj=self.reloj, dormir=self.reloj.dormir
+        )
+        self.difusiones = []
+
+        async def difundir(codigo_sala, pendiente):
+            self.difusiones.append((codigo_sala, sorted(pendiente.tipos), round(self.reloj() - 1000, 3)))
+        self.agrupador._difundir = difundir
+
+    def test_agrupa_los_avisos_dentro_de_la_ventana(self):
+        async def escenario():
+            await self.agrupador.programar('A', 'jugadores')
+            await self.reloj.avanzar_async(0.05)
+            await self.agrupador.programar('A', 'configuracion')
+            await self.agrupador.programar('B', 'jugadores')
+            await self.reloj.avanzar_async(0.05)
+            self.assertEqual(self.difusiones, [])
+            await self.reloj.avanzar_async(0.05)
+            await self.reloj.avanzar_async(0.05)
+        async_to_sync(escenario)()
+
+        # La ventana cuenta desde el último aviso de cada sala
+        self.assertEqual(sorted(self.difusiones), [
+            ('A', ['configuracion', 'jugadores'], 0.15), ('B', ['jugadores'], 0.15),
+        ])
+
+    def test_nunca_espera_mas_de_max_espera(self):
+        async def escenario():
+            for _ in range(4):
+                await self.agrupador.programar('A', 'jugadores')
+                await self.reloj.avanzar_async(0.08)
+            await self.reloj.avanzar_async(0.01)
+            # Un aviso tras la difusión abre otra tanda
+            await self.agrupador.programar('A', 'jugadores')
+            await self.reloj.avanzar_async(0.1)
+        async_to_sync(escenario)()
+
+        self.assertEqual(self.difusiones, [('A', ['jugadores'], 0.25), ('A', ['jugadores'], 0.43)])
+
+    def test_contadores(self):
+        agrupador = consumers.AgrupadorDifusiones(ventana=0.1, reloj=self.reloj, dormir=self.reloj.dormir)
+
+        async def escenario():
+            for _ in range(3):
+                await agrupador.programar('A', 'jugadores')
+            await self.reloj.avanzar_async(0.1)
+            await agrupador.programar('A', 'configuracion')
+            await self.reloj.avanzar_async(0.1)
+
+        with mock.patch.object(consumers, 'leer_estado_sala', mock.AsyncMock(return_value=None)):
+            async_to_sync(escenario)()
+        self.assertEqual(agrupador.estadisticas, {'eventos': 4, 'difusiones': 2, 'agrupados': 2})
+
+
+class AsignadorCodigosTests(TestCase):
+    def test_reintenta_si_otro_proceso_tomo_el_codigo(self):
+        asignador = codigos.AsignadorCodigos()
+        asignador._cargar()
+        # Creada "por otro proceso": este no la tiene en memoria
+        Sala.objects.create(codigo='OCUP01')
+
+        with mock.patch.object(asignador._rng, 'choices', side_effect=[list('OCUP01'), list('LIBR01')]):
+            sala = asignador.crear_sala()
+
+        self.assertEqual(sala.codigo, 'LIBR01')
+        self.assertEqual(asignador.estadisticas['colisiones_bd'], 1)
+        self.assertEqual(asignador.estadisticas['asignaciones'], 1)
+
+    def test_sin_consultas_por_codigo(self):
+        asignador = codigos.AsignadorCodigos()
+        asignador._cargar()
+        with self.assertNumQueries(0):
+            generados = {asignador.generar() for _ in range(100)}
+        self.assertEqual(len(generados), 100)
+
+    def test_recicla_codigo_tras_la_cuarentena(self):
+        ahora = [0]
+        asignador = codigos.AsignadorCodigos(cuarentena=60, reloj=lambda: ahora[0])
+        sala = asignador.crear_sala()
+        asignador.liberar(sala.codigo)
+
+        self.assertNotEqual(asignador.generar(), sala.codigo)
+        ahora[0] = 61
+        self.assertEqual(asignador.generar(), sala.codigo)
+
+    def test_generar_codigo_no_reserva_hasta_crear_la_sala(self):
+        usados = codigos.asignador._cargar()
+        codigo = Sala.generar_codigo()
+        self.assertNotIn(codigo, usados)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Sala.objects.create(codigo=codigo)
+        self.assertIn(codigo, usados)
+
+    def test_suelta_el_codigo_si_la_sala_no_se_crea(self):
+        asignador = codigos.AsignadorCodigos()
+        asignador._cargar()
+        with mock.patch.object(asignador._rng, 'choices', return_value=list('FALLO1')), \
+                mock.patch.object(Sala.objects, 'create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                asignador.crear_sala()
+        self.assertNotIn('FALLO1', asignador._usados)
+
+    def test_borrar_sala_libera_su_codigo(self):
+        sala = codigos.asignador.crear_sala()
+        with self.captureOnCommitCallbacks(execute=True):
+            sala.delete()
+        self.assertIn(sala.codigo, [codigo for _, codigo in codigos.asignador._reciclados])
+
+
+class CacheSalasTests(SimpleTestCase):
+    def setUp(self):
+        self.reloj = RelojFalso()
+        self.cache = cache_salas.CacheSalas(max_salas=3, ttl=60, max_eventos=4, reloj=self.reloj)
+
+    def test_caduca_aunque_se_siga_leyendo(self):
+        self.cache.guardar('A', estado_de_prueba(1))
+        for _ in range(5):
+            self.reloj.avanzar(11)
+            self.assertIsNotNone(self.cache.obtener('A'))
+        self.reloj.avanzar(5)
+        self.assertIsNone(self.cache.obtener('A'))
+        self.assertEqual(len(self.cache), 0)
+
+        # Recargar abre un plazo nuevo
+        self.cache.guardar('A', estado_de_prueba(1))
+        self.reloj.avanzar(59)
+        self.assertIsNotNone(self.cache.obtener('A'))
+
+    def test_expulsa_la_menos_usada(self):
+        for codigo in 'ABC':
+            self.cache.guardar(codigo, estado_de_prueba())
+        self.cache.obtener('A')
+        self.cache.guardar('D', estado_de_prueba())
+
+        self.assertIsNone(self.cache.obtener('B'))
+        self.assertEqual([c for c in 'ACD' if self.cache.obtener(c)], ['A', 'C', 'D'])
+        self.assertEqual(self.cache.expulsiones, 1)
+        self.assertEqual((self.cache.aciertos, self.cache.fallos), (4, 1))
+
+    def test_guardar_purga_las_caducadas_en_cualquier_posicion(self):
+        self.cache.guardar('A', estado_de_prueba(1))
+        self.reloj.avanzar(30)
+        self.cache.guardar('B', estado_de_prueba(2))
+        # A pasa a ser la más reciente, pero caduca antes que B
+        self.cache.obtener('A')
+        self.reloj.avanzar(31)
+        self.cache.guardar('C', estado_de_prueba(3))
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.obtener('A'))
+        self.cache.registrar_jugador({'id': 1, 'nombre': 'J1', 'es_lider': False, 'rol': ''}, 'B')
+        self.assertEqual([j['id'] for j in self.cache.obtener('B')['jugadores']], [1, 2])
+
+    def test_descarta_lecturas_anteriores_a_una_escritura(self):
+        generacion = self.cache.generacion('A')
+        self.cache.invalidar('A')
+        self.assertFalse(self.cache.guardar('A', estado_de_prueba(1), generacion=generacion))
+        self.assertIsNone(self.cache.obtener('A'))
+        self.assertTrue(self.cache.guardar('A', estado_de_prueba(1), generacion=self.cache.generacion('A')))
+
+    def _jugador(self, id, nombre=None, es_lider=False):
+        return {'id': id, 'nombre': nombre or f'J{id}', 'es_lider': es_lider, 'rol': 'aldeano'}
+
+    def test_eventos_versionados(self):
+        self.cache.guardar('A', estado_de_prueba(1, 2, lider=1))
+        self.cache.guardar('B', estado_de_prueba())
+        epoca = self.cache.obtener('A')['epoca']
+
+        self.cache.registrar_jugador(self._jugador(3), 'A')
+        self.cache.registrar_jugador(self._jugador(2, 'Otro'), 'A')
+        self.cache.registrar_jugador(self._jugador(1, es_lider=True), 'B')
+
+        eventos = self.cache.eventos_desde('A', epoca, 0)
+        self.assertEqual([(e['version'], e['evento']) for e in eventos], [
+            (1, 'unido'), (2, 'renombrado'), (3, 'salio'), (4, 'lider'),
+        ])
+        self.assertEqual(eventos[3]['id'], None)
+        self.assertEqual([e['version'] for e in self.cache.eventos_desde('A', epoca, 2)], [3, 4])
+        self.assertEqual(self.cache.eventos_desde('A', epoca, 4), [])
+        self.assertEqual(self.cache.obtener('B')['lider'], 1)
+
+    def test_sin_historial_o_de_otra_epoca_pide_el_estado_completo(self):
+        self.cache.guardar('A', estado_de_prueba())
+        epoca = self.cache.obtener('A')['epoca']
+        for i in range(6):
+            self.cache.registrar_jugador(self._jugador(i), 'A')
+
+        # Solo quedan las 4 últimas versiones (3 a 6)
+        self.assertIsNone(self.cache.eventos_desde('A', epoca, 1))
+        self.assertEqual([e['version'] for e in self.cache.eventos_desde('A', epoca, 2)], [3, 4, 5, 6])
+        self.assertIsNone(self.cache.eventos_desde('A', epoca, 7))
+        self.assertIsNone(self.cache.eventos_desde('A', None, 6))
+        self.assertIsNone(self.cache.eventos_desde('X', epoca, 0))
+
+        # Recargar la sala abre otra época
+        self.cache.guardar('A', estado_de_prueba())
+        self.assertIsNone(self.cache.eventos_desde('A', epoca, 6))
+
+    def test_tomar_pendientes_en_orden_y_una_sola_vez(self):
+        self.assertIsNone(self.cache.tomar_pendientes('A'))
+        self.cache.guardar('A', estado_de_prueba(1))
+        estado, eventos = self.cache.tomar_pendientes('A')
+        # Lo primero que se difunde de una sala recién cargada es el estado completo
+        self.assertIsNone(eventos)
+        self.assertEqual(estado['version'], 0)
+
+        self.cache.registrar_jugador(self._jugador(2), 'A')
+        self.cache.registrar_jugador(self._jugador(2, 'Otro'), 'A')
+        estado, eventos = self.cache.tomar_pendientes('A')
+        self.assertEqual([e['evento'] for e in eventos], ['unido', 'renombrado'])
+        self.assertEqual(estado['version'], 2)
+        self.assertEqual(self.cache.tomar_pendientes('A')[1], [])
+
+        # Si el historial ya no llega hasta lo difundido, otra vez el estado completo
+        for i in range(3, 8):
+            self.cache.registrar_jugador(self._jugador(i), 'A')
+        self.assertIsNone(self.cache.tomar_pendientes('A')[1])
+
+
+class CapaCanalesCompartidaTests(SimpleTestCase):
+    """Capa de canales y broker de juego.capa_canales (group_send entre dos procesos)"""
+
+    RECEPTOR = textwrap.dedent('''
+        import asyncio, json, sys, time
+        from juego.capa_canales import CapaCanalesLocal
+
+        async def main():
+            capa = CapaCanalesLocal(url=sys.argv[1])
+            canal = await capa.new_channel()
+            await capa.group_add('lobby_TEST01', canal)
+            print('listo', flush=True)
+            for _ in range(int(sys.argv[2])):
+                mensaje = await capa.receive(canal)
+                print(json.dumps({'n': mensaje['n'], 'latencia': time.time() - mensaje['t']}), flush=True)
+
+        asyncio.run(main())
+    ''')
+
+    EMISOR = textwrap.dedent('''
+        import asyncio, sys, time
+        from juego.capa_canales import CapaCanalesLocal
+
+        async def main():
+            capa = CapaCanalesLocal(url=sys.argv[1])
+            for n in range(int(sys.argv[2])):
+                await capa.group_send('lobby_TEST01', {'type': 'prueba', 'n': n, 't': time.time()})
+                await asyncio.sleep(0.005)
+
+        asyncio.run(main())
+    ''')
+
+    MENSAJES = 50
+
+    def _proceso(self, *args):
+        return subprocess.Popen(
+            [sys.executable, *args], cwd=settings.BASE_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+
+    def test_group_send_entre_procesos(self):
+        with tempfile.TemporaryDirectory() as directorio:
+            socket = os.path.join(directorio, 'canales.sock')
+            url = f'unix://{socket}'
+            broker = self._proceso('-m', 'juego.capa_canales', '--socket', socket)
+            self.addCleanup(broker.kill)
+            for _ in range(100):
+                if os.path.exists(socket):
+                    break
+                time.sleep(0.05)
+
+            receptor = self._proceso('-c', self.RECEPTOR, url, str(self.MENSAJES))
+            self.addCleanup(receptor.kill)
+            self.assertEqual(receptor.stdout.readline().strip(), 'listo')
+
+            emisor = self._proceso('-c', self.EMISOR, url, str(self.MENSAJES))
+            self.assertEqual(emisor.wait(timeout=30), 0)
+            salida, _ = receptor.communicate(timeout=30)
+
+        recibidos = [json.loads(linea) for linea in salida.splitlines()]
+        self.assertEqual([r['n'] for r in recibidos], list(range(self.MENSAJES)))
+
+        latencias = sorted(r['latencia'] for r in recibidos)
+        self.assertLess(latencias[len(latencias) // 2], 0.1)
+        self.assertLess(latencias[-1], 1)
+
+    def test_descarta_mensajes_a_canales_cerrados(self):
+        capa = capa_canales.CapaCanalesLocal()
+        estado = capa_canales._EstadoBucle()
+        estado.colas['specific.abc!vivo'] = asyncio.Queue()
+        estado.grupos['lobby_TEST01'] = {'specific.abc!vivo', 'specific.abc!cerrado'}
+
+        for paquete in (
+            {'g': 'lobby_TEST01', 'm': {'type': 'prueba'}},
+            {'c': 'specific.abc!cerrado', 'm': {'type': 'prueba'}},
+        ):
+            capa._entregar(estado, capa_canales.serializar({**paquete, 'e': time.time() + 60}))
+
+        self.assertEqual(list(estado.colas), ['specific.abc!vivo'])
+        self.assertEqual(estado.colas['specific.abc!vivo'].qsize(), 1)
+
+    def test_broker_desconecta_suscriptores_lentos(self):
+        class Escritor:
+            def __init__(self, pendiente):
+                self.transport = mock.Mock(**{'get_write_buffer_size.return_value': pendiente})
+                self.escrito = []
+                self.cerrado = False
+
+            def write(self, datos):
+                self.escrito.append(datos)
+
+            def close(self):
+                self.cerrado = True
+
+        broker = capa_canales.BrokerCanales(max_pendiente=1000)
+        al_dia, lento = Escritor(0), Escritor(5000)
+        for escritor in (al_dia, lento):
+            broker._temas[escritor] = {b'tema', b'otro'}
+            broker._suscriptores[b'tema'].add(escritor)
+            broker._suscriptores[b'otro'].add(escritor)
+
+        with self.assertLogs('juego.capa_canales', 'WARNING'):
+            self.assertEqual(broker.publicar(b'tema', b'hola'), 1)
+        self.assertEqual(len(al_dia.escrito), 1)
+        self.assertEqual((lento.escrito, lento.cerrado), ([], True))
+        self.assertEqual(broker._suscriptores[b'otro'], {al_dia})
+        self.assertEqual(broker.desconectados, 1)
+
+
+class ConcurrenciaSQLiteTests(SimpleTestCase):
+    """Uniones simultáneas contra un archivo SQLite con el perfil de lobos.sqlite"""
+
+    UNIONES = textwrap.dedent('''
+        import json, sys, threading
+        from concurrent.futures import ThreadPoolExecutor
+        import django
+        django.setup()
+        from django.core.management import call_command
+        from django.db import connections
+        from django.test import Client
+        from django.test.utils import setup_test_environment
+        from juego import cache_salas
+        from juego.models import Jugador
+
+        setup_test_environment()
+        call_command('migrate', verbosity=0)
+        lider = Client()
+        lider.post('/', {'nombre': 'Líder'})
+        codigo = lider.post('/pre_lobby/', {'accion': 'crear'}).url.strip('/').split('/')[-1]
+
+        n = int(sys.argv[1])
+        barrera = threading.Barrier(n)
+
+        def unirse(i):
+            try:
+                barrera.wait()
+                cliente = Client()
+                cliente.post('/', {'nombre': f'Jugador {i}'})
+                cliente.get(f'/unirse/{codigo}/')
+                # Lectura del estado como la del LobbyConsumer
+                cache_salas.estado_desde_bd(codigo)
+            except Exception as e:
+                return repr(e)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(n) as ejecutor:
+            errores = [e for e in ejecutor.map(unirse, range(n)) if e]
+        print(json.dumps({
+            'errores': errores,
+            'jugadores': Jugador.objects.filter(sala__codigo=codigo).count(),
+        }))
+    ''')
+
+    UNIONES_SIMULTANEAS = 50
+
+    def test_uniones_simultaneas_sin_bloqueos(self):
+        with tempfile.TemporaryDirectory() as directorio:
+            entorno = dict(
+                os.environ,
+                DJANGO_SETTINGS_MODULE='lobos.settings',
+                DATABASE_URL=f"sqlite:///{os.path.join(directorio, 'lobos.sqlite3')}",
+                BD_LECTURA='True',
+                SESIONES='bd',
+            )
+            resultado = subprocess.run(
+                [sys.executable, '-W', 'ignore', '-c', self.UNIONES, str(self.UNIONES_SIMULTANEAS)],
+                cwd=settings.BASE_DIR, env=entorno, capture_output=True, text=True, timeout=120,
+            )
+        self.assertEqual(resultado.returncode, 0, resultado.stderr)
+        datos = json.loads(resultado.stdout.splitlines()[-1])
+        self.assertEqual(datos['errores'], [])
+        self.assertEqual(datos['jugadores'], self.UNIONES_SIMULTANEAS + 1)
+
+
+class DifusionCodificadaUnaVezTests(SimpleTestCase):
+    """Los mensajes de grupo se codifican una vez y se reenvían tal cual a cada socket"""
+
+    def setUp(self):
+        cache_salas.cache.limpiar()
+        self.addCleanup(cache_salas.cache.limpiar)
+        cache_salas.cache.guardar('FANOUT', estado_de_prueba(1, lider=1))
+        cache_salas.cache.tomar_pendientes('FANOUT')
+
+    def test_evento_grupo(self):
+        evento = protocolo.evento_grupo('a', 'b')
+        self.assertEqual((evento['type'], evento['textos']), ('reenviar', ['a', 'b']))
+        self.assertLessEqual(evento['enviado'], time.time())
+
+    def test_un_solo_codificado_para_toda_la_sala(self):
+        agrupador = consumers.AgrupadorDifusiones(ventana=0)
+
+        async def escenario():
+            comunicadores = [
+                WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/lobby/FANOUT/')
+                for _ in range(3)
+            ]
+            for comunicador in comunicadores:
+                await comunicador.connect()
+            for comunicador in comunicadores:
+                while not await comunicador.receive_nothing(0.2):
+                    await comunicador.receive_from()
+
+            cache_salas.cache.registrar_jugador(
+                {'id': 2, 'nombre': 'Nuevo', 'es_lider': False, 'rol': 'aldeano'}, 'FANOUT'
+            )
+            with mock.patch.object(protocolo, 'codificar', wraps=protocolo.codificar) as codificar:
+                await agrupador.programar('FANOUT', 'jugadores')
+                recibidos = [await c.receive_from() for c in comunicadores]
+            for comunicador in comunicadores:
+                await comunicador.disconnect()
+            return codificar.call_count, recibidos
+
+        codificados, recibidos = async_to_sync(escenario)()
+        self.assertEqual(codificados, 1)
+        self.assertEqual(len(set(recibidos)), 1)
+        self.assertEqual(json.loads(recibidos[0])['eventos'][0]['evento'], 'unido')
+
+
+class GestionarTests(TestCase):
+    def setUp(self):
+        import gestionar
+        self.gestionar = gestionar
+        for i in range(3):
+            sala = Sala.objects.create(codigo=f'GES00{i}', partida_iniciada=i == 0)
+            for j in range(2):
+                Jugador.objects.create(session_id=f'ges-{i}-{j}', nombre=f'J{j}', sala=sala)
+
+    def test_listados_con_una_consulta(self):
+        for formato in ('texto', 'json', 'csv'):
+            with self.assertNumQueries(1):
+                self.gestionar.listar_salas(formato=formato, lote=2, destino=io.StringIO())
+            with self.assertNumQueries(1):
+                self.gestionar.listar_jugadores(formato=formato, lote=2, destino=io.StringIO())
+
+        salida = io.StringIO()
+        self.gestionar.listar_salas(self.gestionar.filtrar_salas(iniciadas=False), formato='json', destino=salida)
+        salas = json.loads(salida.getvalue())
+        self.assertEqual([s['codigo'] for s in salas], ['GES001', 'GES002'])
+        self.assertEqual({s['num_jugadores'] for s in salas}, {2})
+
+    def test_limpiar_por_lotes_respeta_los_filtros(self):
+        with mock.patch('sys.stdout'), mock.patch('sys.stderr'):
+            self.gestionar.limpiar_todo(self.gestionar.filtrar_salas(iniciadas=False), lote=1)
+        self.assertEqual(list(Sala.objects.values_list('codigo', flat=True)), ['GES000'])
+        self.assertEqual(Jugador.objects.count(), 2)
+
+    def test_listar_sala_inexistente_escribe_en_stderr(self):
+        salida, errores = io.StringIO(), io.StringIO()
+        with mock.patch('sys.stdout', salida), mock.patch('sys.stderr', errores):
+            self.assertFalse(self.gestionar.listar_jugadores('NOEXISTE', formato='json', destino=salida))
+            self.assertFalse(self.gestionar.eliminar_sala('NOEXISTE'))
+        self.assertEqual(salida.getvalue(), '')
+        self.assertIn('NOEXISTE', errores.getvalue())
+
+    def test_resetear_invalida_la_cache(self):
+        cache_salas.cache.limpiar()
+        Jugador.objects.filter(sala__codigo='GES000').update(rol='lobo')
+        self.assertTrue(cache_salas.obtener_estado('GES000')['partida_iniciada'])
+
+        with mock.patch('sys.stdout'), self.captureOnCommitCallbacks(execute=True):
+            self.gestionar.resetear_sala('GES000')
+
+        estado = cache_salas.obtener_estado('GES000')
+        self.assertFalse(estado['partida_iniciada'])
+        self.assertEqual({j['rol'] for j in estado['jugadores']}, {'aldeano'})
+
+
+class IniciarPartidaTests(TestCase):
+    def setUp(self):
+        # Los on_commit no se ejecutan en TestCase: la caché no vería las escrituras
+        cache_salas.cache.limpiar()
+        self.client = Client()
+
+    def _iniciar(self, sala):
+        return self.client.get(f'/iniciar_partida/{sala.codigo}/')
+
+    def test_reparte_segun_configuracion(self):
+        sala = crear_sala_con_jugadores('CONF01', 5, self.client)
+        sala.configuracion_roles = {'lobo': 2, 'vidente': 1}
+        sala.save()
+
+        self._iniciar(sala)
+
+        sala.refresh_from_db()
+        self.assertTrue(sala.partida_iniciada)
+        roles = sorted(sala.jugadores.filter(es_lider=False).values_list('rol', flat=True))
+        self.assertEqual(roles, ['aldeano', 'aldeano', 'lobo', 'lobo', 'vidente'])
+
+    def test_segundo_inicio_no_vuelve_a_repartir(self):
+        sala = crear_sala_con_jugadores('IDEM01', 20, self.client)
+        self._iniciar(sala)
+        roles = list(sala.jugadores.values_list('id', 'rol'))
+
+        with CaptureQueriesContext(connection) as consultas:
+            self._iniciar(sala)
+
+        self.assertEqual(list(sala.jugadores.values_list('id', 'rol')), roles)
+        self.assertFalse(any(q['sql'].startswith('UPDATE "juego_jugador"') for q in consultas))
+
+    def test_cada_jugador_recibe_su_rol_por_su_socket(self):
+        sala = crear_sala_con_jugadores('ROLES1', 4, self.client)
+        enviados = {}
+
+        async def group_send(channel_layer, grupo, evento, tipo):
+            enviados[grupo] = [json.loads(texto) for texto in evento['textos']]
+
+        with mock.patch.object(metricas, 'group_send', group_send), \
+                self.captureOnCommitCallbacks(execute=True):
+            respuesta = self.client.get(
+                f'/iniciar_partida/{sala.codigo}/', HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+
+        # Con fetch no se sigue la redirección: no se renderiza el lobby
+        self.assertEqual(respuesta.status_code, 204)
+        self.assertEqual(enviados[consumers.grupo_sala(sala.codigo)][0]['tipo'], 'partida_iniciada')
+        lider = sala.jugadores.get(es_lider=True)
+        for jugador in sala.jugadores.filter(es_lider=False):
+            self.assertEqual(
+                enviados[consumers.grupo_jugador(jugador.id)],
+                [{'tipo': 'tu_rol', 'rol': jugador.rol, 'nombre_rol': jugador.get_rol_display()}],
+            )
+        narrador = enviados[consumers.grupo_jugador(lider.id)][0]
+        self.assertEqual(narrador['tipo'], 'roles_asignados')
+        self.assertEqual(len(narrador['jugadores']), 4)
+
+        # La lista de jugadores que recibe toda la sala no lleva los roles
+        estado = json.loads(protocolo.mensaje_estado(cache_salas.obtener_estado(sala.codigo)))
+        self.assertTrue(all('rol' not in j for j in estado['jugadores']))
+
+    def test_ningun_mensaje_de_sala_lleva_roles(self):
+        sala = crear_sala_con_jugadores('ROLES2', 3, self.client)
+        estado = cache_salas.obtener_estado(sala.codigo)
+        cache_salas.cache.tomar_pendientes(sala.codigo)
+        # Un jugador que ya tenía rol en otra partida entra en esta sala
+        nuevo = {'id': 9999, 'nombre': 'Lobo', 'es_lider': False, 'rol': 'lobo'}
+        cache_salas.cache.registrar_jugador(nuevo, sala.codigo)
+        enviados = []
+
+        async def group_send(channel_layer, grupo, evento, tipo):
+            enviados.extend(evento['textos'])
+
+        agrupador = consumers.AgrupadorDifusiones(ventana=0)
+        with mock.patch.object(metricas, 'group_send', group_send):
+            async_to_sync(agrupador.programar)(sala.codigo, 'jugadores')
+
+        # Lo que se difunde, lo que se reenvía al reanudar y el estado completo
+        eventos = cache_salas.cache.eventos_desde(sala.codigo, estado['epoca'], estado['version'])
+        enviados.append(protocolo.mensaje_cambios(estado['epoca'], eventos))
+        enviados.append(protocolo.mensaje_estado(cache_salas.obtener_estado(sala.codigo)))
+        self.assertEqual(json.loads(enviados[0])['tipo'], 'cambios_jugadores')
+        for texto in enviados:
+            self.assertNotIn('"rol"', texto.replace(' ', ''))
+        # Tampoco un evento que llegue con rol sale por el protocolo
+        texto = protocolo.mensaje_cambios(1, [{'evento': 'unido', 'version': 1, 'jugador': nuevo}])
+        self.assertNotIn('rol', json.loads(texto)['eventos'][0]['jugador'])
+
+    def test_consultas_y_tiempo_por_numero_de_jugadores(self):
+        """El reparto hace un único bulk_update (por lotes) sin importar N"""
+        # SQLite limita los parámetros por consulta: bulk_update parte en lotes
+        lote = connection.ops.bulk_batch_size(['pk', 'pk', 'rol'], [None] * 1000)
+        for num_jugadores in (10, 100, 1000):
+            cliente = Client()
+            sala = crear_sala_con_jugadores(f'N{num_jugadores}', num_jugadores, cliente)
+            inicio = time.perf_counter()
+            # Sala y jugadores a la caché, sesión, membresía, la transacción
+            # del reparto (con un UPDATE por lote) y el guardado de la sesión
+            with self.assertNumQueries(12 + -(-num_jugadores // lote)):
+                cliente.get(f'/iniciar_partida/{sala.codigo}/')
+            self.assertLess(time.perf_counter() - inicio, 2)
+            self.assertFalse(sala.jugadores.filter(es_lider=False, rol='').exists())
+
+
+class LimitesMensajesTests(SimpleTestCase):
+    """Mensajes del navegador que LobbyConsumer descarta antes de atenderlos"""
+
+    def setUp(self):
+        self.ahora = 0
+        self.consumidor = consumers.LobbyConsumer()
+        self.consumidor.cubo = consumers.CuboTokens(3, 1, reloj=lambda: self.ahora)
+        self.consumidor.cubo_sala = consumers.CuboTokens(100, 100, reloj=lambda: self.ahora)
+        self.consumidor.ultimo_idempotente = (None, 0)
+
+    def _descartados(self):
+        return dict(metricas.DESCARTADOS._valores)
+
+    def _admitidos(self, *textos):
+        return [self.consumidor.admitir(texto) is not None for texto in textos]
+
+    def test_cubo_de_tokens(self):
+        cubo = consumers.CuboTokens(2, 0.5, reloj=lambda: self.ahora)
+        self.assertEqual([cubo.tomar() for _ in range(3)], [True, True, False])
+        self.ahora = 2
+        self.assertEqual([cubo.tomar() for _ in range(2)], [True, False])
+
+    def test_limite_por_conexion(self):
+        antes = self._descartados()
+        latido = json.dumps({'tipo': 'latido', 'visible': True})
+        self.assertEqual(self._admitidos(*[latido] * 5), [True, True, True, False, False])
+        self.ahora = 1
+        self.assertEqual(self._admitidos(latido, latido), [True, False])
+        self.assertEqual(
+            self._descartados()[('limite_conexion',)] - antes.get(('limite_conexion',), 0), 3
+        )
+
+    def test_limite_por_sala_compartido(self):
+        otro = consumers.LobbyConsumer()
+        otro.cubo = consumers.CuboTokens(100, 0)
+        otro.cubo_sala = self.consumidor.cubo_sala = consumers.CuboTokens(2, 0)
+        otro.ultimo_idempotente = (None, 0)
+        latido = json.dumps({'tipo': 'latido'})
+        self.assertIsNotNone(self.consumidor.admitir(latido))
+        self.assertIsNotNone(otro.admitir(latido))
+        self.assertIsNone(otro.admitir(latido))
+
+    def test_duplicados_tamano_y_formato(self):
+        antes = self._descartados()
+        unido = json.dumps({'tipo': 'jugador_unido'})
+        self.assertEqual(self._admitidos(unido, unido), [True, False])
+        with mock.patch.object(consumers.time, 'monotonic', return_value=time.monotonic() + 5):
+            self.assertEqual(self._admitidos(unido), [True])
+
+        enorme = json.dumps({'tipo': 'latido', 'relleno': 'x' * consumers.MAX_BYTES_MENSAJE})
+        # Menos caracteres que el límite, pero el doble de bytes en UTF-8
+        multibyte = json.dumps({'tipo': 'latido', 'relleno': 'ñ' * 1100}, ensure_ascii=False)
+        self.assertLess(len(multibyte), consumers.MAX_BYTES_MENSAJE)
+        with mock.patch.object(consumers.json, 'loads') as loads:
+            self.assertEqual(self._admitidos(enorme, multibyte, None), [False, False, False])
+            loads.assert_not_called()
+        self.assertEqual(self._admitidos('{no es json', '[1, 2]'), [False, False])
+
+        despues = self._descartados()
+        for motivo, cantidad in (('duplicado', 1), ('tamano', 2), ('binario', 1), ('invalido', 2)):
+            self.assertEqual(despues[(motivo,)] - antes.get((motivo,), 0), cantidad, motivo)
+
+
+class LimpiezaTests(TestCase):
+    def setUp(self):
+        cache_salas.cache.limpiar()
+        self.hace_un_dia = timezone.now() - timedelta(days=1)
+
+    def _sala(self, codigo, actividad):
+        sala = Sala.objects.create(codigo=codigo)
+        Sala.objects.filter(pk=sala.pk).update(actividad=actividad)
+        Jugador.objects.create(session_id=f'clave-{codigo}', nombre='Ana', sala=sala)
+        return sala
+
+    def test_borra_por_lotes_lo_inactivo(self):
+        for codigo in ('VIEJA1', 'VIEJA2', 'VIEJA3'):
+            self._sala(codigo, self.hace_un_dia)
+        self._sala('NUEVA1', timezone.now())
+        Jugador.objects.create(session_id='huerfano', nombre='Eva')
+        caducada = SessionStore()
+        caducada.set_expiry(-60)
+        caducada.create()
+        self.assertIsNotNone(cache_salas.obtener_estado('VIEJA1'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resumen = limpieza.limpiar(ttl=3600, lote=2, pausa=0)
+
+        self.assertEqual(resumen['salas'], 3)
+        self.assertEqual(resumen['jugadores'], 3)
+        self.assertEqual(resumen['jugadores_sin_sala'], 1)
+        self.assertEqual(resumen['sesiones'], 1)
+        self.assertEqual(list(Sala.objects.values_list('codigo', flat=True)), ['NUEVA1'])
+        self.assertEqual(Jugador.objects.count(), 1)
+        self.assertIsNone(cache_salas.cache.obtener('VIEJA1'))
+
+    def test_unirse_renueva_la_actividad(self):
+        sala = self._sala('ANTIGU', self.hace_un_dia)
+        cliente = Client()
+        sesion = cliente.session
+        sesion['nombre_jugador'] = 'Luis'
+        sesion.save()
+        cliente.get(f'/unirse/{sala.codigo}/')
+
+        limpieza.limpiar(ttl=3600, pausa=0)
+        self.assertTrue(Sala.objects.filter(codigo='ANTIGU').exists())
+
+    def test_los_latidos_renuevan_la_actividad(self):
+        self._sala('LATIDO', self.hace_un_dia)
+        self.addCleanup(presencia._actividad_renovada.pop, 'LATIDO', None)
+        ahora = [0]
+
+        def latido(segundos):
+            ahora[0] = segundos
+            async_to_sync(presencia.renovar_actividad)('LATIDO', reloj=lambda: ahora[0])
+
+        latido(0)
+        limpieza.limpiar(ttl=3600, pausa=0)
+        self.assertTrue(Sala.objects.filter(codigo='LATIDO').exists())
+
+        # Como mucho una escritura por INTERVALO_ACTIVIDAD
+        Sala.objects.filter(codigo='LATIDO').update(actividad=self.hace_un_dia)
+        with self.assertNumQueries(0):
+            latido(30)
+        latido(61)
+        limpieza.limpiar(ttl=3600, pausa=0)
+        self.assertTrue(Sala.objects.filter(codigo='LATIDO').exists())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class MetricasTests(TestCase):
+    def setUp(self):
+        cache_salas.cache.limpiar()
+        config = mock.patch.dict(metricas._config, {'TOKEN': 'secreto'})
+        config.start()
+        self.addCleanup(config.stop)
+
+    def _metricas(self, **cabeceras):
+        cabeceras.setdefault('HTTP_AUTHORIZATION', 'Bearer secreto')
+        return self.client.get('/interno/metricas/', **cabeceras)
+
+    def test_vistas_y_sockets(self):
+        lider = Client()
+        lider.post('/', {'nombre': 'Ana'})
+        codigo = lider.post('/pre_lobby/', {'accion': 'crear'}).url.strip('/').split('/')[-1]
+        lider.get(f'/lobby/{codigo}/')
+        metricas.socket_conectado(codigo)
+        metricas.socket_conectado(codigo)
+        metricas.MENSAJES.inc('jugador_unido')
+
+        texto = self._metricas().content.decode()
+        # Las métricas son del proceso: otros tests también suman en las vistas
+        self.assertRegex(texto, r'lobos_vista_consultas_count\{vista="lobby"\} [1-9]')
+        self.assertRegex(texto, r'lobos_vista_segundos_bucket\{vista="pre_lobby",le="\+Inf"\} [1-9]')
+        self.assertIn('lobos_salas{iniciada="false"} 1', texto)
+        self.assertIn('lobos_sockets_conectados 2', texto)
+        self.assertIn('lobos_sockets_por_sala_bucket{le="2"} 1', texto)
+        self.assertIn('lobos_mensajes_recibidos_total{tipo="jugador_unido"}', texto)
+
+        metricas.socket_desconectado(codigo)
+        metricas.socket_desconectado(codigo)
+        self.assertIn('lobos_salas_con_sockets 0', self._metricas().content.decode())
+
+    def test_acceso(self):
+        self.assertEqual(self._metricas(HTTP_AUTHORIZATION='Bearer otro').status_code, 404)
+        self.assertEqual(self._metricas().status_code, 200)
+
+        with mock.patch.dict(metricas._config, {'TOKEN': ''}):
+            # Sin token, ni desde la propia máquina (un proxy en el mismo host)
+            self.assertEqual(self._metricas(HTTP_AUTHORIZATION='').status_code, 404)
+            with self.settings(DEBUG=True):
+                self.assertEqual(self._metricas(HTTP_AUTHORIZATION='').status_code, 200)
+                respuesta = self._metricas(HTTP_AUTHORIZATION='', REMOTE_ADDR='10.0.0.5')
+                self.assertEqual(respuesta.status_code, 404)
+
+    def test_sockets_por_sala_no_se_suman_entre_lecturas(self):
+        metricas.socket_conectado('HIST01')
+        self.addCleanup(metricas.socket_desconectado, 'HIST01')
+        for _ in range(3):
+            texto = '\n'.join(metricas.SOCKETS_POR_SALA.exponer())
+        self.assertIn('lobos_sockets_por_sala_count 1', texto)
+
+
+class PerfiladoTests(TestCase):
+    def setUp(self):
+        cache_salas.cache.limpiar()
+        config = mock.patch.dict(perfilado._config, {'ACTIVO': True, 'MAX_CONSULTAS': 2, 'MAX_MS': 10000})
+        config.start()
+        self.addCleanup(config.stop)
+
+    def test_avisa_de_peticiones_con_demasiadas_consultas(self):
+        lider = Client()
+        # Solo la petición comprobada se mide con el presupuesto reducido
+        with mock.patch.dict(perfilado._config, {'ACTIVO': False}):
+            lider.post('/', {'nombre': 'Ana'})
+        with self.assertLogs('juego.perfilado', 'WARNING') as registro:
+            lider.post('/pre_lobby/', {'accion': 'crear'})
+        aviso = registro.output[0]
+        self.assertIn('POST pre_lobby', aviso)
+        self.assertIn('juego/views.py:', aviso)
+
+    def test_agrupa_consultas_repetidas(self):
+        sala = Sala.objects.create(codigo='PERF01')
+        for i in range(3):
+            Jugador.objects.create(session_id=f'perf-{i}', nombre=f'J{i}', sala=sala)
+        with self.assertLogs('juego.perfilado', 'WARNING') as registro:
+            with perfilado.medir('bucle'):
+                for jugador in Jugador.objects.all():
+                    jugador.save(update_fields=['rol'])
+        self.assertIn('×3', registro.output[0])
+        self.assertIn('juego/tests.py:', registro.output[0])
+
+    def test_manejadores_de_consumer_y_muestreo(self):
+        class Falso:
+            @perfilado.medido
+            async def receive(self, text_data):
+                time.sleep(0.002)
+
+        with tempfile.TemporaryDirectory() as directorio:
+            with mock.patch.dict(perfilado._config, {'MAX_MS': 1, 'MUESTREO': 1, 'DIRECTORIO': directorio}):
+                with self.assertLogs('juego.perfilado', 'WARNING') as registro:
+                    async_to_sync(Falso().receive)('{}')
+            self.assertIn('Falso.receive', registro.output[0])
+            self.assertTrue(any(nombre.endswith('.prof') for nombre in os.listdir(directorio)))
+
+
+
+class PresenciaTests(SimpleTestCase):
+    """Registro de presencia con un reloj falso"""
+
+    def setUp(self):
+        self.ahora = 0
+        self.registro = presencia.RegistroPresencia(ausencia=40, gracia=5, reloj=lambda: self.ahora)
+
+    def test_conectar_y_desconectar_con_gracia(self):
+        self.registro.conectar('ABC', 1, 'canal-1')
+        self.assertEqual(self.registro.tomar_cambios(), {'ABC': {1: presencia.CONECTADO}})
+
+        # Una reconexión dentro de la gracia no se difunde
+        self.registro.desconectar('ABC', 1, 'canal-1')
+        self.ahora = 3
+        self.assertEqual(self.registro.tomar_cambios(), {})
+        self.registro.conectar('ABC', 1, 'canal-2')
+        self.assertEqual(self.registro.tomar_cambios(), {})
+
+        self.registro.desconectar('ABC', 1, 'canal-2')
+        self.ahora = 9
+        self.assertEqual(self.registro.tomar_cambios(), {'ABC': {1: presencia.DESCONECTADO}})
+        self.assertEqual(self.registro.estados('ABC'), {})
+
+    def test_ausente_por_pestana_oculta_o_sin_latidos(self):
+        self.registro.conectar('ABC', 1, 'canal-1')
+        self.registro.conectar('ABC', 2, 'canal-2')
+        self.registro.tomar_cambios()
+
+        self.registro.latido('ABC', 1, visible=False)
+        self.assertEqual(self.registro.tomar_cambios('ABC'), {'ABC': {1: presencia.AUSENTE}})
+
+        self.ahora = 41
+        self.assertEqual(self.registro.tomar_cambios(), {'ABC': {2: presencia.AUSENTE}})
+        self.registro.latido('ABC', 1, visible=True)
+        self.registro.latido('ABC', 2, visible=True)
+        self.assertEqual(self.registro.estados('ABC'), {1: presencia.CONECTADO, 2: presencia.CONECTADO})
+
+    def test_token_reanudar(self):
+        self.assertEqual(consumers._token_reanudar({'query_string': b'reanudar=x.y-1.7'}), ('x.y-1', 7))
+        self.assertIsNone(consumers._token_reanudar({'query_string': b'reanudar=sin-version'}))
+        self.assertIsNone(consumers._token_reanudar({'query_string': b''}))
+
+    def test_al_conectar_cada_cosa_se_envia_una_vez(self):
+        cache_salas.cache.guardar('UNAVEZ', estado_de_prueba(1, lider=1))
+        cache_salas.cache.tomar_pendientes('UNAVEZ')
+        self.addCleanup(cache_salas.cache.invalidar, 'UNAVEZ')
+        self.addCleanup(presencia.registro._salas.pop, 'UNAVEZ', None)
+        aplicacion = URLRouter(routing.websocket_urlpatterns)
+
+        def comunicador(jugador_id):
+            async def con_sesion(scope, receive, send):
+                sesion = {'membresia': {'sala': 'UNAVEZ', 'jugador': jugador_id}}
+                return await aplicacion({**scope, 'session': sesion}, receive, send)
+            return WebsocketCommunicator(con_sesion, '/ws/lobby/UNAVEZ/')
+
+        async def recibir(comunicador):
+            recibidos = []
+            while not await comunicador.receive_nothing(0.3):
+                recibidos.append(json.loads(await comunicador.receive_from()))
+            return recibidos
+
+        async def escenario():
+            primero = comunicador(1)
+            await primero.connect()
+            await recibir(primero)
+            # La vista ya registró al nuevo jugador cuando abre su socket
+            cache_salas.cache.registrar_jugador(
+                {'id': 2, 'nombre': 'J2', 'es_lider': False, 'rol': 'aldeano'}, 'UNAVEZ'
+            )
+            segundo = comunicador(2)
+            await segundo.connect()
+            recibidos = await recibir(segundo), await recibir(primero)
+            for c in (primero, segundo):
+                await c.disconnect()
+            return recibidos
+
+        del_nuevo, del_primero = async_to_sync(escenario)()
+        self.assertEqual([m['tipo'] for m in del_nuevo], ['actualizar_jugadores', 'presencia', 'presencia'])
+        self.assertEqual([j['id'] for j in del_nuevo[0]['jugadores']], [1, 2])
+        self.assertEqual([m['jugadores'] for m in del_nuevo[1:]], [{'1': 'conectado'}, {'2': 'conectado'}])
+        self.assertEqual([m['tipo'] for m in del_primero], ['presencia', 'cambios_jugadores'])
+        self.assertEqual(del_primero[0]['jugadores'], {'2': 'conectado'})
+        self.assertEqual(del_primero[1]['eventos'][0]['evento'], 'unido')
+
+    def test_reconexiones_simultaneas_leen_la_sala_una_vez(self):
+        lecturas = []
+
+        def obtener_estado(codigo):
+            lecturas.append(codigo)
+            time.sleep(0.05)
+            return None
+
+        async def reconectar():
+            return await asyncio.gather(*(consumers.leer_estado_sala('NOCACH') for _ in range(20)))
+
+        with mock.patch.object(consumers, 'obtener_estado', obtener_estado):
+            async_to_sync(reconectar)()
+        self.assertEqual(lecturas, ['NOCACH'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class PresupuestoConsultasTests(TestCase):
+    """Consultas por petición con la sala ya cacheada (incluye la lectura de la sesión)"""
+
+    def setUp(self):
+        cache_salas.cache.limpiar()
+        self.client = Client()
+        self.sala = crear_sala_con_jugadores('PRES01', 10, self.client)
+        # Primera visita: carga la sala en la caché y guarda la membresía en la sesión
+        self.assertEqual(self.client.get('/lobby/PRES01/').status_code, 200)
+
+    def test_lobby(self):
+        with self.assertNumQueries(1):
+            respuesta = self.client.get('/lobby/PRES01/')
+        self.assertContains(respuesta, 'Jugador 9')
+
+    def test_lobby_sin_estilos_ni_scripts_en_linea(self):
+        respuesta = self.client.get('/lobby/PRES01/', HTTP_ACCEPT_ENCODING='gzip')
+        # El HTML va comprimido; los estáticos se cachean aparte
+        self.assertEqual(respuesta['Content-Encoding'], 'gzip')
+        html = gzip.decompress(respuesta.content).decode()
+        self.assertNotIn('<style>', html)
+        self.assertIn('juego/js/lobby.js', html)
+        self.assertIn('juego/css/lobby.css', html)
+        self.assertIn('<script id="datos-lobby" type="application/json">', html)
+        self.assertEqual(
+            json.loads(html.split('type="application/json">')[1].split('</script>')[0])['codigo_sala'],
+            'PRES01',
+        )
+
+    def test_lobby_sin_membresia_en_la_sala(self):
+        otro = Client()
+        otro.session.save()
+        with self.assertNumQueries(2):
+            respuesta = otro.get('/lobby/PRES01/')
+        self.assertRedirects(respuesta, '/pre_lobby/', fetch_redirect_response=False)
+
+    def test_guardar_configuracion_roles(self):
+        with self.assertNumQueries(2):
+            respuesta = self.client.post(
+                '/guardar_configuracion/PRES01/',
+                data=json.dumps({'configuracion': {'lobo': 2}}),
+                content_type='application/json',
+            )
+        self.assertEqual(respuesta.status_code, 200)
+        self.sala.refresh_from_db()
+        self.assertEqual(self.sala.configuracion_roles, {'lobo': 2})
+
+    def test_rechaza_cantidades_desmesuradas(self):
+        for configuracion in ({'lobo': 10 ** 9}, {rol: 10 for rol in reparto.ROLES_VALIDOS}):
+            respuesta = self.client.post(
+                '/guardar_configuracion/PRES01/',
+                data=json.dumps({'configuracion': configuracion}),
+                content_type='application/json',
+            )
+            self.assertEqual(respuesta.status_code, 400)
+        self.sala.refresh_from_db()
+        self.assertNotIn(10 ** 9, self.sala.configuracion_roles.values())
+
+    def test_iniciar_partida(self):
+        # Sesión, SAVEPOINT, sala bloqueada, reclamo, jugadores, bulk_update, RELEASE
+        with self.assertNumQueries(7):
+            self.client.get('/iniciar_partida/PRES01/')
+        self.sala.refresh_from_db()
+        self.assertTrue(self.sala.partida_iniciada)
+
+
+class UrlsVistasAsync:
+    """URLconf con las vistas de juego/views_async.py"""
+    urlpatterns = patrones(views_async)
+
+
+@override_settings(ROOT_URLCONF=UrlsVistasAsync)
+class PresupuestoConsultasAsyncTests(PresupuestoConsultasTests):
+    """Mismo presupuesto de consultas con las vistas asíncronas"""
+
+
+class ProtocoloCompactoTests(TestCase):
+    def test_ida_y_vuelta(self):
+        jugadores = [
+            {'id': 1, 'nombre': 'Líder', 'es_lider': True, 'rol': 'aldeano'},
+            {'id': 2, 'nombre': 'Ana', 'es_lider': False, 'rol': 'vidente'},
+        ]
+        eventos = [
+            {'evento': 'unido', 'version': 3, 'jugador': {'id': 2, 'nombre': 'Ana', 'es_lider': False}},
+            {'evento': 'salio', 'version': 4, 'id': 5},
+            {'evento': 'renombrado', 'version': 5, 'id': 2, 'nombre': 'Ana M.'},
+            {'evento': 'lider', 'version': 6, 'id': 1},
+        ]
+        textos = [
+            protocolo.mensaje_estado({'epoca': 'ab12', 'version': 2, 'jugadores': jugadores}),
+            protocolo.mensaje_cambios('ab12', eventos),
+            protocolo.mensaje_configuracion(dict.fromkeys(protocolo.ROLES, 1)),
+            protocolo.mensaje_presencia({1: 'conectado', 2: 'ausente'}),
+            *protocolo.mensajes_roles(jugadores).values(),
+        ]
+        for texto in textos:
+            self.assertEqual(protocolo.descompactar(protocolo.compactar(texto)), json.loads(texto))
+            self.assertLess(len(protocolo.compactar(texto)), len(texto))
+        self.assertEqual(
+            protocolo.descompactar(protocolo.compactar(protocolo.mensaje_partida_iniciada('ABC'))),
+            {'tipo': 'partida_iniciada'},
+        )
+
+    def test_negociacion_del_subprotocolo(self):
+        async def conectar(subprotocolos):
+            comunicador = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), '/ws/lobby/NOEXIS/',
+                subprotocols=subprotocolos,
+            )
+            _, subprotocolo = await comunicador.connect()
+            primero = await comunicador.receive_from()
+            await comunicador.disconnect()
+            return subprotocolo, primero
+
+        subprotocolo, primero = async_to_sync(conectar)(['lobos.compacto.v1', 'lobos.json.v1'])
+        self.assertEqual(subprotocolo, 'lobos.compacto.v1')
+        self.assertEqual(json.loads(primero), [0, None, 0, []])
+
+        # Sin pedirlo, el protocolo JSON de siempre
+        for subprotocolos in (['lobos.json.v1'], None):
+            subprotocolo, primero = async_to_sync(conectar)(subprotocolos)
+            self.assertEqual(subprotocolo, subprotocolos and 'lobos.json.v1')
+            self.assertEqual(json.loads(primero)['tipo'], 'actualizar_jugadores')
+
+
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class SesionesEnCookieTests(TestCase):
+    def setUp(self):
+        cache_salas.cache.limpiar()
+
+    def test_unirse_sin_sesiones_en_el_servidor(self):
+        lider = Client()
+        lider.post('/', {'nombre': 'Líder'})
+        codigo = lider.post('/pre_lobby/', {'accion': 'crear'}).url.strip('/').split('/')[-1]
+
+        jugador = Client()
+        jugador.post('/', {'nombre': 'Ana'})
+        jugador.get(f'/unirse/{codigo}/')
+        # La clave del jugador no cambia aunque cambie la cookie de sesión
+        jugador.post('/', {'nombre': 'Ana'})
+        jugador.get(f'/unirse/{codigo}/')
+        self.assertEqual(Jugador.objects.filter(sala__codigo=codigo).count(), 2)
+
+        jugador.get(f'/lobby/{codigo}/')
+        with self.assertNumQueries(0):
+            respuesta = jugador.get(f'/lobby/{codigo}/')
+        self.assertContains(respuesta, 'Ana')
+
+
+class RepartoTests(SimpleTestCase):
+    CONFIGURACION = {'lobo': 2, 'vidente': 1, 'aldeano': 1}
+
+    def test_misma_semilla_mismo_reparto(self):
+        primero = RepartidorAleatorio(semilla=42).repartir(8, self.CONFIGURACION)
+        segundo = RepartidorAleatorio(semilla=42).repartir(8, self.CONFIGURACION)
+        self.assertEqual(primero, segundo)
+        self.assertEqual(sorted(primero), ['aldeano'] * 5 + ['lobo', 'lobo', 'vidente'])
+
+    def test_menos_jugadores_que_roles(self):
+        roles = RepartidorAleatorio(semilla=1).repartir(2, self.CONFIGURACION)
+        self.assertEqual(len(roles), 2)
+
+    def test_rechaza_roles_desconocidos_y_cantidades_invalidas(self):
+        for configuracion in (
+            {'dragon': 1}, {'lobo': -1}, {'lobo': '2'}, {'lobo': True}, {'lobo': 10 ** 9},
+            {'lobo': 10, 'aldeano': 20, 'bruja': 10, 'cupido': 10, 'vidente': 1},
+        ):
+            with self.assertRaises(ConfiguracionInvalida):
+                compilar_bolsa(configuracion)
+
+    def test_lote_equivale_a_repartos_sueltos(self):
+        salas = [(6, self.CONFIGURACION), (3, {'lobo': 1}), (6, self.CONFIGURACION)]
+        repartos = RepartidorAleatorio(semilla=7).repartir_lote(salas)
+        self.assertEqual([len(r) for r in repartos], [6, 3, 6])
+        self.assertEqual(repartos, RepartidorAleatorio(semilla=7).repartir_lote(salas))
+
+    @skipIf(reparto.numpy is None, 'numpy no está instalado')
+    def test_lote_numpy(self):
+        salas = [(6, self.CONFIGURACION)] * 50
+        repartos = reparto.RepartidorNumpy(semilla=3).repartir_lote(salas)
+        self.assertEqual(repartos, reparto.RepartidorNumpy(semilla=3).repartir_lote(salas))
+        for roles in repartos:
+            self.assertEqual(sorted(roles), sorted(compilar_bolsa(self.CONFIGURACION, 6)))
@@ -1,11 +1,18 @@
+from django.conf import settings
 from django.urls import path
-from . import views
-
-urlpatterns = [
-    path('', views.inicio, name='inicio'),
-    path('unirse/<str:codigo_sala>/', views.unirse_directo, name='unirse_directo'),
-    path('pre_lobby/', views.pre_lobby, name='pre_lobby'),
-    path('lobby/<str:codigo_sala>/', views.lobby, name='lobby'),
-    path('iniciar_partida/<str:codigo_sala>/', views.iniciar_partida, name='iniciar_partida'),
-    path('guardar_configuracion/<str:codigo_sala>/', views.guardar_configuracion_roles, name='guardar_configuracion'),
-]
\ No newline at end of file
+from . import views, views_async
+
+
+def patrones(vistas):
+    """URLs del juego con las vistas de `vistas` (views o views_async)"""
+    return [
+        path('', views.inicio, name='inicio'),
+        path('unirse/<str:codigo_sala>/', vistas.unirse_directo, name='unirse_directo'),
+        path('pre_lobby/', vistas.pre_lobby, name='pre_lobby'),
+        path('lobby/<str:codigo_sala>/', vistas.lobby, name='lobby'),
+        path('iniciar_partida/<str:codigo_sala>/', vistas.iniciar_partida, name='iniciar_partida'),
+        path('guardar_configuracion/<str:codigo_sala>/', vistas.guardar_configuracion_roles, name='guardar_configuracion'),
+    ]
+
+
+urlpatterns = patrones(views_async if settings.VISTAS_ASYNC else views)
@@ -1,17 +1,82 @@
 # views.py
-from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.shortcuts import render, redirect
+from django.http import Http404, HttpResponse, JsonResponse
 from django.views.decorators.http import require_POST
+from django.utils import timezone
 from .models import Jugador, Sala
-import random
+from .codigos import asignador as asignador_codigos
+from .protocolo import evento_grupo, mensaje_configuracion
+from .reparto import ConfiguracionInvalida, validar_configuracion
+from .servicios import (
+    buscar_jugador, clave_sesion, contexto_lobby, jugador_de_membresia,
+    publicar_en_sala, repartir_roles,
+)
+from . import cache_salas
 import json
 
+def _unir_jugador(request, nombre, sala, es_lider):
+    """Crea o actualiza el jugador de la sesión y lo coloca en la sala"""
+    jugador, created = Jugador.objects.get_or_create(
+        session_id=clave_sesion(request, crear=True),
+        defaults={
+            'nombre': nombre,
+            'sala': sala,
+            'es_lider': es_lider
+        }
+    )
+    if not created:
+        jugador.nombre = nombre
+        jugador.sala = sala
+        jugador.es_lider = es_lider
+        jugador.save()
+    
+    if sala.actividad_desactualizada():
+        Sala.objects.filter(pk=sala.pk).update(actividad=timezone.now())
+    cache_salas.registrar_jugador(jugador, sala)
+    request.session['membresia'] = {'jugador': jugador.id, 'sala': sala.codigo}
+    return jugador
+
+def _jugador_en_sala(request, codigo_sala):
+    """
+    Estado de la sala (desde la caché) y el jugador de la sesión en ella.
+
+    La sesión recuerda en qué sala está su jugador ('membresia'), así que
+    con la sala cacheada no hace falta consultar la base de datos. El
+    jugador es None si la sesión no está en la sala; lanza Http404 si la
+    sala no existe.
+    """
+    estado = cache_salas.obtener_estado(codigo_sala)
+    if estado is None:
+        raise Http404('Sala no encontrada')
+    
+    jugador = jugador_de_membresia(request, estado, codigo_sala)
+    if jugador is not None:
+        return estado, jugador
+    
+    # Sin membresía (o desactualizada): se busca el jugador en la base de datos
+    clave = clave_sesion(request)
+    if clave is None:
+        return estado, None
+    jugador_id = Jugador.objects.filter(
+        session_id=clave, sala__codigo=codigo_sala
+    ).values_list('id', flat=True).first()
+    if jugador_id is None:
+        return estado, None
+    request.session['membresia'] = {'jugador': jugador_id, 'sala': codigo_sala}
+    
+    jugador = buscar_jugador(estado, jugador_id)
+    if jugador is None:
+        # La caché no tenía aún al jugador: se recarga la sala
+        cache_salas.cache.invalidar(codigo_sala)
+        estado = cache_salas.obtener_estado(codigo_sala) or estado
+        jugador = buscar_jugador(estado, jugador_id)
+    return estado, jugador
+
 def inicio(request):
     """Pantalla inicial simple que redirige al pre_lobby"""
     if request.method == 'POST':
         nombre = request.POST.get('nombre')
-        if not request.session.session_key:
-            request.session.create()
+        clave_sesion(request, crear=True)
         
         # Guardamos el nombre en la sesión temporalmente
         request.session['nombre_jugador'] = nombre
@@ -36,27 +101,14 @@ def unirse_directo(request, codigo_sala):
             'error': f'La sala "{codigo_sala}" no existe o ha expirado.'
         })
     
-    if not request.session.session_key:
-        request.session.create()
+    clave_sesion(request, crear=True)
     
     if request.method == 'POST':
         # El usuario envió su nombre desde el formulario
         nombre = request.POST.get('nombre')
         if nombre:
             # Crear o actualizar jugador
-            jugador, created = Jugador.objects.get_or_create(
-                session_id=request.session.session_key,
-                defaults={
-                    'nombre': nombre,
-                    'sala': sala,
-                    'es_lider': False
-                }
-            )
-            if not created:
-                jugador.nombre = nombre
-                jugador.sala = sala
-                jugador.es_lider = False
-                jugador.save()
+            _unir_jugador(request, nombre, sala, es_lider=False)
             
             # Guardar nombre en sesión
             request.session['nombre_jugador'] = nombre
@@ -69,19 +121,7 @@ def unirse_directo(request, codigo_sala):
     nombre = request.session.get('nombre_jugador')
     if nombre:
         # Ya tiene nombre, crear/actualizar jugador y unirse directamente
-        jugador, created = Jugador.objects.get_or_create(
-            session_id=request.session.session_key,
-            defaults={
-                'nombre': nombre,
-                'sala': sala,
-                'es_lider': False
-            }
-        )
-        if not created:
-            jugador.nombre = nombre
-            jugador.sala = sala
-            jugador.es_lider = False
-            jugador.save()
+        _unir_jugador(request, nombre, sala, es_lider=False)
         
         return redirect('lobby', codigo_sala=sala.codigo)
     else:
@@ -92,8 +132,7 @@ def unirse_directo(request, codigo_sala):
 
 def pre_lobby(request):
     """Vista donde el usuario puede crear o unirse a una sala"""
-    if not request.session.session_key:
-        request.session.create()
+    clave_sesion(request, crear=True)
     
     nombre = request.session.get('nombre_jugador')
     if not nombre:
@@ -104,23 +143,12 @@ def pre_lobby(request):
         
         if accion == 'crear':
             # Crear nueva sala
-            codigo = Sala.generar_codigo()
-            sala = Sala.objects.create(codigo=codigo)
+            sala = asignador_codigos.crear_sala()
+            codigo = sala.codigo
+            cache_salas.registrar_sala_creada(sala)
             
             # Crear jugador como líder
-            jugador, created = Jugador.objects.get_or_create(
-                session_id=request.session.session_key,
-                defaults={
-                    'nombre': nombre,
-                    'sala': sala,
-                    'es_lider': True
-                }
-            )
-            if not created:
-                jugador.nombre = nombre
-                jugador.sala = sala
-                jugador.es_lider = True
-                jugador.save()
+            _unir_jugador(request, nombre, sala, es_lider=True)
             
             return redirect('lobby', codigo_sala=codigo)
         
@@ -132,19 +160,7 @@ def pre_lobby(request):
                 sala = Sala.objects.get(codigo=codigo)
                 
                 # Crear o actualizar jugador
-                jugador, created = Jugador.objects.get_or_create(
-                    session_id=request.session.session_key,
-                    defaults={
-                        'nombre': nombre,
-                        'sala': sala,
-                        'es_lider': False
-                    }
-                )
-                if not created:
-                    jugador.nombre = nombre
-                    jugador.sala = sala
-                    jugador.es_lider = False
-                    jugador.save()
+                _unir_jugador(request, nombre, sala, es_lider=False)
                 
                 return redirect('lobby', codigo_sala=codigo)
             
@@ -156,38 +172,11 @@ def pre_lobby(request):
 
 def lobby(request, codigo_sala):
     """Sala de espera de la partida"""
-    session_key = request.session.session_key
-    
-    try:
-        sala = get_object_or_404(Sala, codigo=codigo_sala)
-        jugador_actual = Jugador.objects.get(session_id=session_key, sala=sala)
-    except Jugador.DoesNotExist:
+    estado, datos_jugador = _jugador_en_sala(request, codigo_sala)
+    if datos_jugador is None:
         return redirect('pre_lobby')
-
-    # Obtenemos todos los jugadores de esta sala
-    todos = sala.jugadores.all()
-    
-    # Asegurar que la configuración existe
-    if not sala.configuracion_roles:
-        sala.configuracion_roles = sala.get_configuracion_default()
-        sala.save()
-    
-    # Calcular total de roles configurados
-    total_roles = sum(sala.configuracion_roles.values()) if sala.configuracion_roles else 0
-    
-    # Generar URL completa para compartir
-    url_compartir = request.build_absolute_uri(f'/unirse/{sala.codigo}/')
     
-    context = {
-        'jugador': jugador_actual,
-        'todos_los_jugadores': todos,
-        'sala': sala,
-        'es_lider': jugador_actual.es_lider,
-        'configuracion_roles': sala.configuracion_roles,
-        'configuracion_roles_json': json.dumps(sala.configuracion_roles),
-        'total_roles_configurados': total_roles,
-        'url_compartir': url_compartir,
-    }
+    context = contexto_lobby(request, estado, codigo_sala, datos_jugador)
     return render(request, 'juego/lobby.html', context)
 
 def iniciar_partida(request, codigo_sala):
@@ -197,52 +186,20 @@ def iniciar_partida(request, codigo_sala):
     El líder no recibe rol (es el narrador).
     Usa la configuración dinámica de roles de la sala.
     """
-    session_key = request.session.session_key
-    
-    try:
-        sala = get_object_or_404(Sala, codigo=codigo_sala)
-        jugador_actual = Jugador.objects.get(session_id=session_key, sala=sala)
-        
-        # Verificar que sea el líder
-        if not jugador_actual.es_lider:
-            return redirect('lobby', codigo_sala=codigo_sala)
-        
-    except Jugador.DoesNotExist:
+    estado, jugador_actual = _jugador_en_sala(request, codigo_sala)
+    if jugador_actual is None:
         return redirect('pre_lobby')
     
-    # Construir "bolsa de roles" basada en la configuración
-    roles_disponibles = []
-    configuracion = sala.configuracion_roles or sala.get_configuracion_default()
-    
-    for rol, cantidad in configuracion.items():
-        roles_disponibles.extend([rol] * cantidad)
-    
-    # Obtener todos los jugadores de la sala EXCEPTO el líder
-    jugadores = list(sala.jugadores.exclude(es_lider=True))
-    num_jugadores = len(jugadores)
+    # Verificar que sea el líder
+    if not jugador_actual['es_lider'] or estado['partida_iniciada']:
+        return redirect('lobby', codigo_sala=codigo_sala)
     
-    # Si hay más jugadores que roles configurados, rellenar con aldeanos
-    if num_jugadores > len(roles_disponibles):
-        faltantes = num_jugadores - len(roles_disponibles)
-        roles_disponibles.extend(['aldeano'] * faltantes)
-    
-    # Barajar la lista de roles
-    random.shuffle(roles_disponibles)
-    
-    # Asignar roles SOLO a los jugadores no-líderes y guardar
-    for i, jugador in enumerate(jugadores):
-        if i < len(roles_disponibles):
-            jugador.rol = roles_disponibles[i]
-        else:
-            jugador.rol = 'aldeano'  # Fallback
-        jugador.save()
-    
-    # El líder no recibe rol (queda como 'aldeano' por defecto pero será tratado como narrador)
-    
-    # Marcar la partida como iniciada
-    sala.partida_iniciada = True
-    sala.save()
+    repartir_roles(codigo_sala)
     
+    # El botón de empezar usa fetch: los roles llegan por el socket, así que
+    # no hace falta seguir la redirección y renderizar el lobby
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return HttpResponse(status=204)
     return redirect('lobby', codigo_sala=codigo_sala)
 
 @require_POST
@@ -251,40 +208,42 @@ def guardar_configuracion_roles(request, codigo_sala):
     Vista para guardar la configuración de roles.
     Solo puede ser llamada por el líder.
     """
-    session_key = request.session.session_key
-    
-    try:
-        sala = get_object_or_404(Sala, codigo=codigo_sala)
-        jugador_actual = Jugador.objects.get(session_id=session_key, sala=sala)
-        
-        # Verificar que sea el líder
-        if not jugador_actual.es_lider:
-            return JsonResponse({'error': 'No tienes permisos'}, status=403)
-        
-        # No permitir cambios si la partida ya comenzó
-        if sala.partida_iniciada:
-            return JsonResponse({'error': 'La partida ya comenzó'}, status=400)
-        
-    except Jugador.DoesNotExist:
+    estado, jugador_actual = _jugador_en_sala(request, codigo_sala)
+    if jugador_actual is None:
         return JsonResponse({'error': 'No autorizado'}, status=401)
     
+    # Verificar que sea el líder
+    if not jugador_actual['es_lider']:
+        return JsonResponse({'error': 'No tienes permisos'}, status=403)
+    
+    # No permitir cambios si la partida ya comenzó
+    if estado['partida_iniciada']:
+        return JsonResponse({'error': 'La partida ya comenzó'}, status=400)
+    
     # Obtener configuración del request
     try:
         data = json.loads(request.body)
         nueva_configuracion = data.get('configuracion', {})
         
-        # Validar que todos los valores sean enteros positivos
-        for rol, cantidad in nueva_configuracion.items():
-            if not isinstance(cantidad, int) or cantidad < 0:
-                return JsonResponse({'error': f'Valor inválido para {rol}'}, status=400)
+        # Validar roles conocidos y cantidades enteras positivas
+        try:
+            validar_configuracion(nueva_configuracion)
+        except ConfiguracionInvalida as e:
+            return JsonResponse({'error': str(e)}, status=400)
         
-        # Guardar configuración
-        sala.configuracion_roles = nueva_configuracion
-        sala.save()
+        # Guardar configuración, salvo que la partida haya empezado mientras tanto
+        if not Sala.objects.filter(codigo=codigo_sala, partida_iniciada=False).update(
+            configuracion_roles=nueva_configuracion, actividad=timezone.now()
+        ):
+            return JsonResponse({'error': 'La partida ya comenzó'}, status=400)
+        cache_salas.registrar_configuracion(codigo_sala, nueva_configuracion)
+        publicar_en_sala(
+            codigo_sala, evento_grupo(mensaje_configuracion(nueva_configuracion)), 'configuracion'
+        )
         
         return JsonResponse({
             'success': True,
-            'configuracion': sala.configuracion_roles
+            'configuracion': nueva_configuracion
         })
         
     except json.JSONDecodeError:
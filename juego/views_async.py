@@ -0,0 +1,239 @@
+"""
+Versiones asíncronas de las vistas del flujo de unirse y del lobby.
+
+Bajo daphne una vista síncrona ocupa durante toda la petición (render
+incluido) el único hilo de sync_to_async, así que las peticiones se
+atienden de una en una. Estas vistas solo pasan a ese hilo para las
+consultas (ORM asíncrono) y para lo que debe ir en una transacción; leer
+la caché de salas, renderizar y publicar en el channel layer no bloquean
+al resto de peticiones.
+
+Django 4.2 aún no tiene API asíncrona de sesiones: la sesión se carga con
+sync_to_async y después se usa en memoria.
+
+Se activan con settings.VISTAS_ASYNC (ver juego/urls.py).
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse
+from django.shortcuts import redirect, render
+from django.utils import timezone
+
+from . import cache_salas, metricas
+from .codigos import asignador as asignador_codigos
+from .consumers import grupo_sala, leer_estado_sala
+from .models import Jugador, Sala
+from .protocolo import evento_grupo, mensaje_configuracion
+from .reparto import ConfiguracionInvalida, validar_configuracion
+from .servicios import (
+    buscar_jugador, clave_sesion, contexto_lobby, jugador_de_membresia, repartir_roles,
+)
+
+
+def _cargar_sesion(request, crear=False):
+    request.session.keys()
+    return clave_sesion(request, crear)
+
+
+async def _preparar_sesion(request, crear=False):
+    """Carga la sesión y devuelve la clave del jugador"""
+    if settings.SESSION_ENGINE == 'django.contrib.sessions.backends.signed_cookies':
+        # La cookie firmada se lee sin base de datos: no hace falta un hilo
+        return _cargar_sesion(request, crear)
+    return await sync_to_async(_cargar_sesion)(request, crear)
+
+
+async def _publicar_en_sala(codigo_sala, evento, tipo):
+    """Envía `evento` al grupo del lobby (la escritura ya está confirmada)"""
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        await metricas.group_send(channel_layer, grupo_sala(codigo_sala), evento, tipo)
+
+
+async def _unir_jugador(request, nombre, sala, es_lider):
+    """Crea o actualiza el jugador de la sesión y lo coloca en la sala"""
+    clave = await _preparar_sesion(request, crear=True)
+    jugador, created = await Jugador.objects.aget_or_create(
+        session_id=clave,
+        defaults={
+            'nombre': nombre,
+            'sala': sala,
+            'es_lider': es_lider
+        }
+    )
+    if not created:
+        jugador.nombre = nombre
+        jugador.sala = sala
+        jugador.es_lider = es_lider
+        await jugador.asave()
+
+    if sala.actividad_desactualizada():
+        await Sala.objects.filter(pk=sala.pk).aupdate(actividad=timezone.now())
+
+    # Las escrituras en la caché van por transaction.on_commit, que necesita un hilo
+    await sync_to_async(cache_salas.registrar_jugador)(jugador, sala)
+    request.session['membresia'] = {'jugador': jugador.id, 'sala': sala.codigo}
+    return jugador
+
+
+async def _jugador_en_sala(request, codigo_sala):
+    """Como views._jugador_en_sala, sin bloquear el bucle de eventos"""
+    estado = await leer_estado_sala(codigo_sala)
+    if estado is None:
+        raise Http404('Sala no encontrada')
+
+    clave = await _preparar_sesion(request)
+    jugador = jugador_de_membresia(request, estado, codigo_sala)
+    if jugador is not None:
+        return estado, jugador
+
+    # Sin membresía (o desactualizada): se busca el jugador en la base de datos
+    if clave is None:
+        return estado, None
+    jugador_id = await Jugador.objects.filter(
+        session_id=clave, sala__codigo=codigo_sala
+    ).values_list('id', flat=True).afirst()
+    if jugador_id is None:
+        return estado, None
+    request.session['membresia'] = {'jugador': jugador_id, 'sala': codigo_sala}
+
+    jugador = buscar_jugador(estado, jugador_id)
+    if jugador is None:
+        # La caché no tenía aún al jugador: se recarga la sala
+        cache_salas.cache.invalidar(codigo_sala)
+        estado = await leer_estado_sala(codigo_sala) or estado
+        jugador = buscar_jugador(estado, jugador_id)
+    return estado, jugador
+
+
+async def unirse_directo(request, codigo_sala):
+    """Vista para unirse directamente a una sala mediante enlace"""
+    try:
+        sala = await Sala.objects.aget(codigo=codigo_sala.upper())
+    except Sala.DoesNotExist:
+        return render(request, 'juego/inicio.html', {
+            'error': f'La sala "{codigo_sala}" no existe o ha expirado.'
+        })
+
+    await _preparar_sesion(request, crear=True)
+
+    if request.method == 'POST':
+        # El usuario envió su nombre desde el formulario
+        nombre = request.POST.get('nombre')
+        if nombre:
+            await _unir_jugador(request, nombre, sala, es_lider=False)
+            request.session['nombre_jugador'] = nombre
+            return redirect('lobby', codigo_sala=sala.codigo)
+
+    # Si el usuario ya tiene nombre se une directamente
+    nombre = request.session.get('nombre_jugador')
+    if nombre:
+        await _unir_jugador(request, nombre, sala, es_lider=False)
+        return redirect('lobby', codigo_sala=sala.codigo)
+
+    return render(request, 'juego/inicio.html', {
+        'mensaje': f'Te estás uniendo a la sala {sala.codigo}'
+    })
+
+
+async def pre_lobby(request):
+    """Vista donde el usuario puede crear o unirse a una sala"""
+    await _preparar_sesion(request, crear=True)
+
+    nombre = request.session.get('nombre_jugador')
+    if not nombre:
+        return redirect('inicio')
+
+    if request.method == 'POST':
+        accion = request.POST.get('accion')
+
+        if accion == 'crear':
+            sala = await sync_to_async(asignador_codigos.crear_sala)()
+            await sync_to_async(cache_salas.registrar_sala_creada)(sala)
+            await _unir_jugador(request, nombre, sala, es_lider=True)
+            return redirect('lobby', codigo_sala=sala.codigo)
+
+        elif accion == 'unirse':
+            codigo = request.POST.get('codigo', '').upper().strip()
+            try:
+                sala = await Sala.objects.aget(codigo=codigo)
+            except Sala.DoesNotExist:
+                error = "Sala no encontrada. Verifica el código."
+                return render(request, 'juego/pre_lobby.html', {'nombre': nombre, 'error': error})
+            await _unir_jugador(request, nombre, sala, es_lider=False)
+            return redirect('lobby', codigo_sala=codigo)
+
+    return render(request, 'juego/pre_lobby.html', {'nombre': nombre})
+
+
+async def lobby(request, codigo_sala):
+    """Sala de espera de la partida"""
+    estado, datos_jugador = await _jugador_en_sala(request, codigo_sala)
+    if datos_jugador is None:
+        return redirect('pre_lobby')
+
+    context = contexto_lobby(request, estado, codigo_sala, datos_jugador)
+    return render(request, 'juego/lobby.html', context)
+
+
+async def iniciar_partida(request, codigo_sala):
+    """Reparte los roles (solo el líder); ver views.iniciar_partida"""
+    estado, jugador_actual = await _jugador_en_sala(request, codigo_sala)
+    if jugador_actual is None:
+        return redirect('pre_lobby')
+
+    if not jugador_actual['es_lider'] or estado['partida_iniciada']:
+        return redirect('lobby', codigo_sala=codigo_sala)
+
+    # La transacción (bloqueo, reclamo y bulk_update) va entera en un hilo
+    await sync_to_async(repartir_roles)(codigo_sala)
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return HttpResponse(status=204)
+    return redirect('lobby', codigo_sala=codigo_sala)
+
+
+async def guardar_configuracion_roles(request, codigo_sala):
+    """Guarda la configuración de roles (solo el líder)"""
+    # require_POST no admite vistas asíncronas en Django 4.2
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    estado, jugador_actual = await _jugador_en_sala(request, codigo_sala)
+    if jugador_actual is None:
+        return JsonResponse({'error': 'No autorizado'}, status=401)
+    if not jugador_actual['es_lider']:
+        return JsonResponse({'error': 'No tienes permisos'}, status=403)
+    if estado['partida_iniciada']:
+        return JsonResponse({'error': 'La partida ya comenzó'}, status=400)
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    nueva_configuracion = data.get('configuracion', {})
+
+    try:
+        validar_configuracion(nueva_configuracion)
+    except ConfiguracionInvalida as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Guardar configuración, salvo que la partida haya empezado mientras tanto
+    if not await Sala.objects.filter(codigo=codigo_sala, partida_iniciada=False).aupdate(
+        configuracion_roles=nueva_configuracion, actividad=timezone.now()
+    ):
+        return JsonResponse({'error': 'La partida ya comenzó'}, status=400)
+    await sync_to_async(cache_salas.registrar_configuracion)(codigo_sala, nueva_configuracion)
+    await _publicar_en_sala(
+        codigo_sala, evento_grupo(mensaje_configuracion(nueva_configuracion)), 'configuracion'
+    )
+
+    return JsonResponse({
+        'success': True,
+        'configuracion': nueva_configuracion
+    })
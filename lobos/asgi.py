@@ -21,8 +21,9 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 import juego.routing
+from juego.limpieza import LimpiezaPeriodica
 
-application = ProtocolTypeRouter({
+application = LimpiezaPeriodica(ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
@@ -31,4 +32,4 @@ application = ProtocolTypeRouter({
             )
         )
     ),
-})
+}))
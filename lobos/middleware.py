@@ -0,0 +1,126 @@
+"""
+Middleware propio del proyecto.
+"""
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from juego import metricas, perfilado
+
+
+class WhiteNoiseAsincrono(WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware que también funciona en modo asíncrono.
+
+    El de whitenoise solo es síncrono: con vistas asíncronas bajo daphne,
+    Django ejecutaría toda la petición desde el hilo único de
+    sync_to_async y las peticiones volverían a ir de una en una.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        self.asincrono = iscoroutinefunction(get_response)
+        if self.asincrono:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.asincrono:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+
+class MetricasVistas:
+    """
+    Mide la latencia y las consultas SQL de cada petición, por nombre de
+    vista (juego/metricas.py). Funciona con vistas síncronas y asíncronas.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.asincrono = iscoroutinefunction(get_response)
+        if self.asincrono:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.asincrono:
+            return self.__acall__(request)
+        contador, marca, inicio = self._empezar()
+        try:
+            return self.get_response(request)
+        finally:
+            self._terminar(request, contador, marca, inicio)
+
+    async def __acall__(self, request):
+        contador, marca, inicio = self._empezar()
+        try:
+            return await self.get_response(request)
+        finally:
+            self._terminar(request, contador, marca, inicio)
+
+    def _empezar(self):
+        contador = [0]
+        return contador, metricas.consultas_peticion.set(contador), time.perf_counter()
+
+    def _terminar(self, request, contador, marca, inicio):
+        duracion = time.perf_counter() - inicio
+        metricas.consultas_peticion.reset(marca)
+        coincidencia = getattr(request, 'resolver_match', None)
+        vista = (coincidencia.url_name or coincidencia.view_name) if coincidencia else 'sin_ruta'
+        metricas.VISTAS.observar(duracion, vista)
+        metricas.VISTAS_CONSULTAS.observar(contador[0], vista)
+
+
+class PresupuestoPeticiones:
+    """
+    Avisa de las peticiones que se pasan del presupuesto de consultas o de
+    tiempo, y perfila una de cada N (juego/perfilado.py). Sin efecto si
+    PERFILADO_ACTIVO no está activado.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.asincrono = iscoroutinefunction(get_response)
+        if self.asincrono:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.asincrono:
+            return self.__acall__(request)
+        if not perfilado.activo():
+            return self.get_response(request)
+        with perfilado.medir(request.path) as medicion:
+            respuesta = self.get_response(request)
+            self._nombrar(medicion, request)
+        return respuesta
+
+    async def __acall__(self, request):
+        if not perfilado.activo():
+            return await self.get_response(request)
+        with perfilado.medir(request.path) as medicion:
+            respuesta = await self.get_response(request)
+            self._nombrar(medicion, request)
+        return respuesta
+
+    def _nombrar(self, medicion, request):
+        coincidencia = getattr(request, 'resolver_match', None)
+        if medicion is not None and coincidencia is not None:
+            medicion.nombre = f'{request.method} {coincidencia.view_name} ({request.path})'
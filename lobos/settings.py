@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 import os
 
+import dj_database_url
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -46,7 +48,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',  # Para servir archivos estáticos en producción
+    'lobos.middleware.WhiteNoiseAsincrono',  # Archivos estáticos en producción (también con vistas async)
+    'django.middleware.gzip.GZipMiddleware',  # HTML comprimido (los estáticos ya van precomprimidos)
+    'lobos.middleware.MetricasVistas',  # Latencia y consultas por vista (/interno/metricas/)
+    'lobos.middleware.PresupuestoPeticiones',  # Avisos de peticiones lentas (PERFILADO_ACTIVO)
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -77,40 +82,227 @@ WSGI_APPLICATION = 'lobos.wsgi.application'
 ASGI_APPLICATION = 'lobos.asgi.application'
 
 # Channel Layers - Configuración para WebSockets
-# InMemoryChannelLayer: Funciona en plan gratuito de Render (single worker)
-# IMPORTANTE: Solo funciona con 1 worker/proceso. No escala horizontalmente.
-# Para producción con múltiples workers, usar Redis Channel Layer.
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        'CONFIG': {
-            # Capacidad del canal en memoria (número de mensajes)
-            'capacity': 100,
-            # Tiempo de expiración de mensajes (segundos)
-            'expiry': 60,
+# CAPA_CANALES elige el backend:
+#  - 'memoria' (por defecto): InMemoryChannelLayer. Funciona en plan gratuito
+#    de Render (single worker). IMPORTANTE: Solo funciona con 1 worker/proceso.
+#  - 'compartida': juego.capa_canales.CapaCanalesLocal, para varios procesos
+#    de daphne. Usa el broker incluido (python -m juego.capa_canales) o un
+#    Redis, según CAPA_CANALES_URL (unix:///ruta.sock o redis://host:6379).
+CAPA_CANALES = os.environ.get('CAPA_CANALES', 'memoria')
+
+if CAPA_CANALES == 'compartida':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'juego.capa_canales.CapaCanalesLocal',
+            'CONFIG': {
+                'url': os.environ.get('CAPA_CANALES_URL', 'unix:///tmp/lobos-canales.sock'),
+                'capacity': 100,
+                'expiry': 60,
+            }
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                # Capacidad del canal en memoria (número de mensajes)
+                'capacity': 100,
+                # Tiempo de expiración de mensajes (segundos)
+                'expiry': 60,
+            }
         }
     }
+
+# Agrupación de difusiones del lobby (juego/consumers.py): los avisos de
+# una sala que llegan con menos de VENTANA segundos de separación se
+# envían juntos, esperando como máximo MAX_ESPERA segundos.
+LOBBY_DIFUSION = {
+    'VENTANA': float(os.environ.get('LOBBY_DIFUSION_VENTANA', '0.075')),
+    'MAX_ESPERA': float(os.environ.get('LOBBY_DIFUSION_MAX_ESPERA', '0.25')),
+}
+
+# Presencia en el lobby (juego/presencia.py): cada socket envía un latido
+# cada LATIDO segundos; sin latidos durante AUSENCIA segundos el jugador
+# pasa a ausente y, sin ningún socket durante GRACIA segundos, a
+# desconectado. Los cambios no inmediatos se revisan cada REVISION segundos.
+LOBBY_PRESENCIA = {
+    'LATIDO': int(os.environ.get('PRESENCIA_LATIDO', '15')),
+    'AUSENCIA': int(os.environ.get('PRESENCIA_AUSENCIA', '40')),
+    'GRACIA': int(os.environ.get('PRESENCIA_GRACIA', '5')),
+    'REVISION': int(os.environ.get('PRESENCIA_REVISION', '5')),
+}
+
+# permessage-deflate en los WebSockets al arrancar con servidor.py. Cada
+# socket comprimido guarda sus contextos de zlib: VENTANA (bits de la
+# ventana, 9-15) y MEMORIA (nivel de memoria, 1-9) limitan lo que ocupan.
+WEBSOCKET_DEFLATE = {
+    'ACTIVO': os.environ.get('WS_DEFLATE', 'True') == 'True',
+    'VENTANA': int(os.environ.get('WS_DEFLATE_VENTANA', '11')),
+    'MEMORIA': int(os.environ.get('WS_DEFLATE_MEMORIA', '4')),
 }
 
-# Para Redis en producción (requiere servicio Redis externo):
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-#         'CONFIG': {
-#             "hosts": [os.environ.get('REDIS_URL', 'redis://localhost:6379')],
-#         },
-#     },
-# }
+# Límites de los mensajes que envían los navegadores al lobby
+# (juego/consumers.py). Cada socket tiene un cubo de tokens de
+# CONEXION_RAFAGA mensajes que se rellena a CONEXION_POR_SEGUNDO, y cada
+# sala (por proceso) otro de SALA_RAFAGA a SALA_POR_SEGUNDO. Los mensajes
+# de más de MAX_BYTES bytes (en UTF-8) y los duplicados exactos de mensajes
+# idempotentes en menos de DUPLICADOS segundos se descartan.
+LOBBY_LIMITES = {
+    'MAX_BYTES': int(os.environ.get('LOBBY_LIMITE_MAX_BYTES', '2048')),
+    'CONEXION_RAFAGA': int(os.environ.get('LOBBY_LIMITE_CONEXION_RAFAGA', '10')),
+    'CONEXION_POR_SEGUNDO': float(os.environ.get('LOBBY_LIMITE_CONEXION_POR_SEGUNDO', '2')),
+    'SALA_RAFAGA': int(os.environ.get('LOBBY_LIMITE_SALA_RAFAGA', '50')),
+    'SALA_POR_SEGUNDO': float(os.environ.get('LOBBY_LIMITE_SALA_POR_SEGUNDO', '20')),
+    'DUPLICADOS': float(os.environ.get('LOBBY_LIMITE_DUPLICADOS', '1')),
+}
+
+# Caché en memoria del estado de las salas (juego/cache_salas.py)
+# Límite de salas cacheadas por proceso (LRU), segundos desde que se carga
+# una sala hasta que se vuelve a leer de la base de datos (aunque se siga
+# usando) y eventos de jugadores guardados por sala para enviar diferencias
+# a los clientes. Con varios procesos, las escrituras se avisan al resto
+# para que invaliden su copia.
+CACHE_SALAS = {
+    'MAX_SALAS': int(os.environ.get('CACHE_SALAS_MAX', '1000')),
+    'TTL': int(os.environ.get('CACHE_SALAS_TTL', '600')),
+    'MAX_EVENTOS': int(os.environ.get('CACHE_SALAS_MAX_EVENTOS', '50')),
+    'INVALIDAR_ENTRE_PROCESOS': CAPA_CANALES == 'compartida',
+}
+
+# Motor de reparto de roles (juego/reparto.py). SEMILLA fija el azar para
+# repetir repartos en pruebas; en producción debe quedar vacía.
+REPARTO_ROLES = {
+    'MOTOR': os.environ.get('REPARTO_ROLES_MOTOR', 'juego.reparto.RepartidorAleatorio'),
+    'SEMILLA': os.environ.get('REPARTO_ROLES_SEMILLA') or None,
+}
+
+# Asignación de códigos de sala (juego/codigos.py). Reintentos si otro
+# proceso crea el mismo código a la vez y segundos que espera el código de
+# una sala eliminada antes de volver a usarse.
+CODIGOS_SALA = {
+    'MAX_INTENTOS': int(os.environ.get('CODIGOS_SALA_MAX_INTENTOS', '5')),
+    'CUARENTENA': int(os.environ.get('CODIGOS_SALA_CUARENTENA', '3600')),
+}
+
+# Vistas asíncronas (juego/views_async.py) para unirse, el lobby, la
+# configuración y el inicio de partida. En Django 4.2 el ORM y las
+# sesiones asíncronas siguen pasando por el hilo de sync_to_async, así que
+# con SQLite local no mejoran la latencia (ver `benchmark.py vistas`):
+# quedan desactivadas por defecto.
+VISTAS_ASYNC = os.environ.get('VISTAS_ASYNC', 'False') == 'True'
+
+# Métricas en formato Prometheus en /interno/metricas/ (juego/metricas.py).
+# Con METRICAS_TOKEN hay que enviar 'Authorization: Bearer <token>'; sin
+# él, solo se atienden con DEBUG y desde la propia máquina (en producción,
+# sin token, la vista responde 404).
+METRICAS = {
+    'ACTIVAS': os.environ.get('METRICAS_ACTIVAS', 'True') == 'True',
+    'TOKEN': os.environ.get('METRICAS_TOKEN', ''),
+}
+
+# Presupuesto por petición HTTP y por mensaje de WebSocket (juego/perfilado.py),
+# pensado para staging: avisa en el log de lo que pase de MAX_CONSULTAS
+# consultas o MAX_MS milisegundos, y con MUESTREO = N guarda en DIRECTORIO
+# un perfil de cProfile de una de cada N mediciones (0 = nunca).
+PERFILADO = {
+    'ACTIVO': os.environ.get('PERFILADO_ACTIVO', 'False') == 'True',
+    'MAX_CONSULTAS': int(os.environ.get('PERFILADO_MAX_CONSULTAS', '10')),
+    'MAX_MS': int(os.environ.get('PERFILADO_MAX_MS', '200')),
+    'MUESTREO': int(os.environ.get('PERFILADO_MUESTREO', '0')),
+    'DIRECTORIO': os.environ.get('PERFILADO_DIRECTORIO', '/tmp/lobos-perfiles'),
+}
+
+# Limpieza periódica (juego/limpieza.py): cada INTERVALO segundos borra
+# las salas sin actividad desde hace TTL_SALAS segundos, los jugadores sin
+# sala y las sesiones caducadas, en lotes de LOTE filas con PAUSA segundos
+# entre lotes.
+LIMPIEZA = {
+    'ACTIVA': os.environ.get('LIMPIEZA_ACTIVA', 'True') == 'True',
+    'INTERVALO': int(os.environ.get('LIMPIEZA_INTERVALO', '300')),
+    'TTL_SALAS': int(os.environ.get('LIMPIEZA_TTL_SALAS', str(6 * 3600))),
+    'LOTE': int(os.environ.get('LIMPIEZA_LOTE', '200')),
+    'PAUSA': float(os.environ.get('LIMPIEZA_PAUSA', '0.05')),
+}
+
+# Sesiones. SESIONES elige dónde se guardan:
+#   'bd'      -> tabla django_session (una lectura por petición)
+#   'cache'   -> caché delante de la base de datos (cached_db): las lecturas
+#                salen de la caché y las escrituras van a ambas
+#   'archivo' -> un archivo por sesión en SESION_DIRECTORIO
+#   'cookie'  -> cookie firmada; nada en el servidor (la sesión solo guarda
+#                el nombre, la sala pendiente y la membresía)
+SESIONES = os.environ.get('SESIONES', 'bd')
+SESSION_ENGINE = {
+    'bd': 'django.contrib.sessions.backends.db',
+    'cache': 'django.contrib.sessions.backends.cached_db',
+    'archivo': 'django.contrib.sessions.backends.file',
+    'cookie': 'django.contrib.sessions.backends.signed_cookies',
+}[SESIONES]
+if os.environ.get('SESION_DIRECTORIO'):
+    SESSION_FILE_PATH = os.environ['SESION_DIRECTORIO']
+
+# Caché de Django (la usan las sesiones en modo 'cache'). En memoria del
+# proceso por defecto; con CACHE_DIRECTORIO se comparte entre los
+# procesos de la máquina a través de archivos.
+if os.environ.get('CACHE_DIRECTORIO'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ['CACHE_DIRECTORIO'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# DATABASE_URL (dj-database-url) elige la base de datos; sin ella se usa
+# SQLite en db.sqlite3. Con BD_CONN_MAX_AGE > 0 las conexiones se reutilizan
+# durante esos segundos; por defecto 0 (una por petición) porque con daphne
+# las vistas y database_sync_to_async corren en hilos cuyas conexiones no
+# cierra request_finished, y en PostgreSQL se irían acumulando. Subirlo
+# solo con un pool delante (p. ej. PgBouncer) o con hilos de vida acotada.
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': dj_database_url.config(
+        default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}",
+        conn_max_age=int(os.environ.get('BD_CONN_MAX_AGE', '0')),
+        conn_health_checks=True,
+    )
+}
+
+# SQLite usa el backend de lobos/sqlite: PRAGMA al conectar (WAL,
+# synchronous, busy_timeout en milisegundos) y BEGIN IMMEDIATE para que
+# las escrituras concurrentes esperen en lugar de fallar.
+BD_SQLITE = {
+    'WAL': os.environ.get('BD_SQLITE_WAL', 'True') == 'True',
+    'SYNCHRONOUS': os.environ.get('BD_SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'BUSY_TIMEOUT': int(os.environ.get('BD_SQLITE_BUSY_TIMEOUT', '20000')),
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['ENGINE'] = 'lobos.sqlite'
+
+# Conexión de solo lectura para las lecturas de estado de las salas
+# (juego/cache_salas.py). Con BD_LECTURA=True es otra conexión a la misma
+# base; DATABASE_URL_LECTURA permite apuntar a una réplica.
+if os.environ.get('DATABASE_URL_LECTURA') or os.environ.get('BD_LECTURA') == 'True':
+    if os.environ.get('DATABASE_URL_LECTURA'):
+        DATABASES['lectura'] = dj_database_url.parse(
+            os.environ['DATABASE_URL_LECTURA'],
+            conn_max_age=DATABASES['default']['CONN_MAX_AGE'],
+            conn_health_checks=True,
+        )
+    else:
+        DATABASES['lectura'] = dict(DATABASES['default'])
+    if DATABASES['lectura']['ENGINE'] in ('django.db.backends.sqlite3', 'lobos.sqlite'):
+        DATABASES['lectura']['ENGINE'] = 'lobos.sqlite'
+        DATABASES['lectura']['OPTIONS'] = {'solo_lectura': True}
+    DATABASES['lectura']['TEST'] = {'MIRROR': 'default'}
 
 
 # Password validation
@@ -149,6 +341,9 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+# collectstatic guarda cada archivo con un hash en el nombre y sus versiones
+# .gz y .br (brotli, si está instalado); whitenoise sirve la comprimida que
+# acepte el navegador y, al estar versionados, con caché de un año (immutable).
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Default primary key field type
@@ -0,0 +1,50 @@
+"""
+Backend SQLite con el perfil de producción del juego.
+
+- Al abrir cada conexión aplica los PRAGMA de settings.BD_SQLITE: modo WAL
+  (las lecturas no bloquean a quien escribe), synchronous y busy_timeout.
+- Las transacciones empiezan con BEGIN IMMEDIATE, que toma el bloqueo de
+  escritura al principio. Con un BEGIN normal la transacción lee primero y
+  al pasar a escribir SQLite responde "database is locked" sin esperar al
+  busy_timeout si otro proceso escribió entre medias.
+- Con OPTIONS['solo_lectura'] la conexión se abre con PRAGMA query_only.
+"""
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+MODOS_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('solo_lectura', None)
+        return params
+
+    @property
+    def solo_lectura(self):
+        return bool(self.settings_dict['OPTIONS'].get('solo_lectura'))
+
+    def get_new_connection(self, conn_params):
+        conexion = super().get_new_connection(conn_params)
+        perfil = getattr(settings, 'BD_SQLITE', {})
+        synchronous = perfil.get('SYNCHRONOUS', 'NORMAL').upper()
+        if synchronous not in MODOS_SYNCHRONOUS:
+            raise ValueError(f'BD_SQLITE["SYNCHRONOUS"] inválido: {synchronous}')
+
+        cursor = conexion.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(perfil.get('BUSY_TIMEOUT', 5000))}")
+        if self.solo_lectura:
+            cursor.execute('PRAGMA query_only = 1')
+        else:
+            if perfil.get('WAL', True):
+                cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute(f'PRAGMA synchronous = {synchronous}')
+        cursor.close()
+        return conexion
+
+    def _start_transaction_under_autocommit(self):
+        if self.solo_lectura:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute('BEGIN IMMEDIATE')
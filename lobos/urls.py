@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from juego import metricas
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('interno/metricas/', metricas.vista, name='metricas'),
     path('', include('juego.urls')), # Conecta con las urls de tu app
 ]
\ No newline at end of file
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Arranca daphne con permessage-deflate en los WebSockets (daphne no deja
+configurarlo). Acepta los mismos argumentos que `daphne`:
+
+    python servidor.py -b 0.0.0.0 -p 8000 lobos.asgi:application
+
+La compresión se negocia en el handshake con cada navegador que la ofrezca
+y se configura con WEBSOCKET_DEFLATE en lobos/settings.py.
+"""
+import os
+import sys
+
+# daphne.cli instala el reactor asyncio de Twisted: va antes que `reactor`
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from twisted.internet import reactor
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lobos.settings')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ServidorDeflate(Server):
+    def run(self):
+        # La fábrica de WebSockets se crea dentro de run(): se configura en
+        # cuanto arranca el reactor, antes de aceptar ningún handshake
+        reactor.callWhenRunning(self.activar_deflate)
+        super().run()
+
+    def activar_deflate(self):
+        from django.conf import settings
+
+        config = settings.WEBSOCKET_DEFLATE
+        if not config['ACTIVO']:
+            return
+
+        def aceptar(ofertas):
+            for oferta in ofertas:
+                if isinstance(oferta, PerMessageDeflateOffer):
+                    # La ventana es la del compresor del servidor: no puede
+                    # pasar del máximo que pida el navegador
+                    ventana = min(config['VENTANA'], oferta.request_max_window_bits or 15)
+                    return PerMessageDeflateOfferAccept(
+                        oferta, window_bits=ventana, mem_level=config['MEMORIA']
+                    )
+            return None
+
+        self.ws_factory.setProtocolOptions(perMessageCompressionAccept=aceptar)
+
+
+class LineaDeComandos(CommandLineInterface):
+    server_class = ServidorDeflate
+
+
+if __name__ == '__main__':
+    LineaDeComandos.entrypoint()